@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# End to end benchmark of import_manifest.py kblookup, import and sync modes against the local mock Black Duck
+# server in mock_hub.py. For each synthetic component list size, kblookup is run (with an empty KB cache)
+# followed by import into a new project version, then sync (with another empty KB cache) into a second new
+# project version, and the requests made to the server are recorded to report:
+#   - requests and response KB per component list entry, by endpoint
+#   - p50/p95 server request latency (including the simulated latency)
+#   - elapsed time and throughput (component list entries per second) of each phase
+#   - number of packages matched by kblookup to the KB component they were generated from
+#   - with --throttle, the rate of requests accepted by the server (not answered with 429) - the benchmark fails if
+#     kblookup (which sends KB requests as fast as the rate limit allows) uses less than --min-throttle-use of the
+#     throttle rate, so the adaptive rate limit of the request layer is checked to recover after throttling
+#
+# The synthetic component list is mostly exact name and version matches, plus entries which need the
+# name variant search (e.g. 'name-dev'), versions not in the KB and components not in the KB.
+#
+# Usage: bench_import_manifest.py [--sizes 100,1000,10000] [--latency SECONDS] [--jitter FRACTION] [--workers N]
+#                                 [--throttle RATE] [--min-throttle-use FRACTION] [--phases kblookup,import,sync] [--fixtures FILE] [--script PATH] [--json FILE] [--keep]
+#   --phases    modes to run (e.g. kblookup,import to compare with a release without sync mode)
+#   --throttle  requests per second above which the mock server answers 429 Too Many Requests
+#   --min-throttle-use  fraction of the --throttle rate kblookup must sustain (default 0.8, checked for runs of 10 seconds or more)
+#   --script  import_manifest.py to benchmark (default the one in this repository) - use to compare releases
+#   --json    also write the results to FILE as JSON
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_hub import MockHub, synthetic_kb
+
+MIN_CHECKED_ELAPSED = 10    # Seconds a throttled kblookup phase must run for its throughput to be checked (start-up dominates shorter runs)
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "import_manifest.py")
+
+def make_manifest(components, entries, seed=1):
+    #
+    # Return a list of 'name-version' component list lines for the KB components, and dict of package name ->
+    # the KB component name it was generated from
+    rng = random.Random(seed)
+    lines = []
+    expected = {}
+    for i in range(entries):
+        comp = rng.choice(components)
+        version = rng.choice(comp['versions'])
+        roll = rng.random()
+        if roll < 0.7:
+            # Exact name & version
+            package = comp['name']
+        elif roll < 0.8:
+            # Package name needs the variant search
+            package = "{}-{}".format(comp['name'], rng.choice(["dev", "utils", "lib"]))
+        elif roll < 0.9:
+            # Version not in the KB
+            package = comp['name']
+            version += ".99"
+        else:
+            # Component not in the KB
+            package = "nokb{}".format("".join(rng.choice("abcdefghij") for i in range(6)))
+        lines.append("{}-{}".format(package, version))
+        if not package.startswith("nokb"):
+            expected[package] = comp['name']
+    return lines, expected
+
+def check_matches(kbfile, expected):
+    #
+    # Return the number of packages in the kbfile matched to the expected KB component (and no other component)
+    matched = {}
+    with open(kbfile) as kfile:
+        for line in kfile:
+            elements = line.split(";")
+            if len(elements) > 3 and elements[3] != "NO MATCH":
+                matched.setdefault(elements[0], set()).add(elements[1])
+    return len([package for package, compname in expected.items() if matched.get(package) == {compname}])
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+def run_phase(hub, name, command, workdir, entries):
+    #
+    # Run one import_manifest.py command and return its statistics
+    hub.reset_stats()
+    logpath = os.path.join(workdir, name + ".log")
+    start = time.time()
+    with open(logpath, "w") as logfile:
+        result = subprocess.run(command, cwd=workdir, stdout=logfile, stderr=subprocess.STDOUT)
+    elapsed = time.time() - start
+    requests = hub.reset_stats()
+    if result.returncode != 0:
+        print("  {} failed with exit code {} - see {}".format(name, result.returncode, logpath))
+
+    endpoints = {}
+    for endpoint, status, seconds, size in requests:
+        stats = endpoints.setdefault(endpoint, {'count': 0, 'errors': 0, 'bytes': 0})
+        stats['count'] += 1
+        stats['bytes'] += size
+        if status >= 400:
+            stats['errors'] += 1
+    latencies = [seconds for endpoint, status, seconds, size in requests]
+    totalbytes = sum(size for endpoint, status, seconds, size in requests)
+    accepted = len([endpoint for endpoint, status, seconds, size in requests if status != 429])
+    return {
+        'phase': name,
+        'entries': entries,
+        'returncode': result.returncode,
+        'elapsed': elapsed,
+        'throughput': entries / elapsed if elapsed else 0.0,
+        'requests': len(requests),
+        'requests_per_entry': len(requests) / float(entries) if entries else 0.0,
+        'accepted_rate': accepted / elapsed if elapsed else 0.0,
+        'bytes': totalbytes,
+        'kb_per_entry': totalbytes / 1024.0 / entries if entries else 0.0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'endpoints': endpoints,
+    }
+
+def print_result(result):
+    print("  {:<10} {:>8.1f}s {:>9.1f}/s {:>9} {:>9.2f} {:>9.2f} {:>8.1f} {:>8.1f}".format(
+        result['phase'], result['elapsed'], result['throughput'], result['requests'], result['requests_per_entry'],
+        result['kb_per_entry'], result['latency_p50'] * 1000, result['latency_p95'] * 1000))
+    print("             per entry: " + ", ".join(
+        "{} {:.2f} ({:.1f} KB){}".format(endpoint, stats['count'] / float(result['entries']), stats['bytes'] / 1024.0 / result['entries'],
+                                             " ({} errors)".format(stats['errors']) if stats['errors'] else "")
+        for endpoint, stats in sorted(result['endpoints'].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import_manifest.py against a mock Black Duck server')
+    parser.add_argument('--sizes', help='Comma separated component list sizes (default 100,1000,10000)', default='100,1000,10000')
+    parser.add_argument('--latency', help='Simulated server latency per request in seconds (default 0.005)', type=float, default=0.005)
+    parser.add_argument('--jitter', help='Random variation of the latency as a fraction (default 0.5)', type=float, default=0.5)
+    parser.add_argument('--workers', help='--workers value passed to import_manifest.py (default 4)', type=int, default=4)
+    parser.add_argument('--throttle', help='Requests per second above which the mock server answers 429 Too Many Requests - 0 for no limit (default 0)', type=float, default=0.0)
+    parser.add_argument('--min-throttle-use', help='Fraction of the --throttle rate the kblookup phase must sustain (default 0.8)', type=float, default=0.8)
+    parser.add_argument('--phases', help='Comma separated modes to run (default kblookup,import,sync)', default='kblookup,import,sync')
+    parser.add_argument('--fixtures', help='JSON file of KB components for the mock server (default synthetic components)')
+    parser.add_argument('--script', help='import_manifest.py script to benchmark', default=DEFAULT_SCRIPT)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='Write results to this file as JSON')
+    parser.add_argument('--keep', help='Keep the working directories (component lists, kbfiles and logs)', action='store_true')
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        if args.fixtures:
+            with open(args.fixtures) as ffile:
+                components = json.load(ffile)
+        else:
+            components = synthetic_kb(max(1000, size), args.seed)
+        hub = MockHub(components, args.latency, args.jitter, throttle=args.throttle).start()
+        workdir = tempfile.mkdtemp(prefix="bench_import_manifest_")
+        with open(os.path.join(workdir, ".restconfig.json"), "w") as cfile:
+            json.dump({'baseurl': hub.baseurl, 'api_token': 'benchmark', 'insecure': True, 'debug': False}, cfile)
+        lines, expected = make_manifest(components, size, args.seed)
+        with open(os.path.join(workdir, "manifest.txt"), "w") as mfile:
+            mfile.write("\n".join(lines) + "\n")
+
+        print("")
+        print("{} component list entries, {} KB components, {:.1f} ms latency, {} workers ({})".format(
+            size, len(components), args.latency * 1000, args.workers, workdir if args.keep else "temporary directory"))
+        print("  {:<10} {:>9} {:>11} {:>9} {:>9} {:>9} {:>8} {:>8}".format("phase", "elapsed", "entries", "requests", "req/entry", "KB/entry", "p50 ms", "p95 ms"))
+        common = ['--workers', str(args.workers)]
+        phases = (
+            ('kblookup', ['kblookup', '-c', 'manifest.txt', '-o', 'kblookup.out', '--restart', '--cache-dir', 'cache'], 'kblookup.out'),
+            ('import', ['import', '-c', 'manifest.txt', '-k', 'kblookup.out', '-p', 'benchmark', '-v', str(size), '--cache-dir', 'cache'], None),
+            ('sync', ['sync', '-c', 'manifest.txt', '-o', 'sync.out', '-p', 'benchmark-sync', '-v', str(size), '--cache-dir', 'cache-sync'], 'sync.out'))
+        for name, command, kbfile in phases:
+            if name not in args.phases.split(","):
+                continue
+            result = run_phase(hub, name, [sys.executable, os.path.abspath(args.script)] + command + common, workdir, size)
+            result['size'] = size
+            print_result(result)
+            if kbfile and os.path.exists(os.path.join(workdir, kbfile)):
+                result['correct_matches'] = check_matches(os.path.join(workdir, kbfile), expected)
+                result['expected_matches'] = len(expected)
+                print("             {} of {} packages matched to the expected KB component".format(result['correct_matches'], len(expected)))
+            if args.throttle:
+                result['throttle_use'] = result['accepted_rate'] / args.throttle
+                print("             {:.1f} requests/s accepted ({:.0%} of the {:.1f}/s throttle rate)".format(
+                    result['accepted_rate'], result['throttle_use'], args.throttle))
+                if name == 'kblookup' and result['elapsed'] >= MIN_CHECKED_ELAPSED and result['throttle_use'] < args.min_throttle_use:
+                    print("  FAILED: kblookup sustained less than {:.0%} of the throttle rate".format(args.min_throttle_use))
+                    result['throttle_check_failed'] = True
+            results.append(result)
+
+        hub.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as jfile:
+            json.dump(results, jfile, indent=2)
+
+    if any(result['returncode'] != 0 or result.get('throttle_check_failed') for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Benchmark of the compiled KB Lookup file index (kb_index.py) against reading the KB Lookup file into dicts with
+# import_kbfile(). Checks that both return the same KB component and version URLs for every query and reports
+# the time and memory used to load each, the file sizes and the time per lookup.
+#
+# Usage: bench_kb_index.py [--entries N] [--queries N] [--seed SEED]
+#   --entries  Number of packages in the synthetic KB Lookup file (default 200000)
+#   --queries  Number of package and package/version lookups (default 20000)
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kb_index
+from import_manifest import import_kbfile
+
+BASEURL = "https://hub.example.com"
+
+def write_kbfile(path, entries, rnd):
+    #
+    # Write a synthetic KB Lookup file - most packages matched to one KB component with 1-4 versions, some matched
+    # to two components, some NO MATCH
+    with open(path, "w") as kfile:
+        for number in range(entries):
+            package = "package-{}-{}".format(number, rnd.choice(("dev", "lib", "doc", "utils")))
+            if rnd.random() < 0.1:
+                kfile.write("{};;;NO MATCH;1.0;NO VERSION MATCH;\n".format(package))
+                continue
+            for component in range(2 if rnd.random() < 0.05 else 1):
+                compurl = "{}/api/components/{}".format(BASEURL, uuid.UUID(int=rnd.getrandbits(128), version=4))
+                versions = ""
+                for version in range(rnd.randint(1, 4)):
+                    verurl = "{}/versions/{}".format(compurl, uuid.UUID(int=rnd.getrandbits(128), version=4)) if rnd.random() < 0.9 else "NO VERSION MATCH"
+                    versions += "{}.{}.{};{};".format(rnd.randint(0, 9), version, rnd.randint(0, 30), verurl)
+                kfile.write("{};{};http://{}.org/;{};{}\n".format(package, package.split("-")[0], package, compurl, versions))
+
+def measure(load):
+    #
+    # Return the result, elapsed time, and memory held and peak memory (measured in a second call, as tracing
+    # allocations slows down the load) of load()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = load()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        held = load()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del held
+    return result, elapsed, current, peak
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the compiled KB Lookup file index')
+    parser.add_argument('--entries', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench_kb_index_")
+    try:
+        kbfile = os.path.join(workdir, "kblookup.out")
+        write_kbfile(kbfile, args.entries, rnd)
+        start = time.perf_counter()
+        counts = kb_index.compile_index(kbfile)
+        compile_time = time.perf_counter() - start
+
+        (kblookupdict, kbverdict), text_time, text_mem, text_peak = measure(lambda: import_kbfile(kbfile, ""))
+        index, index_time, index_mem, index_peak = measure(lambda: kb_index.open_index(kbfile))
+
+        packages = rnd.sample(list(kblookupdict), min(args.queries, len(kblookupdict))) + ["missing-{}".format(n) for n in range(100)]
+        verkeys = rnd.sample(list(kbverdict), min(args.queries, len(kbverdict))) + ["missing/{}".format(n) for n in range(100)]
+        for package in packages:
+            assert kblookupdict.get(package) == index.packages.get(package), package
+        for packstr in verkeys:
+            assert kbverdict.get(packstr) == index.versions.get(packstr), packstr
+
+        timings = {}
+        for name, lookups, versions in (("dict", kblookupdict, kbverdict), ("index", index.packages, index.versions)):
+            start = time.perf_counter()
+            for package in packages:
+                lookups.get(package)
+            for packstr in verkeys:
+                versions.get(packstr)
+            timings[name] = (time.perf_counter() - start) / (len(packages) + len(verkeys))
+
+        print("KB Lookup file: {} entries, {} packages, {} versions - {:.1f} MB text, {:.1f} MB index (compiled in {:.2f} s)".format(
+            counts['components'], counts['packages'], counts['versions'], os.path.getsize(kbfile) / 1e6, counts['size'] / 1e6, compile_time))
+        print("{:<8} {:>10} {:>12} {:>12} {:>12}".format("", "load s", "held MB", "peak MB", "lookup us"))
+        print("{:<8} {:>10.3f} {:>12.1f} {:>12.1f} {:>12.2f}".format("text", text_time, text_mem / 1e6, text_peak / 1e6, timings["dict"] * 1e6))
+        print("{:<8} {:>10.3f} {:>12.1f} {:>12.1f} {:>12.2f}".format("index", index_time, index_mem / 1e6, index_peak / 1e6, timings["index"] * 1e6))
+        print("All {} lookups returned the same KB URLs".format(len(packages) + len(verkeys)))
+        index.close()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
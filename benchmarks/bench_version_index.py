@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Benchmark of version_index.VersionIndex against the original linear SequenceMatcher scan from
+# find_ver_from_compver(). Checks that both matchers return the same version and match strength
+# for every query and reports the time per lookup.
+#
+# Usage: bench_version_index.py [--versions-file FILE] [--queries N] [--seed SEED]
+#   --versions-file  JSON versions payload saved from <component>/versions?limit=1000 (can be specified
+#                    multiple times) - synthetic kernel, openssl and busybox version lists are used if not specified
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from version_index import VersionIndex
+
+def legacy_match(items, version):
+    #
+    # Version matching loop from find_ver_from_compver() before the version index was introduced
+    # (debug logging removed)
+    matchversion = ""
+    kbver_url = ""
+    localversion = version.replace('-','.')
+    for kbversion in items:
+
+        kbversionname = kbversion['versionName'].replace('-', '.')
+        kbver_url = kbversion['_meta']['href']
+        if (kbversionname == localversion):
+            matchversion = kbversion['versionName']
+            matchstrength = 3
+            break
+
+        seq = SequenceMatcher(None, kbversionname, localversion)
+        match = seq.find_longest_match(0, len(kbversionname), 0, len(localversion))
+        if (match.a == 0) and (match.b == 0) and (match.size == len(kbversionname)):
+            if len(kbversionname) > len(matchversion):
+                matchversion = kbversion['versionName']
+                matchstrength = 2
+
+        elif (match.b == 0) and (match.size == len(localversion)):
+            mob = re.search(r'\d', kbversionname[0:match.a])
+            if not mob and (len(kbversionname) > len(matchversion)):
+                matchversion = kbversion['versionName']
+                if (match.a == 1) and (kbversionname.lower() == 'v' ):
+                    matchstrength = 3
+                else:
+                    matchstrength = 2
+
+        elif (match.a == 0) and (match.b == 0) and (match.size > 2):
+            if 0 <= match.size - localversion.rfind(".") <= 2:
+                kbfinalsegment = kbversionname.split(".")[-1]
+                localfinalsegment = localversion.split(".")[-1]
+                if (kbfinalsegment.isdigit() and localfinalsegment.isdigit()):
+                    if abs(int(kbfinalsegment) - int(localfinalsegment)) <= 2:
+                        if len(kbversionname) >= len(matchversion):
+                            matchversion = kbversion['versionName']
+                            matchstrength = 1
+
+    if matchversion != "":
+        return matchversion, matchstrength
+    return "", 0
+
+def make_items(name, versions):
+    url = "https://hub.example.com/api/components/{}/versions/".format(name)
+    return [{'versionName': v, '_meta': {'href': url + str(i)}} for i, v in enumerate(versions)]
+
+def kernel_versions():
+    versions = []
+    for major, minor, patches in ((2, 6, 0), (3, 10, 108), (4, 4, 302), (4, 19, 280), (5, 4, 240), (5, 10, 170), (5, 15, 110), (6, 1, 30)):
+        versions.append("{}.{}".format(major, minor))
+        for rc in range(1, 8):
+            versions.append("{}.{}-rc{}".format(major, minor, rc))
+        for patch in range(1, patches + 1):
+            versions.append("{}.{}.{}".format(major, minor, patch))
+    for minor in range(0, 40):
+        versions.append("2.6.{}".format(minor))
+    return versions[:1000]
+
+def openssl_versions():
+    versions = []
+    for base in ("0.9.8", "1.0.0", "1.0.1", "1.0.2", "1.1.0", "1.1.1"):
+        versions.append(base)
+        versions.append("OpenSSL_" + base.replace(".", "_"))
+        for letter in "abcdefghijklmnopqrstuvw":
+            versions.append(base + letter)
+            versions.append("OpenSSL_{}{}".format(base.replace(".", "_"), letter))
+    for minor in range(0, 2):
+        for patch in range(0, 12):
+            versions.append("3.{}.{}".format(minor, patch))
+        for alpha in range(1, 18):
+            versions.append("3.{}.0-alpha{}".format(minor, alpha))
+        versions.append("openssl-3.{}.0".format(minor))
+    return versions
+
+def busybox_versions():
+    versions = []
+    for minor in range(0, 37):
+        for patch in range(0, 6):
+            versions.append("1.{}.{}".format(minor, patch))
+            versions.append("v1.{}.{}".format(minor, patch))
+            versions.append("1_{}_{}".format(minor, patch))
+    return versions
+
+def make_queries(versions, count, rng):
+    #
+    # Mix of exact, bumped, truncated, extended and unrelated version strings
+    queries = []
+    for _ in range(count):
+        version = rng.choice(versions)
+        kind = rng.randrange(7)
+        if kind == 1:
+            version = re.sub(r'(\d+)$', lambda m: str(int(m.group(1)) + rng.randrange(-3, 4)), version)
+        elif kind == 2:
+            version = version.rsplit(".", 1)[0]
+        elif kind == 3:
+            version = version + rng.choice(["-r0", ".1", "+git", "-1"])
+        elif kind == 4:
+            version = version.replace(".", "-")
+        elif kind == 5:
+            version = version.lstrip("v").replace("OpenSSL_", "").replace("_", ".")
+        elif kind == 6:
+            version = "{}.{}.{}".format(rng.randrange(10), rng.randrange(50), rng.randrange(300))
+        queries.append(version)
+    return queries
+
+def bench(name, items, queries):
+    start = time.perf_counter()
+    legacy = [legacy_match(items, query) for query in queries]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = VersionIndex(items)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    indexed = [index.match(query) for query in queries]
+    index_time = time.perf_counter() - start
+
+    mismatches = 0
+    for query, old, new in zip(queries, legacy, indexed):
+        if old != (new[0], new[2]):
+            mismatches += 1
+            print("  MISMATCH {} query '{}': legacy={} index={}".format(name, query, old, (new[0], new[2])))
+    per_legacy = 1e6 * legacy_time / len(queries)
+    per_index = 1e6 * index_time / len(queries)
+    print("{:<10} {:>6} versions {:>6} queries  legacy {:>9.1f} us/lookup  index {:>7.1f} us/lookup (build {:.1f} ms)  speedup {:>6.1f}x  mismatches {}".format(
+        name, len(items), len(queries), per_legacy, per_index, build_time * 1000, per_legacy / per_index, mismatches))
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare version_index.VersionIndex with the original linear version matcher')
+    parser.add_argument('--versions-file', help='JSON versions payload from the KB (can be specified multiple times)', action='append')
+    parser.add_argument('--queries', help='Number of version lookups per component (default 2000)', type=int, default=2000)
+    parser.add_argument('--seed', help='Random seed for generated queries (default 1)', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    components = []
+    if args.versions_file:
+        for versions_file in args.versions_file:
+            with open(versions_file) as f:
+                items = json.load(f).get('items', [])
+            components.append((os.path.basename(versions_file), items))
+    else:
+        components.append(("kernel", make_items("kernel", kernel_versions())))
+        components.append(("openssl", make_items("openssl", openssl_versions())))
+        components.append(("busybox", make_items("busybox", busybox_versions())))
+
+    mismatches = 0
+    for name, items in components:
+        versions = [item['versionName'] for item in items]
+        mismatches += bench(name, items, make_queries(versions, args.queries, rng))
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+#
+# Local stand-in for the Black Duck server endpoints used by import_manifest.py, for benchmarks and
+# manual testing without a Black Duck server. Serves a KB of components and versions (synthetic, or
+# loaded from a JSON fixture file) and keeps projects, versions and BOMs in memory:
+#   POST   /api/tokens/authenticate                     API token authentication
+#   GET    /api/current-version
+#   GET    /api/search/components?q=name:NAME            KB component search (components whose name starts with NAME, most versions first)
+#   GET    /api/components/ID                           KB component
+#   GET    /api/components/ID/versions?q=versionName:V&limit=&offset=
+#   GET    /api/projects?q=name:NAME, POST /api/projects
+#   GET    /api/projects/ID/versions?q=versionName:V, POST /api/projects/ID/versions
+#   GET    /api/projects/ID/versions/ID/components?limit=&offset=, POST (add manual component)
+#   DELETE /api/projects/ID/versions/ID/components/ID
+# Responses are gzip compressed when the client accepts gzip. Every request is recorded (endpoint, status, time taken
+# including the configured latency and response size as sent) for reporting.
+# With --throttle RATE, requests (other than authentication) received faster than RATE per second are answered with
+# 429 Too Many Requests and Retry-After: 1, to exercise the retries and rate limiting of import_manifest.py.
+#
+# Usage: mock_hub.py [--port PORT] [--latency SECONDS] [--jitter FRACTION] [--throttle RATE] [--components N] [--fixtures FILE]
+# then create .restconfig.json containing {"baseurl": "http://127.0.0.1:PORT", "api_token": "x", "insecure": true}
+# in the directory where import_manifest.py is run.
+#
+# Fixture file format: [{"name": NAME, "url": SOURCEURL, "versions": [VERSIONNAME, ...]}, ...]
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SEARCH_LIMIT = 20
+GZIP_MIN_SIZE = 256     # Smallest response body compressed
+
+def synthetic_kb(count, seed=1):
+    #
+    # Return a list of count KB components with random names and version lists. About 30% of components
+    # have forks (components named with a suffix added, e.g. 'name' and 'namex') sharing some of their versions.
+    rng = random.Random(seed)
+    components = []
+    names = set()
+    while len(components) < count:
+        name = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for i in range(rng.randint(4, 10)))
+        if name in names:
+            continue
+        names.add(name)
+        versions = []
+        major = rng.randint(0, 5)
+        for minor in range(rng.randint(1, 8)):
+            for patch in range(rng.randint(1, 12)):
+                versions.append("{}.{}.{}".format(major, minor, patch))
+        rng.shuffle(versions)
+        components.append({'name': name, 'url': "https://{}.example.org/".format(name), 'versions': versions})
+        if rng.random() < 0.3:
+            for fork in range(rng.randint(1, 3)):
+                forkname = name + "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for i in range(rng.randint(1, 3)))
+                if forkname in names or len(components) >= count:
+                    continue
+                names.add(forkname)
+                forkversions = rng.sample(versions, rng.randint(1, len(versions))) + ["{}.99.{}".format(major, i) for i in range(rng.randint(0, 40))]
+                components.append({'name': forkname, 'url': "https://{}.example.org/".format(forkname), 'versions': forkversions})
+    return components
+
+class MockHub:
+    def __init__(self, components, latency=0.0, jitter=0.0, port=0, throttle=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.recent = deque()   # Times of requests in the last second (for --throttle)
+        self.components = {}    # id -> {name, url, versions: [(id, versionName)]}
+        for comp in components:
+            compid = str(uuid.uuid5(uuid.NAMESPACE_URL, comp['name']))
+            self.components[compid] = {
+                'name': comp['name'],
+                'url': comp.get('url', ""),
+                'versions': [(str(uuid.uuid5(uuid.NAMESPACE_URL, comp['name'] + "/" + version)), version) for version in comp['versions']],
+            }
+        ordered = sorted((comp['name'].lower(), compid) for compid, comp in self.components.items())
+        self.search_names = [name for name, compid in ordered]
+        self.search_ids = [compid for name, compid in ordered]
+        self.projects = {}      # id -> {name, versions: {id: versionName}}
+        self.boms = {}          # version id -> list of KB component version URLs
+        self.lock = threading.Lock()
+        self.requests = []      # (endpoint, status, seconds, response bytes)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), MockHubHandler)
+        self.server.daemon_threads = True
+        self.server.hub = self
+        self.thread = None
+
+    @property
+    def baseurl(self):
+        return "http://{}:{}".format(*self.server.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, endpoint, status, seconds, size):
+        with self.lock:
+            self.requests.append((endpoint, status, seconds, size))
+
+    def reset_stats(self):
+        with self.lock:
+            requests = self.requests
+            self.requests = []
+        return requests
+
+    def throttled(self):
+        #
+        # True if the request should be refused because more than throttle requests were received in the last second
+        if not self.throttle:
+            return False
+        with self.lock:
+            now = time.time()
+            while self.recent and self.recent[0] < now - 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.throttle:
+                return True
+            self.recent.append(now)
+            return False
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def search(self, name):
+        #
+        # KB components whose name starts with name (case insensitive), components with most versions first
+        name = name.lower()
+        start = bisect_left(self.search_names, name)
+        ids = []
+        for pos in range(start, len(self.search_names)):
+            if not self.search_names[pos].startswith(name) or len(ids) >= SEARCH_LIMIT:
+                break
+            ids.append(self.search_ids[pos])
+        return sorted(ids, key=lambda compid: -len(self.components[compid]['versions']))
+
+def query_value(query, param, prefix):
+    #
+    # Return the value of a 'prefix:value' query parameter, or None
+    value = query.get(param, [None])[0]
+    if value is None or not value.startswith(prefix + ":"):
+        return None
+    return value[len(prefix) + 1:]
+
+def page(items, query):
+    offset = int(query.get('offset', ['0'])[0])
+    limit = int(query.get('limit', ['10'])[0])
+    return {'totalCount': len(items), 'items': items[offset:offset + limit]}
+
+class MockHubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately - without TCP_NODELAY each keep-alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj, headers=None):
+        # 204 No Content responses must not have a body (a keep-alive client would read it as the next response)
+        body = json.dumps(obj).encode() if status != 204 else b""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if len(body) > GZIP_MIN_SIZE and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.sent_bytes = len(body)
+        return status
+
+    def handle_request(self, method):
+        hub = self.server.hub
+        start = time.time()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = self.rfile.read(length) if length else b""
+        hub.delay()
+        endpoint, status = self.route(hub, method, url.path, query, body)
+        hub.record(endpoint, status, time.time() - start, self.sent_bytes)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def route(self, hub, method, path, query, body):
+        base = hub.baseurl
+        if path == '/api/tokens/authenticate':
+            return 'auth', self.send_json(200, {'bearerToken': 'token', 'expiresInMilliseconds': 7200000}, {'X-CSRF-TOKEN': 'csrf'})
+        if hub.throttled():
+            return 'throttled', self.send_json(429, {'errorMessage': 'Too many requests'}, {'Retry-After': '1'})
+        if path == '/api/current-version':
+            return 'current-version', self.send_json(200, {'version': '2023.10.0'})
+
+        if path == '/api/search/components':
+            name = query_value(query, 'q', 'name') or ""
+            hits = [{'component': base + '/api/components/' + compid,
+                     'fields': {'name': [hub.components[compid]['name']], 'release_count': [str(len(hub.components[compid]['versions']))]}}
+                    for compid in hub.search(name)]
+            return 'search', self.send_json(200, {'totalCount': 1, 'items': [
+                {'searchResultStatistics': {'numResultsInThisPage': len(hits)}, 'hits': hits}]})
+
+        mob = re.match(r'/api/components/([^/]+)(/versions)?$', path)
+        if mob:
+            comp = hub.components.get(mob.group(1))
+            if comp is None:
+                return 'component', self.send_json(404, {})
+            href = base + '/api/components/' + mob.group(1)
+            if not mob.group(2):
+                return 'component', self.send_json(200, {'name': comp['name'], 'url': comp['url'],
+                                                         '_meta': {'href': href, 'links': [{'rel': 'versions', 'href': href + '/versions'}]}})
+            versions = comp['versions']
+            versionname = query_value(query, 'q', 'versionName')
+            if versionname is not None:
+                versions = [(verid, name) for verid, name in versions if versionname in name]
+            items = [{'versionName': name, '_meta': {'href': href + '/versions/' + verid}} for verid, name in versions]
+            return 'versions', self.send_json(200, page(items, query))
+
+        if path == '/api/projects':
+            if method == 'POST':
+                data = json.loads(body)
+                with hub.lock:
+                    projid = str(uuid.uuid4())
+                    verid = str(uuid.uuid4())
+                    hub.projects[projid] = {'name': data['name'], 'versions': {verid: data['versionRequest']['versionName']}}
+                return 'projects', self.send_json(201, {}, {'Location': base + '/api/projects/' + projid})
+            name = query_value(query, 'q', 'name') or ""
+            items = [{'name': proj['name'], '_meta': {'href': base + '/api/projects/' + projid,
+                                                      'links': [{'rel': 'versions', 'href': base + '/api/projects/' + projid + '/versions'}]}}
+                     for projid, proj in hub.projects.items() if name in proj['name']]
+            return 'projects', self.send_json(200, page(items, query))
+
+        mob = re.match(r'/api/projects/([^/]+)/versions$', path)
+        if mob and mob.group(1) in hub.projects:
+            proj = hub.projects[mob.group(1)]
+            href = base + '/api/projects/' + mob.group(1) + '/versions/'
+            if method == 'POST':
+                verid = str(uuid.uuid4())
+                with hub.lock:
+                    proj['versions'][verid] = json.loads(body)['versionName']
+                return 'project-versions', self.send_json(201, {}, {'Location': href + verid})
+            name = query_value(query, 'q', 'versionName') or ""
+            items = [{'versionName': vername, '_meta': {'href': href + verid, 'links': []}}
+                     for verid, vername in proj['versions'].items() if name in vername]
+            return 'project-versions', self.send_json(200, page(items, query))
+
+        mob = re.match(r'/api/projects/([^/]+)/versions/([^/]+)/components(/\d+)?$', path)
+        if mob and mob.group(1) in hub.projects:
+            bom = hub.boms.setdefault(mob.group(2), [])
+            if method == 'POST':
+                with hub.lock:
+                    bom.append(json.loads(body)['component'])
+                return 'bom-add', self.send_json(200, {})
+            if method == 'DELETE':
+                with hub.lock:
+                    bom[int(mob.group(3)[1:])] = None
+                return 'bom-delete', self.send_json(204, {})
+            href = base + path.split('/components')[0] + '/components/'
+            items = [{'componentVersion': compver, 'component': compver.split('/versions')[0],
+                      'matchTypes': ['MANUAL_BOM_COMPONENT'], '_meta': {'href': href + str(pos)}}
+                     for pos, compver in enumerate(bom) if compver]
+            return 'bom', self.send_json(200, page(items, query))
+
+        return 'other', self.send_json(404, {})
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local mock Black Duck server')
+    parser.add_argument('--port', help='Port to listen on (default 8765)', type=int, default=8765)
+    parser.add_argument('--latency', help='Delay added to every request in seconds (default 0)', type=float, default=0.0)
+    parser.add_argument('--jitter', help='Random variation of the latency as a fraction (default 0)', type=float, default=0.0)
+    parser.add_argument('--throttle', help='Requests per second above which requests are answered with 429 Too Many Requests - 0 for no limit (default 0)', type=float, default=0.0)
+    parser.add_argument('--components', help='Number of synthetic KB components (default 1000)', type=int, default=1000)
+    parser.add_argument('--fixtures', help='JSON file of KB components to serve instead of synthetic components')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        with open(args.fixtures) as ffile:
+            components = json.load(ffile)
+    else:
+        components = synthetic_kb(args.components)
+    hub = MockHub(components, args.latency, args.jitter, args.port, args.throttle)
+    print("Mock Black Duck server at {} with {} KB components".format(hub.baseurl, len(hub.components)))
+    try:
+        hub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
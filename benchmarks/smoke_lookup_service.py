@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Smoke test of the lookup service (lookup_service.py) used by serve mode and --server: starts a LookupServer on a
+# TCP port and on a Unix socket with stub handlers, and checks that LookupClient gets the find-comp, find-ver and
+# status responses over several requests on each keep-alive connection.
+#
+# Usage: smoke_lookup_service.py
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lookup_service import LookupClient, LookupServer
+
+def find_comp(request):
+    return {'lines': ["{};{};;NO MATCH;{};NO VERSION MATCH;".format(request['package'], request['package'], version)
+                      for version in request['versions']],
+            'messages': [[version, "no match"] for version in request['versions']]}
+
+def find_ver(request):
+    return {'compname': "comp", 'matchversion': request['version'], 'matchstrength': 1, 'sourceurl': "",
+            'verurl': "{}/versions/1".format(request['kburl'])}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def check(address):
+    #
+    # Start a LookupServer on address and check the client responses
+    server = LookupServer(address, {'/v1/find-comp': find_comp, '/v1/find-ver': find_ver})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = LookupClient(address, timeout=10)
+        for number in range(3):
+            lines, messages = client.find_comp("pkg{}".format(number), ["1.0"], [])
+            assert lines == ["pkg{0};pkg{0};;NO MATCH;1.0;NO VERSION MATCH;".format(number)], lines
+            assert messages == [("1.0", "no match")], messages
+            assert client.find_ver("http://hub/api/components/1", "2.0")[4] == "http://hub/api/components/1/versions/1"
+        requests = client.status()['requests']
+        assert requests == {'/v1/find-comp': 3, '/v1/find-ver': 3}, requests
+    finally:
+        server.server.shutdown()
+        server.close()
+    print("{}: OK".format(address))
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="smoke_lookup_service_")
+    try:
+        check("127.0.0.1:{}".format(free_port()))
+        check("unix:{}".format(os.path.join(workdir, "lookup.sock")))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#
+# HTTP transport for the Black Duck API requests made by import_manifest.py
+#
+# HubTransport sends requests through one shared requests.Session, so connections (and TLS sessions) to the
+# Black Duck server are kept alive and reused by all workers instead of being opened for every request by the
+# HubInstance execute_get()/execute_post() helpers. The connection pool is sized to the number of concurrent
+# requests (--max-requests), responses are requested gzip compressed, and every request has a connect and read
+# timeout so a stalled connection fails (and is retried by the request layer) instead of blocking a worker. A request
+# which fails while the connection is opened raises request_layer.RequestNotSent, as it was not sent to the server.
+#
+# trim_response() reduces the JSON of the KB search, component, version list and BOM responses to the fields
+# import_manifest.py uses, before the response is stored in the KB cache or held in memory for the run.
+
+import json
+import logging
+import threading
+
+import request_layer
+
+DEFAULT_CONNECT_TIMEOUT = 10    # Seconds
+DEFAULT_READ_TIMEOUT = 120      # Seconds
+
+class JSONResponse:
+    #
+    # Stand-in for requests.Response holding already decoded (and trimmed) JSON
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = json.dumps(self.data, separators=(',', ':')).encode('utf-8')
+        return self._content
+
+    def json(self):
+        return self.data
+
+def trim_search(data):
+    items = []
+    for item in data.get('items', []):
+        hits = [{'component': hit.get('component'),
+                 'fields': dict((field, hit['fields'][field]) for field in ('name', 'release_count') if field in hit.get('fields', {}))}
+                for hit in item.get('hits', [])]
+        stats = item.get('searchResultStatistics', {})
+        items.append({'searchResultStatistics': {'numResultsInThisPage': stats.get('numResultsInThisPage', len(hits))}, 'hits': hits})
+    return {'totalCount': data.get('totalCount', len(items)), 'items': items}
+
+def trim_component(data):
+    meta = data.get('_meta', {})
+    return {'name': data.get('name'), 'url': data.get('url'),
+            '_meta': {'href': meta.get('href'), 'links': meta.get('links', [])[:1]}}
+
+def trim_versions(data):
+    return {'totalCount': data.get('totalCount', 0),
+            'items': [{'versionName': item.get('versionName', ""), '_meta': {'href': item['_meta']['href']}}
+                      for item in data.get('items', [])]}
+
+def trim_bom(data):
+    items = []
+    for item in data.get('items', []):
+        trimmed = dict((field, item[field]) for field in ('component', 'componentVersion', 'componentName', 'componentVersionName', 'matchTypes')
+                       if field in item)
+        trimmed['_meta'] = {'href': item['_meta']['href']}
+        items.append(trimmed)
+    return {'totalCount': data.get('totalCount', 0), 'items': items}
+
+TRIMMERS = {
+    'search': trim_search,
+    'component': trim_component,
+    'versions': trim_versions,
+    'bom': trim_bom,
+}
+
+def trim_response(endpoint, response):
+    #
+    # Return a JSONResponse holding the JSON of a successful response for endpoint reduced to the fields used, or
+    # response unchanged (other endpoints, errors, and responses which do not have the expected fields)
+    trimmer = TRIMMERS.get(endpoint)
+    if trimmer is None or response.status_code != 200:
+        return response
+    try:
+        return JSONResponse(trimmer(response.json()), response.status_code, response.headers)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        logging.debug("trim_response(): %s response not trimmed - %s", endpoint, e)
+        return response
+
+def connect_failed(error):
+    #
+    # True if the requests ConnectionError error was raised while the connection was opened (before the request was
+    # sent), rather than after the request was sent on an open connection
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+
+class HubTransport:
+    def __init__(self, pool_size=10, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, compress=True):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.compress = compress
+        self.verify = True
+        self.session = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        #
+        # Return the shared session, creating it on first use (so the module can be imported without loading requests)
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    # Connections are only opened to the Black Duck server, so one pool holding a connection per concurrent request
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers['Accept-Encoding'] = 'gzip' if self.compress else 'identity'
+                    self.session = session
+        return self.session
+
+    def send(self, method, url, headers, data=None):
+        import requests
+        try:
+            return self.get_session().request(method, url, headers=headers, data=data, timeout=self.timeout, verify=self.verify)
+        except requests.exceptions.ConnectionError as e:
+            if connect_failed(e):
+                raise request_layer.RequestNotSent(str(e)) from e
+            raise
+
+    def get(self, url, headers):
+        return self.send('GET', url, headers)
+
+    def post(self, url, data, headers):
+        return self.send('POST', url, headers, json.dumps(data))
+
+    def delete(self, url, headers):
+        return self.send('DELETE', url, headers)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
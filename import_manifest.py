@@ -5,131 +5,356 @@
 #    name and version
 # 2. Mode import: Accept input file, seed file, project name and version - Read list of components & version from the input file in addition to a seed file of BD URLs
 #    (produced by mode 1), find matching KB component & version and (if not already in project) add as manual component to specified project & version
+#
+# Mode sync does both in one pass - KB versions are added to the project as soon as they are matched, and the KB Lookup file is
+# written as in mode 1.
+#
+# Mode batch runs mode 2 for each (component list file, project, version) job in a job file, sharing one Black Duck
+# session, kbfile and set of caches between the jobs.
+#
+# Mode serve runs a local lookup service which keeps the Black Duck session and KB caches in memory between runs - kblookup and import
+# modes send their KB lookups to it when --server is specified (see lookup_service.py).
+#
+# The offline modes validate, merge, stat and compile (KB Lookup files), export-snapshot and import-snapshot (KB snapshots, see
+# kb_snapshot.py), parse (component list files) and plan (preview an import using the
+# project BOM saved by the last import run) never connect to the Black Duck server.
+#
+# The module can be imported without side effects - the Black Duck server connection is only opened (and authenticated) when first
+# used by get_hub(), and logging and the run options are set up by main().
 
 import argparse
-#import json
+import hashlib
+import json
 import logging
-import re
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from difflib import SequenceMatcher
+from urllib.parse import quote
+
+import instrumentation
+import hub_transport
+import kb_cache
+import kb_index
+import kb_snapshot
+import kb_store
+import lookup_service
+import manifest_reader
+import request_layer
+import search_plan
+import version_index
+
+LOG_FILE = 'MRB_import_yocto_manifest.log'
+
+hub = None          # Black Duck HubInstance - created on first use by get_hub()
+args = None         # Command line options (set by main())
+kbcache = None      # Persistent KB response cache (None if --no-cache)
+kbsnapshot = None   # KB match snapshot used before the KB cache and the server (--snapshot)
+compmemo = kb_cache.LRUCache("KB component memo")   # Parsed KB components and version indexes by component URL
+# KB version URLs matched to (package, version) from the kbfile component URLs (import, plan and batch modes)
+resolvememo = kb_cache.LRUCache("KB version resolution memo", 100000)
+metrics = instrumentation.Metrics()     # Run metrics written to --metrics-out
+# Request layer used for every Black Duck API request (rate limit, retries, circuit breaker and concurrency limits - set by main())
+api = request_layer.RequestLayer(reauth=lambda: check_hub_token(force=True),
+                                 record=lambda endpoint, status: metrics.count('api_requests', endpoint=endpoint, status=status))
+transport = hub_transport.HubTransport()    # Shared keep-alive HTTP session for the API requests (pool size and timeouts set by main())
+hub_auth_lock = threading.Lock()
+hub_auth_time = 0               # Time of last authentication to the Hub
+token_refresh = 15 * 60         # Seconds between re-authentication (API sessions expire after 20 minutes)
+add_retries = 3                 # Retries for failed BOM component additions (--retries)
+BOM_PAGE_SIZE = 1000            # Components requested per page of the project BOM
+VERSION_PAGE_SIZE = 100         # KB component versions requested per page
+component_fetch_budget = 10     # Maximum KB components checked per component list package (--max-component-fetches, None for no limit)
+confirmed_mappings = {}         # Package name -> set of KB component URLs confirmed by earlier runs (used to rank search hits)
+confirmed_components = {}       # KB component URL -> number of packages confirmed as that component
+kbsearchplan = None             # search_plan.SearchPlan of the KB searches for the component list (kblookup mode)
+kblookupdict = {}               # Dict of package names from kbfile with matching array of component URLs for each
+kbverdict = {}                  # Dict of package/version strings with single component version URL for each
+resumed_results = {}            # Checkpoint results for packages not yet returned (kblookup mode)
+bdversion_url = None            # Project version URL (sync mode)
+project_locks = {}              # Project name -> lock held while the project is opened or created (see project_lock())
+offline = False                 # True if KB requests must be answered from the KB snapshot and cache (plan mode, kblookup --offline)
+lookup_client = None            # lookup_service.LookupClient used for KB lookups (--server)
+PROJECT_HEADERS = {'Accept': 'application/vnd.blackducksoftware.project-detail-4+json'}
+
+def get_hub():
+    #
+    # Return the Black Duck HubInstance, creating it (and authenticating to the Hub) on first use
+    global hub, hub_auth_time
+    if hub is None:
+        with hub_auth_lock:
+            if hub is None:
+                from blackduck.HubRestApi import HubInstance
+                newhub = HubInstance()
+                transport.verify = not newhub.config.get('insecure', False)
+                hub_auth_time = time.time()
+                metrics.count('api_requests', endpoint='auth', status='ok')
+                hub = newhub
+    return hub
+
+def check_hub_token(force=False):
+    #
+    # Re-authenticate to the Hub before the bearer token expires (or immediately if force)
+    global hub_auth_time
+    get_hub()
+    if not force and time.time() - hub_auth_time < token_refresh:
+        return
+    with hub_auth_lock:
+        if not force and time.time() - hub_auth_time < token_refresh:
+            return
+        hub.token, hub.csrf_token, hub.cookie = hub.get_auth_token()
+        hub_auth_time = time.time()
+        metrics.count('api_requests', endpoint='auth', status='ok')
+        logging.info("Refreshed Black Duck API authentication token")
+
+def hub_headers(custom_headers={}):
+    #
+    # Authentication headers for a request (read for every attempt, so retries use a refreshed token)
+    headers = hub.get_headers()
+    headers.update(custom_headers)
+    return headers
 
-from blackduck.HubRestApi import HubInstance
+def hub_get(url, endpoint, custom_headers={}):
+    #
+    # GET a Black Duck API URL through the request layer
+    check_hub_token()
+    return api.request(endpoint, lambda: transport.get(url, hub_headers(custom_headers)))
 
-logging.basicConfig(filename='MRB_import_yocto_manifest.log',level=logging.DEBUG)
+def hub_post(url, data, endpoint, custom_headers={}, retries=None):
+    #
+    # POST to a Black Duck API URL through the request layer (not idempotent - see request_layer.py)
+    check_hub_token()
+    post_headers = dict({'Content-Type': 'application/json'}, **custom_headers)
+    return api.request(endpoint, lambda: transport.post(url, data, hub_headers(post_headers)), retries, idempotent=False)
+
+def kb_get(url):
+    #
+    # GET a KB search, component or version list URL, using the KB snapshot and the persistent cache if enabled
+    if kbsnapshot:
+        response = kbsnapshot.get(url)
+        if response:
+            return response
+    if kbcache:
+        try:
+            response = kbcache.get(url)
+        except sqlite3.Error as e:
+            # e.g. the cache database is locked by another process for longer than the timeout - treated as a miss
+            logging.warning("kb_get(): KB cache read failed - %s", e)
+            response = None
+        if response:
+            return response
+    if offline:
+        metrics.count('kb_offline_misses')
+        logging.debug("kb_get(): %s not in the KB snapshot or cache (offline)", url)
+        return kb_cache.CachedResponse(b"{}", 504)
+    endpoint = kb_cache.url_endpoint(url) or 'kb'
+    response = hub_transport.trim_response(endpoint, hub_get(url, endpoint))
+    if kbcache and response.status_code == 200:
+        try:
+            kbcache.put(url, response.content)
+        except sqlite3.Error as e:
+            logging.warning("kb_get(): KB cache write failed - %s", e)
+    return response
 
-hub = HubInstance()
+def kb_baseurl():
+    #
+    # Return the Black Duck server URL for KB searches - from the KB snapshot when offline
+    if offline and kbsnapshot:
+        return kbsnapshot.baseurl
+    return get_hub().get_urlbase()
 
 def get_kb_component(packagename):
     #print("DEBUG: processing package {}".format(packagename))
     packagename = packagename.replace(" ", "+")
     #packagename = packagename.replace("-", "+")
-    req_url = hub.get_urlbase() + "/api/search/components?q=name:{}&limit={}".format(packagename, 20)
-    try:
-        response = hub.execute_get(req_url)
-    except:
-        logging.error("get_kb_component(): Exception trying to find KB matches")
-        
+    req_url = kb_baseurl() + "/api/search/components?q=name:{}&limit={}".format(packagename, 20)
+    with metrics.timed('get_kb_component'):
+        response = kb_get(req_url)
     if response.status_code != 200:
         logging.error("Failed to retrieve KB matches, status code: {}".format(response.status_code))
     return response
 
-def find_ver_from_compver(kburl, version):
-    matchversion = ""
-    
-    component = hub.execute_get(kburl)            
+def load_kb_component(kburl):
+    #
+    # Request the KB component
+    # Returns dict of component JSON, versions URL and version list state (the versions are read when needed
+    # by find_ver_from_compver()) or None on failure
+    component = kb_get(kburl)
     if component.status_code != 200:
         logging.error("Failed to retrieve component, status code: {}".format(component.status_code))
+        return None
+    compjson = component.json()
+    links = compjson.get('_meta')['links']
+    return {
+        'json': compjson,
+        'versions_url': links[0]['href'],
+        'items': [],        # KB versions read so far (in KB order)
+        'total': None,      # Number of KB versions (None until the first page is read)
+        'index': None,      # VersionIndex once all versions have been read
+        'lock': threading.Lock(),
+    }
+
+def get_kb_component_versions(kburl):
+    #
+    # Return the KB component data from load_kb_component() for a KB component URL, downloaded once per run
+    # (held in compmemo) - returns None on failure
+    return compmemo.get_or_load(kburl, lambda: load_kb_component(kburl))
+
+def exact_kb_version(items, localversion):
+    #
+    # Return (versionName, URL) of the first KB version in items equal to localversion (normalized) or None
+    for item in items:
+        if item['versionName'] != "" and version_index.normalize_version(item['versionName']) == localversion:
+            return item['versionName'], item['_meta']['href']
+    return None
+
+def query_kb_version(compdata, version):
+    #
+    # Ask the KB for the versions of the component matching the version string (versionName query) and
+    # return (versionName, URL) of an exact match or None
+    localversion = version_index.normalize_version(version)
+    for query in dict.fromkeys([version, localversion]):
+        url = compdata['versions_url'] + "?q=versionName:{}&limit={}".format(quote(query, safe=''), VERSION_PAGE_SIZE)
+        response = kb_get(url)
+        if response.status_code != 200:
+            logging.error("Failed to query component versions, status code: {}".format(response.status_code))
+            return None
+        match = exact_kb_version(response.json().get('items', []), localversion)
+        if match:
+            return match
+    return None
+
+def read_kb_versions(compdata, version):
+    #
+    # Read the KB version list of the component a page at a time (continuing from the pages already read),
+    # stopping early if an exact match for version is found
+    # Returns (versionName, URL) of the exact match, or None once the whole list has been read and compdata['index'] set
+    localversion = version_index.normalize_version(version)
+    with compdata['lock']:
+        if compdata['index'] is not None:
+            return None
+        match = exact_kb_version(compdata['items'], localversion)
+        if match:
+            return match
+        while compdata['total'] is None or len(compdata['items']) < compdata['total']:
+            url = compdata['versions_url'] + "?limit={}&offset={}".format(VERSION_PAGE_SIZE, len(compdata['items']))
+            response = kb_get(url)
+            if response.status_code != 200:
+                logging.error("Failed to retrieve component versions, status code: {}".format(response.status_code))
+                return None
+            page = response.json()
+            items = page.get('items', [])
+            compdata['items'].extend(items)
+            compdata['total'] = page.get('totalCount', 0)
+            if not items:
+                break
+            match = exact_kb_version(items, localversion)
+            if match:
+                return match
+        compdata['index'] = version_index.VersionIndex(compdata['items'])
+        return None
+
+def find_ver_from_compver(kburl, version):
+    if lookup_client:
+        metrics.count('lookup_server_requests', endpoint='find-ver')
+        return lookup_client.find_ver(kburl, version)
+    with metrics.timed('find_ver_from_compver'):
+        return match_kb_version(kburl, version)
+
+def match_kb_version(kburl, version):
+    #
+    # Find the best match for version in the KB versions of the component - exact matches are looked up with a
+    # versionName query, then by reading the version list a page at a time, and partial matches (strength 1 or 2)
+    # from the index of the complete version list
+    compdata = get_kb_component_versions(kburl)
+    if compdata is None:
         return "", "", 0, "", ""
-    bdcomp_sourceurl = component.json().get('url')
+    compjson = compdata['json']
+    bdcomp_sourceurl = compjson.get('url')
     if bdcomp_sourceurl:
         bdcomp_sourceurl = bdcomp_sourceurl.replace(';','')
-    #
-    # Request the list of versions for this component
-    compname = component.json().get('name')
-    respitems = component.json().get('_meta')
-    links = respitems['links']
-    vers_url = links[0]['href'] + "?limit=1000"
-    kbversions = hub.execute_get(vers_url)           
-    if kbversions.status_code != 200:
-        logging.error("Failed to retrieve component, status code: {}".format(kbversions.status_code))
-        return "", "", 0, "", ""
+    compname = compjson.get('name')
 
-    localversion = version.replace('-','.')
-    for kbversion in kbversions.json().get('items'):
-
-        kbversionname = kbversion['versionName'].replace('-', '.')
-        kbver_url = kbversion['_meta']['href']
-        logging.debug("DEBUG: component = {} searchversion = {} kbver = {} kbverurl = {}".format(compname, version, kbversionname, kbver_url))
-        if (kbversionname == localversion):
-            # exact version string match
-            matchversion = kbversion['versionName']
-            matchstrength = 3
-            break                
-
-        # Need to look for partial matches
-        seq = SequenceMatcher(None, kbversionname, localversion)
-        match = seq.find_longest_match(0, len(kbversionname), 0, len(localversion))
-        if (match.a == 0) and (match.b == 0) and (match.size == len(kbversionname)):
-            # Found match of full kbversion at start of search_version
-            if len(kbversionname) > len(matchversion):
-                # Update if the kbversion is longer than the previous match
-                matchversion = kbversion['versionName']
-                matchstrength = 2
-                logging.debug("Found component block 1 - version="+ matchversion)
-
-        elif (match.b == 0) and (match.size == len(localversion)):
-            # Found match of full search_version within kbversion
-            # Need to check if kbversion has digits before the match (would mean a mismatch)
-            mob = re.search('\d', kbversionname[0:match.a])
-            if not mob and (len(kbversionname) > len(matchversion)):
-                # new version string matches kbversion but with characters before and is longer than the previous match
-                matchversion = kbversion['versionName']
-                logging.debug("Found component block 2 - version="+ matchversion)
-                if (match.a == 1) and (kbversionname.lower() == 'v' ):  # Special case of kbversion starting with 'v'
-                    matchstrength = 3
-                else:
-                    matchstrength = 2
-
-        elif (match.a == 0) and (match.b == 0) and (match.size > 2):
-            # both strings match at start for more than 2 characters min
-            # Need to try close numeric version match
-            # - Get the final segment of searchversion & kbversion
-            # - Match if 2 versions off?          
-            if 0 <= match.size - localversion.rfind(".") <= 2:
-                # common matched string length is after final .
-                kbfinalsegment = kbversionname.split(".")[-1]
-                localfinalsegment = localversion.split(".")[-1]
-                if (kbfinalsegment.isdigit() and localfinalsegment.isdigit()):
-                    # both final segments are numeric
-                    logging.debug("kbfinalsegment = " + kbfinalsegment + " localfinalsegment = " + localfinalsegment + " matchversion = " + matchversion)
-                    if abs(int(kbfinalsegment) - int(localfinalsegment)) <= 2:
-                        # values of final segments are within 2 of each other
-                        if len(kbversionname) >= len(matchversion):
-                            # kbversion is longer or equal to matched version string 
-                            matchversion = kbversion['versionName']
-                            matchstrength = 1
-                            logging.debug("Found component block 3 - version="+ matchversion)
-                                  
+    match = None
+    if compdata['index'] is None:
+        match = query_kb_version(compdata, version)
+        metrics.count('version_lookups', method='query', found=match is not None)
+        if match is None:
+            match = read_kb_versions(compdata, version)
+            metrics.count('version_lookups', method='pages', found=match is not None)
+    if match:
+        matchversion, kbver_url = match
+        matchstrength = 3
+    elif compdata['index'] is not None:
+        matchversion, kbver_url, matchstrength = compdata['index'].match(version)
+    else:
+        matchversion, kbver_url, matchstrength = "", "", 0
+    metrics.count('version_comparisons', strength=matchstrength)
+    logging.debug("find_ver_from_compver(): component = %s searchversion = %s kbversions = %d matchversion = %s matchstrength = %d", compname, version, len(compdata['items']), matchversion, matchstrength)
     if matchversion != "":
         return compname, matchversion, matchstrength, bdcomp_sourceurl, kbver_url
     
     return "", "", 0, "", ""
 
-def find_ver_from_hits(hits, search_version):
-    matchversion = ""
-    matchstrength=0
+def normalize_name(name):
+    return "".join(char for char in name.lower() if char.isalnum())
+
+def rank_hits(hits, package, searchname):
+    #
+    # Order KB search hits for package by how likely they are to be the right component, before any components are
+    # fetched: components confirmed for the package by earlier runs first, then exact name matches, name similarity,
+    # components confirmed for other packages and number of KB versions (search order is kept for equal ranks)
+    name = normalize_name(searchname)
+    def rank(hit):
+        fields = hit.get('fields', {})
+        hitname = normalize_name((fields.get('name') or [""])[0])
+        try:
+            releases = int((fields.get('release_count') or ["0"])[0])
+        except ValueError:
+            releases = 0
+        similarity = round(SequenceMatcher(None, name, hitname).ratio(), 1) if name and hitname else 0.0
+        return (hit['component'] not in confirmed_mappings.get(package, ()), hitname != name, -similarity,
+                -confirmed_components.get(hit['component'], 0), -releases)
+    return sorted(hits, key=rank)
+
+def find_ver_from_hits(hits, search_versions, budget=None):
+    #
+    # Match all search_versions against the KB components in the search hits
+    # Returns dict of version -> (compname, matchversion, matchstrength, bdcomp_sourceurl, comp_url, bdcompver_url)
+    # for the best match of each version (first hit wins for equal match strength)
+    # budget is an optional dict of the KB components already checked for the package ('seen') and the number of
+    # further components which can be checked ('remaining', None for no limit)
+    matches = {}
     for hit in hits:
         #
         # Get component from URL
         comp_url = hit['component']
-        compname, matchversion, matchstrength, bdcomp_sourceurl, bdcompver_url = find_ver_from_compver(comp_url, search_version)
-        if matchstrength == 3:
+        if budget is not None:
+            if comp_url in budget['seen']:
+                # Already checked for these versions from the search for another name variant
+                continue
+            if budget['remaining'] is not None:
+                if budget['remaining'] <= 0:
+                    metrics.count('component_fetches_skipped', len(hits) - hits.index(hit))
+                    break
+                budget['remaining'] -= 1
+            budget['seen'].add(comp_url)
+        for version in search_versions:
+            if version in matches and matches[version][2] == 3:
+                continue
+            compname, matchversion, matchstrength, bdcomp_sourceurl, bdcompver_url = find_ver_from_compver(comp_url, version)
+            if matchstrength > 0 and (version not in matches or matchstrength > matches[version][2]):
+                matches[version] = (compname, matchversion, matchstrength, bdcomp_sourceurl, comp_url, bdcompver_url)
+        if len(matches) == len(search_versions) and all(match[2] == 3 for match in matches.values()):
             break
 
-    if matchversion == "":
-        return "", "", 0, "", "", ""
-    else:
-        return compname, matchversion, matchstrength, bdcomp_sourceurl, comp_url, bdcompver_url
-
+    return matches
 
 def search_kbpackage(package):    
     response = get_kb_component(package)
@@ -138,158 +363,90 @@ def search_kbpackage(package):
         return ""
     
     respitems = response.json().get('items', [])
-    logging.debug("{} items returned".format(respitems[0]['searchResultStatistics']['numResultsInThisPage']))
+    logging.debug("%s items returned", respitems[0]['searchResultStatistics']['numResultsInThisPage'])
     if respitems[0]['searchResultStatistics']['numResultsInThisPage'] > 0:
         return respitems[0]['hits']
     else:
         return ""
 
-def find_comp_from_kb(compstring, version, outkbfile, inkbfile, replace_strings):
-    #
-    # Try to find component in KB
+def update_best_matches(best_matches, hits, versions, budget=None):
     #
-    end = False
-    found_comp = ""
-    found_version = ""
-    comp_url = ""
-    compver_url = ""
-    source_url = ""
-    max_matchstrength = 0
+    # Update best_matches (dict version -> match tuple from find_ver_from_hits()) with matches from hits
+    # Returns True if all versions now have exact (strength 3) matches or the component fetch budget is used up
+    for version, match in find_ver_from_hits(hits, [v for v in versions if v not in best_matches or best_matches[v][2] < 3], budget).items():
+        if version not in best_matches or match[2] > best_matches[version][2]:
+            best_matches[version] = match
+    if budget is not None and budget['remaining'] == 0:
+        return True
+    return all(version in best_matches and best_matches[version][2] == 3 for version in versions)
 
-    #packagename = package.lower()
+def search_compname(compstring, replace_strings):
+    #
+    # Return the package name used for KB searches (with the -r strings removed)
+    compname = compstring
     if replace_strings:
         for repstr in replace_strings:
-            compname = compstring.replace(repstr, '')
-    else:
-        compname = compstring
-        
-    origcomp = compname
-    while end == False:
-        logging.debug("find_comp_from_kb(): Searching for '{}'".format(compname))
-        hits = search_kbpackage(compname)
-        if hits:
-            logging.debug("find_comp_from_kb(): Found matches for package {}".format(compname))
-            temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = find_ver_from_hits(hits, version)
-            if matchstrength == 3:
-                end = True
-            if matchstrength > max_matchstrength:
-                max_matchstrength = matchstrength
-                found_comp = temp_comp
-                found_version = temp_version
-                comp_url = temp_compurl
-                compver_url = temp_compverurl
-                source_url = temp_srcurl             
-                
-        if (end == False) and (len(compname) == len(origcomp)) and (compname.find("-") > -1):
-            compnamecolons = compname.replace("-", "::")
-            compnamecolons = compnamecolons.replace("_", "::")
-            hits = search_kbpackage(compnamecolons)
-            if hits:
-                logging.debug("find_comp_from_kb(): Found matches for package {}".format(compnamecolons))
-                temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = find_ver_from_hits(hits, version)
-                if matchstrength == 3:
-                    end = True    
-                if matchstrength > max_matchstrength:
-                    max_matchstrength = matchstrength
-                    found_comp = temp_comp
-                    found_version = temp_version
-                    comp_url = temp_compurl
-                    compver_url = temp_compverurl
-                    source_url = temp_srcurl                
-
-        if (end == False) and ((compname.find("-") > -1) or (compname.find("_") > -1)):
-            #
-            # Process component replacing - with spaces
-            compnamespaces = compname.replace("-", " ")
-            compnamespaces = compnamespaces.replace("_", " ")
-            hits = search_kbpackage(compnamespaces)
-            if hits:
-                logging.debug("find_comp_from_kb(): Found matches for package {}".format(compnamespaces))
-                temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = find_ver_from_hits(hits, version)
-                if matchstrength == 3:
-                    end = True
-                if matchstrength > max_matchstrength:
-                    max_matchstrength = matchstrength
-                    found_comp = temp_comp
-                    found_version = temp_version
-                    comp_url = temp_compurl
-                    compver_url = temp_compverurl
-                    source_url = temp_srcurl             
-
-        if end == False:
-            #
-            # Remove trailing -xxx from package name
-            newcompname = compname.rsplit("-", 1)[0]
-            if len(newcompname) == len(compname):
-                #
-                # No - found, try removing trailing .xxxx
-                newcompname = compname.rsplit(".", 1)[0]
-                if (len(newcompname) == len(compname)):
-                    end = True
-            compname = newcompname
-
-    if max_matchstrength > 0:
-        print(" - MATCHED '{}/{}' (sourceURL={})".format(found_comp, found_version, source_url))
-        return "{};{};{};{};{};{};\n".format(compstring,found_comp,source_url,comp_url,version,compver_url)
-
-    else:
-        print(" - NO MATCH")
-        return "{};;;NO MATCH;{};NO VERSION MATCH;\n".format(compstring, version)
+            compname = compname.replace(repstr, '')
+    return compname
 
-def add_kbfile_entry(outkbfile, line):
-    try:
-        ofile = open(outkbfile, "a+")
-    except:
-        logging.error("append_kbfile(): Failed to open file {} for read".format(outkbfile))
-        return
-
-    ofile.write(line)
-    ofile.close()
-    
-def update_kbfile_entry(outkbfile, package, version, compurl, kbverurl):
+def find_comp_from_kb(compstring, versions, outkbfile, inkbfile, replace_strings):
     #
-    # Append version strings to kbfile entry
+    # Try to find component in KB for all versions of one package
+    # Returns list of kbfile lines for the package and list of (version, message)
     #
-    # FIELDS:
-    # 1 = Local component name;
-    # 2 = KB component name;
-    # 3 = KB component source URL;
-    # 4 = KB component URL;
-    # 
-    # OPTIONAL:
-    # 5 = Local component version string
-    # 6 = KB Component version URL
-    # (Repeated as often as matched)
+    # The name variants to search are listed by search_plan.search_names() - searches shared with other packages
+    # in the component list are only sent once (see search_plan.py)
+    if lookup_client:
+        metrics.count('lookup_server_requests', endpoint='find-comp')
+        return lookup_client.find_comp(compstring, versions, replace_strings)
+    best_matches = {}
+    budget = {'remaining': component_fetch_budget, 'seen': set()}
+
+    compname = search_compname(compstring, replace_strings)
+    names = kbsearchplan.search_names(compname) if kbsearchplan else search_plan.search_names(compname)
     try:
-        ofile = open(outkbfile, "r")
-    except:
-        logging.error("update_kbfile(): Failed to open file {} for read".format(outkbfile))
-        return
+        for searchname in names:
+            logging.debug("find_comp_from_kb(): Searching for '%s'", searchname)
+            if kbsearchplan:
+                hits = kbsearchplan.search(searchname, lambda: search_kbpackage(searchname))
+            else:
+                hits = search_kbpackage(searchname)
+            if hits:
+                logging.debug("find_comp_from_kb(): Found matches for package %s", searchname)
+                if update_best_matches(best_matches, rank_hits(hits, compstring, searchname), versions, budget):
+                    break
+    finally:
+        if kbsearchplan:
+            kbsearchplan.release(compname)
 
-    lines = ofile.readlines()
-    ofile.close()
+    return kbfile_lines_from_matches(compstring, versions, best_matches)
 
-    try:
-        ofile = open(outkbfile, "w")
-    except:
-        logging.error("update_kbfile(): Failed to open file {} for write".format(outkbfile))
-        return
-    
-    for line in lines:
-        elements = line.split(";")
-        compname = elements[0]
-        thiscompurl = elements[3]
-        if compname != package:
-            ofile.write(line)
+def kbfile_lines_from_matches(compstring, versions, best_matches):
+    #
+    # Create kbfile lines for a package from the best match of each version - one line per matched
+    # KB component with its versions, versions without a match are added to the first line as NO VERSION MATCH
+    messages = []
+    complines = {}      # KB component URL -> [compname, sourceurl, [version;verurl strings]]
+    nomatch = []
+    for version in versions:
+        if version in best_matches:
+            found_comp, found_version, matchstrength, source_url, comp_url, compver_url = best_matches[version]
+            complines.setdefault(comp_url, [found_comp, source_url, []])[2].append("{};{};".format(version, compver_url))
+            metrics.count('version_matches', strength=matchstrength)
+            messages.append((version, " - MATCHED '{}/{}' (sourceURL={})".format(found_comp, found_version, source_url)))
         else:
-            if compurl != thiscompurl:
-                ofile.write(line)
-            else:
-                ofile.write("{}{};{};\n".format(line.rstrip(), version, kbverurl))
-                logging.debug("update_kbfile(): updated kbfile line with '{};{};'".format(version, kbverurl))
-            
-    ofile.close()
-    return
+            nomatch.append("{};NO VERSION MATCH;".format(version))
+            metrics.count('version_matches', strength=0)
+            messages.append((version, " - NO MATCH"))
+
+    lines = []
+    for comp_url, (found_comp, source_url, vers) in complines.items():
+        lines.append("{};{};{};{};{}".format(compstring, found_comp, source_url, comp_url, "".join(vers)))
+    if lines:
+        lines[0] += "".join(nomatch)
+    else:
+        lines.append("{};;;NO MATCH;{}".format(compstring, "".join(nomatch)))
+    return [line + "\n" for line in lines], messages
 
 def import_kbfile(kbfile, outfile):
     #
@@ -352,14 +509,45 @@ def import_kbfile(kbfile, outfile):
     print("Processed {} entries from {}".format(count, kbfile))
     return kblookupdict, kbverdict
 
+def load_kbfile(kbfile):
+    #
+    # Return the kblookupdict and kbverdict for kbfile - read from the compiled index of the kbfile (see the compile
+    # command) if it is up to date, otherwise from the kbfile
+    index = kb_index.open_index(kbfile)
+    if index is None:
+        return import_kbfile(kbfile, "")
+    print("Using KB match list index {} ({} entries)".format(index.path, index.ncomponents))
+    return index.packages, index.versions
+
 def find_compver_from_compurl(package, kburl, search_version):
     compname, matchversion, matchstrength, bdcomp_sourceurl, bd_verurl = find_ver_from_compver(kburl, search_version)
     if matchstrength > 0:
         return bd_verurl, bdcomp_sourceurl
     else:
         return "NO VERSION MATCH", ""
+
+def find_compvers_from_compurls(package, kburls, search_versions):
+    #
+    # Match all search_versions against the KB component URLs for package (in kbfile order)
+    # Returns dict of version -> (kburl, KB version URL, source URL) for matched versions
+    matches = {}
+    for kburl in kburls:
+        if kburl == "NO MATCH":
+            continue
+        for version in search_versions:
+            if version not in matches:
+                kbverurl, srcurl = find_compver_from_compurl(package, kburl, version)
+                if kbverurl != "NO VERSION MATCH":
+                    matches[version] = (kburl, kbverurl, srcurl)
+        if len(matches) == len(search_versions):
+            break
+    return matches
     
 def add_comp_to_bom(bdverurl, kbverurl, compfile, compver):
+    with metrics.timed('add_comp_to_bom'):
+        return post_comp_to_bom(bdverurl, kbverurl, compfile, compver)
+
+def post_comp_to_bom(bdverurl, kbverurl, compfile, compver):
     
     posturl = bdverurl + "/components"
     custom_headers = {
@@ -373,14 +561,16 @@ def add_comp_to_bom(bdverurl, kbverurl, compfile, compver):
             "componentModification" : "Original component = " + compver
     }
     
+    #
+    # Returns True if the component was added - the request layer retries (up to --retries times) if the server
+    # is busy or the request fails
     #print("POST command - posturl = {} postdata = {}".format(posturl, postdata, custom_headers))
-    response = hub.execute_post(posturl, postdata, custom_headers)
-    if response.status_code == 200:
-        print(" - Component added")
-        logging.debug("Component added {}".format(kbverurl))
-    else:
-        print(" - Component NOT added")
-        logging.error("Component NOT added {}".format(kbverurl))
+    response = hub_post(posturl, postdata, 'bom-add', custom_headers, add_retries)
+    if response.status_code in (200, 201):
+        logging.debug("Component added %s", kbverurl)
+        return True
+    logging.error("Component NOT added {}, status code: {}".format(kbverurl, response.status_code))
+    return False
 
 def del_comp_from_bom(projverurl, compurl):
 #CURLURL="${HUBURL}/api/v1/releases/${PROJVERID}/component-bom-entries"
@@ -397,256 +587,1391 @@ def del_comp_from_bom(projverurl, compurl):
     #kbverid = compurl.split("/")[7]
     #postdata =  { "entityKey":{"entityId":kbverid,"entityType":"RL"}}
     
-    response = hub.execute_delete(compurl)
-    if response.status_code == 200:
-        logging.debug("Component deleted {}".format(compurl))
+    check_hub_token()
+    response = api.request('bom-delete', lambda: transport.delete(compurl, hub_headers()))
+    if response.status_code in (200, 204):
+        logging.debug("Component deleted %s", compurl)
         return True
     else:
         logging.error("Component NOT deleted {}".format(compurl))
         return False
 
-def manage_project_version(proj, ver):
-    bdproject = hub.get_project_by_name(proj)
+def find_by_name(url, field, name, endpoint):
+    #
+    # Return the project (or version) named name from the search url, or None - raises ValueError if the
+    # request fails (so a server error is not taken to mean the project does not exist)
+    response = hub_get(url, endpoint, PROJECT_HEADERS)
+    if response.status_code != 200:
+        raise ValueError("Failed to search {}, status code: {}".format(endpoint, response.status_code))
+    # A query by name can return more than one item if other names include the search term
+    for item in response.json().get('items', []):
+        if item.get(field) == name:
+            return item
+    return None
+
+def get_project_by_name(proj):
+    url = get_hub().get_urlbase() + "/api/projects?q={}&limit=100".format(quote("name:" + proj, safe=''))
+    return find_by_name(url, 'name', proj, 'projects')
+
+def get_version_by_name(bdproject, ver):
+    url = bdproject['_meta']['href'] + "/versions?q={}&limit=100".format(quote("versionName:" + ver, safe=''))
+    return find_by_name(url, 'versionName', ver, 'project-versions')
+
+def manage_project_version(proj, ver, create=True, out=print):
+    #
+    # Open (or create if create is True) the project & version - messages are passed to out()
+    # Returns None, None if the project or version cannot be created, or (for create=False) does not exist
+    try:
+        with project_lock(proj):
+            return open_project_version(proj, ver, create, out)
+    except ValueError as e:
+        logging.error(str(e))
+        out("Cannot open project '{}' version '{}' - {}".format(proj, ver, e))
+        return None, None
+
+def project_lock(proj):
+    #
+    # Lock held while a project is opened or created, so concurrent batch jobs for versions of the same project
+    # do not both create the project
+    return project_locks.setdefault(proj, threading.Lock())
+
+def open_project_version(proj, ver, create, out):
+    bdproject = get_project_by_name(proj)
     if not bdproject:
-        resp = hub.create_project(proj, ver)
-        if resp.status_code != 200:
-            logging.debug("Cannot create project {}".format(proj))
+        if not create:
+            out("Project '{}' does not exist".format(proj))
             return None, None
-        
-        print("Created project '{}'".format(proj))
-        bdproject = hub.get_project_by_name(proj)
+        postdata = {
+                "name" : proj,
+                "versionRequest" : { "versionName" : ver, "phase" : "PLANNING", "distribution" : "EXTERNAL" }
+        }
+        resp = hub_post(get_hub().get_urlbase() + "/api/projects", postdata, 'projects')
+        if resp.status_code not in (200, 201):
+            # The request is not re-sent, as the server may have created the project (e.g. if the response timed out)
+            bdproject = get_project_by_name(proj)
+            if not bdproject:
+                logging.debug("Cannot create project {}".format(proj))
+                return None, None
+        out("Created project '{}'".format(proj))
+        bdproject = bdproject or get_project_by_name(proj)
     else:
-        print("Opening project '{}'".format(proj))        
+        out("Opening project '{}'".format(proj))        
         
-    bdversion = hub.get_version_by_name(bdproject, ver)
+    bdversion = get_version_by_name(bdproject, ver)
     if not bdversion:
-        resp = hub.create_project_version(bdproject, ver)
+        if not create:
+            out("Version '{}' does not exist".format(ver))
+            return bdproject, None
+        postdata = { "versionName" : ver, "phase" : "PLANNING", "distribution" : "EXTERNAL" }
+        resp = hub_post(bdproject['_meta']['href'] + "/versions", postdata, 'project-versions')
         if resp.status_code != 201:
-            logging.debug("Cannot create version {}".format(ver))
-            return None, None
-        print("Created version '{}'".format(ver))
-        bdversion = hub.get_version_by_name(bdproject, ver)
+            # As for the project - check whether the server created the version before giving up
+            bdversion = get_version_by_name(bdproject, ver)
+            if not bdversion:
+                logging.debug("Cannot create version {}".format(ver))
+                return None, None
+        out("Created version '{}'".format(ver))
+        bdversion = bdversion or get_version_by_name(bdproject, ver)
     else:
-        print("Opening version '{}'".format(ver))
+        out("Opening version '{}'".format(ver))
     return bdproject, bdversion
 
-def read_compfile(compfile):
+def get_bom_components(bdversion):
+    #
+    # Return dict of KB component version URL -> BOM component for all components in the project version
+    # (reading all pages of the BOM)
+    bom = {}
+    custom_headers = {
+            'Accept':'application/vnd.blackducksoftware.bill-of-materials-6+json'
+    }
+    offset = 0
+    while True:
+        url = bdversion['_meta']['href'] + "/components?limit={}&offset={}".format(BOM_PAGE_SIZE, offset)
+        response = hub_transport.trim_response('bom', hub_get(url, 'bom', custom_headers))
+        if response.status_code != 200:
+            logging.error("Failed to retrieve project components, status code: {}".format(response.status_code))
+            return None
+        page = response.json()
+        items = page.get('items', [])
+        for component in items:
+            bom[component.get('componentVersion', component.get('component'))] = component
+        offset += len(items)
+        if not items or offset >= page.get('totalCount', 0):
+            break
+    return bom
+
+def group_compfile_entries(entries):
+    #
+    # Group component list (package, version) entries by package
+    # Returns list of (package, [versions]) in component list order (duplicate versions removed)
+    packages = {}
+    for package, version in entries:
+        versions = packages.setdefault(package, [])
+        if version not in versions:
+            versions.append(version)
+    return list(packages.items())
+
+def read_compfile(compfile, fmt):
+    #
+    # Stream the component list file in the specified format (see manifest_reader.py) and group it by package
+    # Returns None if the file cannot be read
     try:
-        cfile = open(compfile)
-    except:
-        logging.error("Failed to open file {} ".format(compfile))
+        return group_compfile_entries(manifest_reader.read_manifest(compfile, fmt))
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        logging.error("Failed to read file {} - {}".format(compfile, e))
         return None
-    
-    if cfile.mode != 'r':
-        logging.error("Failed to open file {} ".format(compfile))
+
+def read_jobfile(jobfile):
+    #
+    # Read the batch mode job file - one COMPONENT_FILE;PROJECT;VERSION line per job (blank lines and lines starting
+    # with # are ignored, and component list file paths are relative to the directory of the job file)
+    # Returns list of (component list file, project, version) - raises ValueError for invalid lines and repeated jobs
+    jobs = []
+    seen = {}
+    basedir = os.path.dirname(os.path.abspath(jobfile))
+    with open(jobfile, "r") as jfile:
+        for lineno, line in enumerate(jfile, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = [field.strip() for field in line.split(";")]
+            if len(fields) != 3 or not all(fields):
+                raise ValueError("line {}: expected COMPONENT_FILE;PROJECT;VERSION".format(lineno))
+            compfile, project, version = fields
+            if (project, version) in seen:
+                raise ValueError("line {}: project '{}' version '{}' is already imported by line {}".format(lineno, project, version, seen[(project, version)]))
+            seen[(project, version)] = lineno
+            jobs.append((os.path.join(basedir, compfile), project, version))
+    return jobs
+
+def add_component_file_arguments(subparser, component_file=True):
+    if component_file:
+        subparser.add_argument('-c', '--component_file', help='Input component list file', required=True)
+    subparser.add_argument('-f', '--format', help='Component list file format: {} (default auto - detect from the file contents)'.format(', '.join(manifest_reader.FORMATS)), choices=manifest_reader.FORMATS, default='auto')
+
+def add_kbfile_argument(subparser, required):
+    subparser.add_argument('-k', '--kbfile', help='Input file of KB component IDs and URLs matching manifest components', required=required)
+
+def add_replace_arguments(subparser):
+    subparser.add_argument('-r', '--replace_package_string', help='Replace (remove) string in input package name', action='append')
+    subparser.add_argument('-a', '--append', help='Append new KB URLs to the KB Lookup file specified in -k', action='store_true')
+
+def add_project_arguments(subparser):
+    subparser.add_argument('-p', '--project', help='Black Duck project name', required=True)
+    subparser.add_argument('-v', '--version', help='Black Duck version name', required=True)
+
+def add_delete_argument(subparser):
+    subparser.add_argument('-d', '--delete', help='Delete existing manual components from the project - if not specified then components will be added to the existing list', action='store_true')
+
+def add_retries_argument(subparser):
+    subparser.add_argument('--retries', help='Number of times to retry adding a component to a project if the server is busy or the request could not be sent (default 3)', type=int, default=3)
+
+def add_match_arguments(subparser):
+    subparser.add_argument('--max-component-fetches', help='Maximum number of KB components (search results) checked for each package looked up - 0 for no limit (default 10)', type=int, default=10)
+    subparser.add_argument('--token-refresh', help='Minutes between refreshing the Black Duck API authentication token (default 15)', type=float, default=15)
+
+def add_worker_arguments(subparser):
+    subparser.add_argument('--workers', help='Number of component list entries to process concurrently (default 1)', type=int, default=1)
+    subparser.add_argument('--max-requests', help='Maximum number of concurrent requests to the Black Duck server (default same as --workers)', type=int)
+
+def add_request_arguments(subparser):
+    subparser.add_argument('--rate-limit', help='Maximum Black Duck API requests per second - 0 for no limit (default 0). The rate is reduced automatically while the server is throttling requests', type=float, default=0)
+    subparser.add_argument('--endpoint-limit', help='Maximum concurrent requests to one API endpoint as ENDPOINT=N where ENDPOINT is search, component, versions, bom, bom-add, bom-delete, projects or project-versions (can be specified multiple times)', action='append')
+    subparser.add_argument('--request-retries', help='Number of times to retry an API request which fails or is throttled (default 5)', type=int, default=5)
+    subparser.add_argument('--breaker-threshold', help='Consecutive failed API requests which pause all requests (default 5)', type=int, default=5)
+    subparser.add_argument('--breaker-cooldown', help='Seconds requests are paused after --breaker-threshold consecutive failures - doubled each time requests keep failing (default 30)', type=float, default=30)
+    subparser.add_argument('--connect-timeout', help='Seconds to wait for a connection to the Black Duck server (default {})'.format(hub_transport.DEFAULT_CONNECT_TIMEOUT), type=float, default=hub_transport.DEFAULT_CONNECT_TIMEOUT)
+    subparser.add_argument('--read-timeout', help='Seconds to wait for a response from the Black Duck server (default {})'.format(hub_transport.DEFAULT_READ_TIMEOUT), type=float, default=hub_transport.DEFAULT_READ_TIMEOUT)
+    subparser.add_argument('--no-compression', help='Do not request gzip compressed responses', action='store_true')
+
+def add_server_arguments(subparser):
+    subparser.add_argument('--server', help='Send KB lookups to the lookup service started by serve mode at this address (HOST:PORT or unix:PATH)')
+
+def add_cache_dir_argument(subparser):
+    subparser.add_argument('--cache-dir', help='Directory for the persistent KB response cache (default "{}")'.format(kb_cache.DEFAULT_CACHE_DIR), default=kb_cache.DEFAULT_CACHE_DIR)
+
+def add_cache_size_argument(subparser):
+    subparser.add_argument('--cache-size', help='Maximum KB cache size in MB (default {})'.format(kb_cache.DEFAULT_CACHE_SIZE), type=int, default=kb_cache.DEFAULT_CACHE_SIZE)
+
+def add_cache_arguments(subparser):
+    add_cache_dir_argument(subparser)
+    subparser.add_argument('--cache-ttl', help='KB cache TTL in hours for all endpoints, or per endpoint as ENDPOINT=HOURS where ENDPOINT is search, component or versions (can be specified multiple times)', action='append')
+    add_cache_size_argument(subparser)
+    subparser.add_argument('--no-cache', help='Do not use the persistent KB response cache', action='store_true')
+    subparser.add_argument('--snapshot', help='KB snapshot file (from export-snapshot) used for KB requests before the KB response cache and the Black Duck server')
+    subparser.add_argument('--memo-size', help='Maximum number of KB components (with version lists) held in memory during the run (default {})'.format(kb_cache.DEFAULT_MEMO_SIZE), type=int, default=kb_cache.DEFAULT_MEMO_SIZE)
+
+def open_kbcache(args):
+    #
+    # Open the persistent KB cache (None if --no-cache) - raises ValueError for invalid --cache-ttl values
+    if args.no_cache:
         return None
+    ttls = kb_cache.parse_ttls(args.cache_ttl)
+    return kb_cache.KBCache(args.cache_dir, ttls, args.cache_size * 1024 * 1024)
 
-    lines = cfile.readlines()
-#
-# Alternative file format:
-#    outlines = []
-#    package = ""
-#    version = ""
-#    for line in lines:
-#        splitline = line.split(":")
-#        if splitline[0] == "PACKAGE NAME":
-#            package = splitline[1].strip()
-#        if splitline[0] == "PACKAGE VERSION":
-#            version = splitline[1].strip()
-#        if splitline[0] == "LICENSE":
-#            if splitline[1].strip() == "CLOSED":
-#                continue
-#            else:
-#                outlines.append("{};{}".format(package, version))
-#    lines = outlines
-#
-# End Alternative
-                
-    return lines
-
-def process_compfile_line(line):
-    version = ""
-    package = ""
-    splitline = line.split("-")
-    for segment in splitline:
-        if segment[0].isdigit():
-            if version != "":
-                version += "."
-            version += segment.strip()
-        else:
-            if package != "":
-                package += "-"
-            package += segment.strip()
-    return(package, version)
-#    splitline = line.split(";") # Alternative import
-#    return(splitline[0], splitline[1]) # Alternative import
+def add_metrics_arguments(subparser):
+    subparser.add_argument('--metrics-out', help='Write run metrics (API requests, timings, cache hits and version match strengths) to this file')
+    subparser.add_argument('--metrics-format', help='Format of the --metrics-out file (default prometheus if the file name ends with .prom, otherwise json)', choices=['json', 'prometheus'])
+    subparser.add_argument('--log-level', help='Level of messages written to the log file MRB_import_yocto_manifest.log (default INFO)', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
 
-#
-# Main Program
-            
-parser = argparse.ArgumentParser(description='Process or import component list into project/version', prog='import_manifest')
-
-subparsers = parser.add_subparsers(help='Choose operation mode', dest='command')
-# create the parser for the "kblookup" command
-parser_g = subparsers.add_parser('kblookup', help='Process component list to find matching KB URLs & export to file')
-parser_g.add_argument('-c', '--component_file', help='Input component list file', required=True)
-parser_g.add_argument('-k', '--kbfile', help='Input file of KB component IDs matching manifest components')
-parser_g.add_argument('-o', '--output', help='Output file of KB component IDs matching manifest components (default "kblookup.out")', default='kblookup.out')
-parser_g.add_argument('-r', '--replace_package_string', help='Replace (remove) string in input package name', action='append')
-parser_g.add_argument('-a', '--append', help='Append new KB URLs to the KB Lookup file specified in -k', action='store_true')
-
-# create the parser for the "import" command
-parser_i = subparsers.add_parser('import', help='Import component list into specified Black Duck project/version using KB URLs from supplied file')
-parser_i.add_argument('-c', '--component_file', help='Input component list file', required=True)
-parser_i.add_argument('-k', '--kbfile', help='Input file of KB component IDs and URLs matching manifest components', required=True)
-parser_i.add_argument('-p', '--project', help='Black Duck project name',required=True)
-parser_i.add_argument('-v', '--version', help='Black Duck version name',required=True)
-parser_i.add_argument('-d', '--delete', help='Delete existing manual components from the project - if not specified then components will be added to the existing list', action='store_true')
-
-
-#parser.add_argument("version")
-args = parser.parse_args()
-
-kblookupdict = {}   # Dict of package names from kbfile with matching array of component URLs for each
-kbverdict = {}      # Dict of package/version strings with single component version URL for each
-manualcomplist = [] # List of manually added components for optional deletion is -d specified
-
-if not args.command:
-    parser.print_help()
-    exit
-    
-if args.command == 'kblookup':
-    if args.kbfile:
-        if args.append:
-            kblookupdict, kbverdict = import_kbfile(args.kbfile, args.output)
-        else:
-            kblookupdict, kbverdict = import_kbfile(args.kbfile, "")
+def close_caches():
     #
-    # Process components to find matching KB URLs - output to componentlookup.csv
-    lines = read_compfile(args.component_file)
-    
-    print("")
-    print("Will use output kbfile {}".format(args.output))
-    print("Processing component list file {} ...".format(args.component_file))
-    processed_comps = 0
-    for line in lines:
-        package, version = process_compfile_line(line)
-        
-        print("Manifest Component = '{}/{}'".format(package, version), end = "")
-        if package in kblookupdict:
-            #
-            # Found primary package name in kbfile
-            if kblookupdict[package][0] == "NO MATCH":
-                print("- NO MATCH in input KB File")
-                continue
-            logging.debug("Found package {} in kblookupdict".format(package))
-            #
-            # Check if package/version is defined in KB Lookup file 
+    # Report and close the caches and write the run metrics at the end of the run
+    if kbsearchplan:
+        print(kbsearchplan.report())
+        metrics.set('kb_searches', kbsearchplan.searches, result='sent')
+        metrics.set('kb_searches', kbsearchplan.shared, result='shared')
+    print(compmemo.report())
+    if resolvememo.hits + resolvememo.misses:
+        print(resolvememo.report())
+    if api.retried or api.breaker.opened:
+        print(api.report())
+    metrics.set('api_retries', api.retried)
+    metrics.set('api_breaker_opened', api.breaker.opened)
+    metrics.set('cache_lookups', compmemo.hits, cache='memo', result='hit')
+    metrics.set('cache_lookups', compmemo.misses, cache='memo', result='miss')
+    if kbsnapshot:
+        print(kbsnapshot.report())
+        metrics.set('cache_lookups', kbsnapshot.hits, cache='snapshot', result='hit')
+        metrics.set('cache_lookups', kbsnapshot.misses, cache='snapshot', result='miss')
+        kbsnapshot.close()
+    if kbcache:
+        print(kbcache.report())
+        metrics.set('cache_lookups', kbcache.hits, cache='kb', result='hit')
+        metrics.set('cache_lookups', kbcache.misses, cache='kb', result='miss')
+        metrics.set('kb_cache_bytes', kbcache.size)
+        kbcache.close()
+    if args.metrics_out:
+        metrics.write(args.metrics_out, args.metrics_format)
+        print("Wrote metrics to {}".format(args.metrics_out))
+
+def load_confirmed_mappings():
+    #
+    # Return dicts of package -> confirmed KB component URLs and KB component URL -> number of packages, from the
+    # mappings saved in the KB cache by earlier runs, the KB snapshot and the input kbfile
+    # (not when the kbfile is read from its compiled index, as listing all its packages would read the whole index)
+    mappings = kbcache.mappings() if kbcache else {}
+    if kbsnapshot:
+        for package, kburls in kbsnapshot.mappings().items():
+            mappings.setdefault(package, set()).update(kburls)
+    if isinstance(kblookupdict, dict):
+        for package, kburls in kblookupdict.items():
+            mappings.setdefault(package, set()).update(kburl for kburl in kburls if kburl != "NO MATCH")
+    components = {}
+    for kburls in mappings.values():
+        for kburl in kburls:
+            components[kburl] = components.get(kburl, 0) + 1
+    return mappings, components
+
+def confirm_mapping(kbline):
+    #
+    # Save the package -> KB component mapping from a new kbfile line with matched versions in the KB cache
+    entry = kb_store.parse_kbfile_line(kbline)
+    if kbcache and entry and entry[3] != "NO MATCH" and any(verurl != "NO VERSION MATCH" for version, verurl in entry[4]):
+        try:
+            kbcache.confirm(entry[0], entry[3])
+        except sqlite3.Error as e:
+            logging.warning("confirm_mapping(): KB cache write failed - %s", e)
+
+def kblookup_package(packageversions):
+    #
+    # Find the KB component/versions for one package and all its versions from the component list
+    # Returns package, list of (version, message to print), list of kbfile actions and number of versions processed,
+    # where kbfile actions are ('add', kbfile line) or ('update', KB component URL, [(version, KB version URL)])
+    package, versions = packageversions
+    if package in kblookupdict:
+        #
+        # Found primary package name in kbfile
+        if kblookupdict[package][0] == "NO MATCH":
+            return package, [(version, "- NO MATCH in input KB File") for version in versions], [], 0
+        logging.debug("Found package %s in kblookupdict", package)
+        #
+        # Check if package/versions are defined in KB Lookup file 
+        messages = {}
+        searchversions = []
+        for version in versions:
             packverstr = package + "/" + version
             if packverstr in kbverdict:
                 # Found in KB ver URL list - Nothing to do
-                logging.debug("Found component {} version {} in kbverdict - URL {}".format(package, version, kbverdict[packverstr]))
-                kbverurl = kbverdict[packverstr]
-                print(" - already MATCHED in input KB file")
+                logging.debug("Found component %s version %s in kbverdict - URL %s", package, version, kbverdict[packverstr])
+                messages[version] = " - already MATCHED in input KB file"
+            else:
+                searchversions.append(version)
+        #
+        # Check component URLs for remaining component versions
+        verurls = {}
+        matches = find_compvers_from_compurls(package, kblookupdict[package], searchversions)
+        for version in searchversions:
+            if version in matches:
+                kburl, kbverurl, srcurl = matches[version]
+                messages[version] = " - MATCHED '{}/{}' (sourceURL={})".format(package, version, srcurl)
             else:
                 #
-                # Loop through component URLs to check for component version
-                foundkbversion = False
-                for kburl in kblookupdict[package]:
-                    kbverurl, srcurl = find_compver_from_compurl(package, kburl, version)
-                    processed_comps += 1
+                # No version match - need to add NO VERSION MATCH string to kbfile
+                kburl, kbverurl = kblookupdict[package][0], "NO VERSION MATCH"
+                messages[version] = " - NO VERSION MATCH in input KB File components"
+            verurls.setdefault(kburl, []).append((version, kbverurl))
+        kbactions = [('update', kburl, kbvers) for kburl, kbvers in verurls.items()]
+        return package, [(version, messages[version]) for version in versions], kbactions, len(searchversions)
+
+    newkblines, messages = find_comp_from_kb(package, versions, args.output, args.kbfile, args.replace_package_string)
+    return package, messages, [('add', line) for line in newkblines], len(versions)
+
+def apply_kbactions(kbstore, package, kbactions):
+    #
+    # Write the kbfile actions returned by kblookup_package() for package to the output KB Lookup file
+    with metrics.timed('kbfile_write'):
+        for kbaction in kbactions:
+            if kbaction[0] == 'add':
+                kbstore.add_entry(kbaction[1])
+                confirm_mapping(kbaction[1])
+            else:
+                for version, kbverurl in kbaction[2]:
                     if kbverurl != "NO VERSION MATCH":
-                        print(" - MATCHED '{}/{}' (sourceURL={})".format(package, version, srcurl))
-                        #
-                        # KB version URL found
                         kbverdict[package + "/" + version] = kbverurl
-                        update_kbfile_entry(args.output, package, version, kblookupdict[package][0], kbverurl)
-                        processed_comps += 1
-
-                        foundkbversion = True
-                        break
-                if foundkbversion == False:
-                    #
-                    # No version match - need to add NO VERSION MATCH string to kbfile
-                    update_kbfile_entry(args.output, package, version, kblookupdict[package][0], "NO VERSION MATCH")
-                    continue # move to next component
+                kbstore.add_versions(package, kbaction[1], kbaction[2])
+
+def matched_versions(package, versions, kbactions):
+    #
+    # Return dict of version -> KB version URL for the versions of package matched in the input kbfile or by the
+    # kbfile actions returned by kblookup_package()
+    verurls = {}
+    for kbaction in kbactions:
+        if kbaction[0] == 'add':
+            entry = kb_store.parse_kbfile_line(kbaction[1])
+            verlist = entry[4] if entry else []
+        else:
+            verlist = kbaction[2]
+        for version, kbverurl in verlist:
+            if kbverurl != "NO VERSION MATCH":
+                verurls.setdefault(version, kbverurl)
+    for version in versions:
+        kbverurl = kbverdict.get(package + "/" + version)
+        if kbverurl and kbverurl != "NO VERSION MATCH":
+            verurls.setdefault(version, kbverurl)
+    return verurls
+
+def kblookup_item(item):
+    #
+    # Process (index, (package, versions)) item, reusing the result saved in the checkpoint if available
+    index, packageversions = item
+    if index in resumed_results:
+        return index, resumed_results.pop(index)
+    return index, kblookup_package(packageversions)
+
+def ordered_map(func, items, workers, pending=None):
+    #
+    # Yield func(item) for each item in order, running up to workers calls concurrently
+    # (no more than 2 x workers results are held ahead of the next one returned)
+    # pending is an optional deque which holds the futures for submitted items not yet returned
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if pending is None:
+        pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def import_package(packageversions):
+    #
+    # Find the KB version URLs for all versions of one package from the kbfile
+    # Returns list of (package, version, KB version URL or None if no match, message if no match)
+    package, versions = packageversions
+    if package not in kblookupdict:
+        return [(package, version, None, " - No component match in KB list file") for version in versions]
+    #
+    # Check if package/versions are in kbverdict, search the kbfile component URLs for the other versions
+    kbverurls = {}
+    searchversions = []
+    for version in versions:
+        packstr = package + "/" + version
+        if packstr in kbverdict:
+            #
+            # Component version URL found in kbfile 
+            logging.debug("Compver found in kbverdict packstr = %s, kbverdict[packstr] = %s", packstr, kbverdict[packstr])
+            kbverurls[version] = kbverdict[packstr]
         else:
-            newkbline = find_comp_from_kb(package, version, args.output, args.kbfile, args.replace_package_string)
-            add_kbfile_entry(args.output, newkbline)
-            processed_comps += 1
-            
-        if processed_comps > 500:
-            print("500 components processed - terminating. Please rerun with -k option to append to kbfile")
-            exit()
-    exit()
-
-if args.command == 'import':
+            searchversions.append(version)
+    for version in searchversions:
+        kbverurls[version] = resolvememo.get_or_load((package, version), lambda: resolve_kbfile_version(package, version))
+
+    results = []
+    for version in versions:
+        kbverurl = kbverurls.get(version, "NO VERSION MATCH")
+        if kbverurl != "NO VERSION MATCH":
+            results.append((package, version, kbverurl, ""))
+        else:
+            results.append((package, version, None, " - No component match from KB"))
+    return results
+
+def resolve_kbfile_version(package, version):
+    #
+    # Return the KB version URL of the first kbfile component URL for package with a match for version, or
+    # "NO VERSION MATCH" (held in resolvememo, so batch mode jobs with the same package versions reuse the match)
+    matches = find_compvers_from_compurls(package, kblookupdict[package], [version])
+    return matches[version][1] if version in matches else "NO VERSION MATCH"
+
+def del_bom_entry(component):
+    return del_comp_from_bom(bdversion_url, component['_meta']['href'])
+
+def add_bom_entry(entry):
+    package, version, kbverurl = entry
+    return add_comp_to_bom(bdversion_url, kbverurl, args.component_file, package + "/" + version)
+
+def manifest_delta(prevgroups, groups, recorded):
+    #
+    # Compare the component list with the previous component list
+    # Returns list of (package, [versions]) which need to be looked up - versions not in the previous component list
+    # or not recorded in the previous kbfile (recorded is dict of package -> set of versions from kb_store.kbfile_versions())
+    # - dict of the numbers of added, removed, version changed and unchanged packages, and list of removed packages
+    prevversions = dict((package, set(versions)) for package, versions in prevgroups)
+    delta = []
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+    for package, versions in groups:
+        if package not in prevversions:
+            counts['added'] += 1
+        elif set(versions) - prevversions[package]:
+            counts['changed'] += 1
+        else:
+            counts['unchanged'] += 1
+        lookup = [version for version in versions
+                  if version not in prevversions.get(package, ()) or version not in recorded.get(package, ())]
+        if lookup:
+            delta.append((package, lookup))
+    packages = set(package for package, versions in groups)
+    removed = [package for package in prevversions if package not in packages]
+    counts['removed'] = len(removed)
+    return delta, counts, removed
+
+def incremental_groups(groups, kbstore):
+    #
+    # Return the packages and versions in the component list which need to be looked up (--previous) after
+    # copying the previous kbfile entries for packages still in the component list to the output kbfile, and
+    # (unless -a) removing the entries for packages no longer in the component list from the output kbfile
+    # Returns None if the previous component list cannot be read
+    prevgroups = read_compfile(args.previous, args.format)
+    if prevgroups is None:
+        print("Cannot read previous component list file {}".format(args.previous))
+        return None
+    recorded = kb_store.kbfile_versions(args.kbfile) if os.path.exists(args.kbfile) else {}
+    delta, counts, removed = manifest_delta(prevgroups, groups, recorded)
+    print("Changes from previous component list {}: {} packages added, {} with version changes, {} removed, {} unchanged".format(
+        args.previous, counts['added'], counts['changed'], counts['removed'], counts['unchanged']))
+    if not args.append:
+        if os.path.abspath(args.kbfile) != os.path.abspath(args.output):
+            if os.path.exists(args.kbfile):
+                packages = set(package for package, versions in groups)
+                print("Copied {} entries from {} to {}".format(kbstore.merge_file(args.kbfile, packages), args.kbfile, args.output))
+        elif removed:
+            print("Removed {} entries for packages no longer in the component list from {}".format(kbstore.remove_packages(removed), args.output))
+    print("Looking up {} versions of {} packages".format(sum(len(versions) for package, versions in delta), len(delta)))
+    return delta
+
+def parse_shard(value):
+    #
+    # Return (shard, number of shards) for a --shard value 'I/N' (1 <= I <= N)
+    try:
+        shard, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be I/N, e.g. 1/4")
+    if count < 1 or not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError("shard number must be between 1 and the number of shards")
+    return shard, count
+
+def package_shard(package, count):
+    #
+    # Return the shard (1 to count) which looks up package - the same in every process and on every host
+    return int(hashlib.sha1(package.encode('utf-8')).hexdigest(), 16) % count + 1
+
+def manifest_hash(groups):
+    return hashlib.sha1(json.dumps(groups).encode('utf-8')).hexdigest()
+
+def read_checkpoint(checkpointfile, hashval):
+    #
+    # Return (number of packages completed, dict of index -> saved results for later packages)
+    # from the checkpoint file if it was written for the same component list
+    try:
+        with open(checkpointfile, "r") as cfile:
+            checkpoint = json.load(cfile)
+    except (IOError, ValueError):
+        return 0, {}
+    if checkpoint.get('manifest_hash') != hashval:
+        print("Ignoring checkpoint file {} (written for a different component list)".format(checkpointfile))
+        return 0, {}
+    return checkpoint['offset'], dict((index, result) for index, result in checkpoint.get('pending', []))
+
+def write_checkpoint(checkpointfile, component_file, hashval, offset, pending):
+    #
+    # Save the number of packages completed and the results already found for later packages
+    results = [future.result() for future in list(pending) if future.done() and not future.cancelled() and future.exception() is None]
+    checkpoint = {
+        'component_file': component_file,
+        'manifest_hash': hashval,
+        'offset': offset,
+        'pending': results,
+    }
+    tmpfile = checkpointfile + ".tmp"
+    with open(tmpfile, "w") as cfile:
+        json.dump(checkpoint, cfile)
+    os.replace(tmpfile, checkpointfile)
+
+
+def bom_snapshot_path(cachedir, project, version):
+    return os.path.join(cachedir, "boms", hashlib.sha1("{}/{}".format(project, version).encode('utf-8')).hexdigest() + ".json")
+
+def save_bom_snapshot(cachedir, project, version, bom):
+    #
+    # Save the KB component version URLs, names and match types of the project version BOM in the cache directory
+    # (used by plan mode)
+    path = bom_snapshot_path(cachedir, project, version)
+    snapshot = {
+        'project': project,
+        'version': version,
+        'time': time.time(),
+        'components': dict((compver, dict((field, component[field]) for field in ('componentName', 'componentVersionName', 'matchTypes') if field in component))
+                           for compver, component in bom.items()),
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = path + ".tmp"
+        with open(tmppath, "w") as bfile:
+            json.dump(snapshot, bfile)
+        os.replace(tmppath, path)
+    except OSError as e:
+        logging.error("save_bom_snapshot(): Failed to write file {} - {}".format(path, e))
+
+def load_bom_snapshot(cachedir, project, version):
+    #
+    # Return the BOM snapshot saved by the last import into the project version, or None
+    try:
+        with open(bom_snapshot_path(cachedir, project, version), "r") as bfile:
+            return json.load(bfile)
+    except (IOError, ValueError):
+        return None
+
+def plan_import(groups, bom, delete, out=print):
+    #
+    # Resolve KB version URLs for all component list entries, then plan the changes to the project:
+    # add each distinct KB version not already in the project, keep those already in the project and
+    # (if delete) remove manual components which are not in the component list
+    # Returns list of (package, version, KB version URL to add or message), list of (package, version, KB version URL)
+    # to add, dict of KB version URL -> component list entry which will add it, set of KB version URLs to keep
+    # and list of BOM components to delete
+    entries = []
+    toadd = []
+    added_by = {}
+    keep = set()
+    for results in ordered_map(import_package, groups, args.workers):
+        for package, version, kbverurl, message in results:
+            logging.debug("Manifest component to add = '%s/%s'", package, version)
+            if kbverurl is None:
+                entries.append((package, version, message))
+            elif kbverurl in bom:
+                keep.add(kbverurl)
+                entries.append((package, version, " - already in project"))
+            elif kbverurl in added_by:
+                entries.append((package, version, " - same KB component version as '{}'".format(added_by[kbverurl])))
+            else:
+                added_by[kbverurl] = package + "/" + version
+                toadd.append((package, version, kbverurl))
+                entries.append((package, version, kbverurl))
+    toremove = []
+    if delete:
+        manualcomps = set(compver for compver, component in bom.items() if 'MANUAL_BOM_COMPONENT' in component.get('matchTypes', []))
+        out("Found {} manual components".format(len(manualcomps)))
+        toremove = [bom[compver] for compver in sorted(manualcomps - keep)]
+    return entries, toadd, added_by, keep, toremove
+
+def print_import_plan(entries, toadd, added_by, keep, toremove, note, out=print):
+    for package, version, result in entries:
+        if result in added_by:
+            result = " - would be added"
+        out("Manifest component to add = '{}/{}'{}".format(package, version, result))
+    for component in toremove:
+        out("Manual component to delete = '{}/{}'".format(component.get('componentName'), component.get('componentVersionName')))
+    out("")
+    out("Import plan: {} to add, {} already in project, {} to delete ({})".format(len(toadd), len(keep), len(toremove), note))
+
+def run_kblookup():
+    global token_refresh, kblookupdict, kbverdict, component_fetch_budget, confirmed_mappings, confirmed_components
+    global resumed_results, kbsearchplan, offline
+    offline = args.offline
+    if not args.output:
+        args.output = "kblookup-{}-of-{}.out".format(*args.shard) if args.shard else "kblookup.out"
+    token_refresh = args.token_refresh * 60
     if args.kbfile:
-        kblookupdict, kbverdict = import_kbfile(args.kbfile, "")
+        kblookupdict, kbverdict = load_kbfile(args.kbfile)
+    component_fetch_budget = args.max_component_fetches or None
+    confirmed_mappings, confirmed_components = load_confirmed_mappings()
+    kbstore = kb_store.KBFileStore(args.output)
+    if args.kbfile and args.append and os.path.abspath(args.kbfile) != os.path.abspath(args.output):
+        print("Copied {} entries from {} to {}".format(kbstore.merge_file(args.kbfile), args.kbfile, args.output))
+    #
+    # Process components to find matching KB URLs - output to componentlookup.csv
+    groups = read_compfile(args.component_file, args.format)
+    if groups is None:
+        print("Cannot read component list file {}".format(args.component_file))
+        kbstore.close()
+        close_caches()
+        return 1
+    if args.previous:
+        groups = incremental_groups(groups, kbstore)
+        if groups is None:
+            kbstore.close()
+            close_caches()
+            return 1
+    if args.shard:
+        shard, count = args.shard
+        total = len(groups)
+        groups = [(package, versions) for package, versions in groups if package_shard(package, count) == shard]
+        print("Shard {} of {}: looking up {} of {} packages".format(shard, count, len(groups), total))
+    hashval = manifest_hash(groups)
+    checkpointfile = args.checkpoint or args.output + ".checkpoint"
+    offset = 0
+    resumed_results = {}
+    if not args.restart:
+        offset, resumed_results = read_checkpoint(checkpointfile, hashval)
+        if offset > 0 or resumed_results:
+            print("Resuming from checkpoint {} - {} of {} packages already processed".format(checkpointfile, offset, len(groups)))
+    #
+    # Plan the KB searches for all packages still to be looked up so searches shared by several packages are only sent once
+    # (KB searches are made by the lookup server if --server is used)
+    if not lookup_client:
+        kbsearchplan = search_plan.SearchPlan([search_compname(package, args.replace_package_string)
+                                               for index, (package, versions) in enumerate(groups)
+                                               if index >= offset and index not in resumed_results and package not in kblookupdict])
+        print("Planned {} distinct KB searches for {} package name variants".format(kbsearchplan.distinct, kbsearchplan.planned))
     
-    bdproject, bdversion = manage_project_version(args.project, args.version) 
+    print("")
+    print("Will use output kbfile {}".format(args.output))
+    print("Processing component list file {} ({} packages) ...".format(args.component_file, len(groups)))
+    pending = deque()
+    starttime = lastcheckpoint = time.time()
+    processed = 0
+    processed_versions = 0
+    try:
+        for index, (package, messages, kbactions, kbcount) in ordered_map(kblookup_item, list(enumerate(groups))[offset:], args.workers, pending):
+            for version, message in messages:
+                print("Manifest Component = '{}/{}'{}".format(package, version, message))
+            apply_kbactions(kbstore, package, kbactions)
+            offset = index + 1
+            processed += 1
+            processed_versions += kbcount
+            metrics.count('packages_processed')
+            metrics.count('versions_looked_up', kbcount)
+
+            if time.time() - lastcheckpoint > 30:
+                write_checkpoint(checkpointfile, args.component_file, hashval, offset, pending)
+                lastcheckpoint = time.time()
+                rate = processed * 60 / (lastcheckpoint - starttime)
+                print("Progress: {}/{} packages ({} versions looked up) - {:.1f} packages/min - approx {:.0f} min remaining".format(
+                    offset, len(groups), processed_versions, rate, (len(groups) - offset) / rate if rate else 0))
+    except (KeyboardInterrupt, lookup_service.LookupServiceError) as e:
+        write_checkpoint(checkpointfile, args.component_file, hashval, offset, pending)
+        kbstore.close()
+        if isinstance(e, lookup_service.LookupServiceError):
+            print(e)
+        print("Interrupted after {} of {} packages - rerun the same command to resume".format(offset, len(groups)))
+        close_caches()
+        return 1
+
+    with metrics.timed('kbfile_write'):
+        kbstore.close()
+    if os.path.exists(checkpointfile):
+        os.remove(checkpointfile)
+    elapsed = time.time() - starttime
+    print("Processed {} packages ({} versions looked up) in {:.1f} min".format(processed, processed_versions, elapsed / 60))
+    misses = sum(count for key, count in metrics.counters.items() if key[0] == 'kb_offline_misses')
+    if misses:
+        print("{} KB responses were not in the KB snapshot or cache (offline) - packages and versions which needed them are reported as not matched".format(misses))
+    close_caches()
+
+def run_import():
+    global add_retries, kblookupdict, kbverdict
+    add_retries = args.retries
+    if args.kbfile:
+        kblookupdict, kbverdict = load_kbfile(args.kbfile)
+    summary = import_component_list(args.component_file, args.format, args.project, args.version, args.delete, args.dry_run)
+    close_caches()
+    if summary is None:
+        return 1
+
+def import_component_list(compfile, fmt, project, version, delete, dry_run, out=print):
+    #
+    # Import the component list file into the project version using the kbfile entries in kblookupdict/kbverdict
+    # (import mode, and each job in batch mode). Messages are passed to out()
+    # Returns dict of the numbers of components added, skipped, failed, not matched and deleted (the numbers to add
+    # and to delete for dry_run), or None if the project version or component list cannot be read
+    bdproject, bdversion = manage_project_version(project, version, not dry_run, out)
+    if not bdversion and not dry_run:
+        out("Cannot create version {}".format(version))
+        return None
+
+    out("Using component list file '{}'".format(compfile))
+    groups = read_compfile(compfile, fmt)
+    if groups is None:
+        out("Cannot read component list file {}".format(compfile))
+        return None
+
+    if bdversion:
+        bdverurl = bdversion['_meta']['href']
+        bom = get_bom_components(bdversion)
+        if bom is None:
+            out("Cannot read components in version {}".format(version))
+            return None
+        if not args.no_cache:
+            save_bom_snapshot(args.cache_dir, project, version, bom)
+    else:
+        bom = {}
+    out("Found {} existing components in project".format(len(bom)))
+
+    out("")
+    out("Processing component list ...")
+    try:
+        entries, toadd, added_by, keep, toremove = plan_import(groups, bom, delete, out)
+    except lookup_service.LookupServiceError as e:
+        out(str(e))
+        return None
+
+    if dry_run:
+        print_import_plan(entries, toadd, added_by, keep, toremove, "dry run - project not changed", out)
+        return {'added': len(toadd), 'skipped': len(keep), 'failed': 0, 'nomatch': 0, 'deleted': len(toremove)}
+
+    out("Adding {} components to project ...".format(len(toadd)))
+    results = ordered_map(lambda entry: add_comp_to_bom(bdverurl, entry[2], compfile, entry[0] + "/" + entry[1]), toadd, args.workers)
+    addstatus = dict(zip([kbverurl for package, version, kbverurl in toadd], results))
+    added = failed = skipped = nomatch = 0
+    for package, compver, result in entries:
+        if result in addstatus:
+            if addstatus[result]:
+                message = " - Component added"
+                added += 1
+                bom[result] = {'componentName': package, 'componentVersionName': compver, 'matchTypes': ['MANUAL_BOM_COMPONENT']}
+            else:
+                message = " - Component NOT added"
+                failed += 1
+        else:
+            message = result
+            if message.startswith(" - No component"):
+                nomatch += 1
+            else:
+                skipped += 1
+        out("Manifest component to add = '{}/{}'{}".format(package, compver, message))
+
+    deleted = 0
+    if toremove:
+        out("Deleting {} manual components not in component list ...".format(len(toremove)))
+        results = ordered_map(lambda component: del_comp_from_bom(bdverurl, component['_meta']['href']), toremove, args.workers)
+        for component, status in zip(toremove, results):
+            if status:
+                deleted += 1
+                bom.pop(component.get('componentVersion', component.get('component')), None)
+            else:
+                out("Manual component '{}/{}' NOT deleted".format(component.get('componentName'), component.get('componentVersionName')))
+    if not args.no_cache:
+        save_bom_snapshot(args.cache_dir, project, version, bom)
+    out("")
+    out("Import summary: {} added, {} skipped (already in project or duplicate), {} failed, {} not matched, {} deleted".format(added, skipped, failed, nomatch, deleted))
+    return {'added': added, 'skipped': skipped, 'failed': failed, 'nomatch': nomatch, 'deleted': deleted}
+
+def run_batch():
+    #
+    # Import the component list of each job in the job file into its project version, running --jobs jobs at once.
+    # The jobs share the Black Duck session, the kbfile (read once), the KB caches and the KB version resolution memo,
+    # the output of each job is printed when it finishes (in job file order), and a failed job does not stop the others
+    global add_retries, kblookupdict, kbverdict
+    add_retries = args.retries
+    try:
+        jobs = read_jobfile(args.jobfile)
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        print("Cannot read job file {} - {}".format(args.jobfile, e))
+        close_caches()
+        return 1
+    kblookupdict, kbverdict = load_kbfile(args.kbfile)
+    print("Running {} jobs from {} ({} at a time)".format(len(jobs), args.jobfile, args.jobs))
+
+    def run_job(job):
+        compfile, project, version = job
+        lines = []
+        starttime = time.time()
+        try:
+            summary = import_component_list(compfile, args.format, project, version, args.delete, args.dry_run, lines.append)
+        except Exception as e:
+            logging.exception("run_batch(): job for project '{}' version '{}' failed".format(project, version))
+            lines.append("Job failed - {}".format(e))
+            summary = None
+        metrics.count('batch_jobs', result='ok' if summary is not None else 'failed')
+        return lines, summary, time.time() - starttime
+
+    results = []
+    for index, (job, (lines, summary, elapsed)) in enumerate(zip(jobs, ordered_map(run_job, jobs, args.jobs)), 1):
+        compfile, project, version = job
+        print("")
+        print("=== Job {} of {}: project '{}' version '{}' ({}) ===".format(index, len(jobs), project, version, compfile))
+        for line in lines:
+            print(line)
+        results.append((job, summary, elapsed))
+
+    print("")
+    print("Batch report:")
+    totals = dict.fromkeys(('added', 'skipped', 'failed', 'nomatch', 'deleted'), 0)
+    failed_jobs = 0
+    for (compfile, project, version), summary, elapsed in results:
+        if summary is None:
+            failed_jobs += 1
+            print("  {}/{}: FAILED ({:.1f} s)".format(project, version, elapsed))
+            continue
+        for key in totals:
+            totals[key] += summary[key]
+        if args.dry_run:
+            print("  {}/{}: {} to add, {} already in project, {} to delete ({:.1f} s)".format(
+                project, version, summary['added'], summary['skipped'], summary['deleted'], elapsed))
+        else:
+            print("  {}/{}: {} added, {} skipped, {} failed, {} not matched, {} deleted ({:.1f} s)".format(
+                project, version, summary['added'], summary['skipped'], summary['failed'], summary['nomatch'], summary['deleted'], elapsed))
+    if args.dry_run:
+        print("Batch summary: {} jobs ({} failed) - {} to add, {} already in projects, {} to delete (dry run - projects not changed)".format(
+            len(jobs), failed_jobs, totals['added'], totals['skipped'], totals['deleted']))
+    else:
+        print("Batch summary: {} jobs ({} failed) - {} added, {} skipped, {} failed, {} not matched, {} deleted".format(
+            len(jobs), failed_jobs, totals['added'], totals['skipped'], totals['failed'], totals['nomatch'], totals['deleted']))
+    close_caches()
+    if failed_jobs:
+        return 1
+
+def run_sync():
+    #
+    # Look up the component list in the KB and import it into the project in one pass: packages are looked up by the
+    # lookup workers (as in kblookup mode) and each KB version matched which is not already in the project is queued
+    # straight away for the import workers to add, while the KB Lookup file is written as in kblookup mode
+    global token_refresh, add_retries, kblookupdict, kbverdict, component_fetch_budget, confirmed_mappings, confirmed_components
+    global kbsearchplan, bdversion_url
+    token_refresh = args.token_refresh * 60
+    add_retries = args.retries
+    if args.kbfile:
+        kblookupdict, kbverdict = load_kbfile(args.kbfile)
+    component_fetch_budget = args.max_component_fetches or None
+    confirmed_mappings, confirmed_components = load_confirmed_mappings()
+
+    print("Using component list file '{}'".format(args.component_file))
+    groups = read_compfile(args.component_file, args.format)
+    if groups is None:
+        print("Cannot read component list file {}".format(args.component_file))
+        close_caches()
+        return 1
+    bdproject, bdversion = manage_project_version(args.project, args.version)
     if not bdversion:
         print("Cannot create version {}".format(args.version))
-        exit()
+        close_caches()
+        return 1
     bdversion_url = bdversion['_meta']['href']
-         
-    print("Using component list file '{}'".format(args.component_file))
-    lines = read_compfile(args.component_file)
-    
-    components = hub.get_version_components(bdversion)
-    print("Found {} existing components in project".format(components['totalCount']))
-    if args.delete:
-        count = 0
-        logging.debug("Looking through the components for project {}, version {}.".format(args.project, args.version))
-        for component in components['items']:
-            if component['matchTypes'][0] == 'MANUAL_BOM_COMPONENT':
-                manualcomplist.append(component['componentVersion'])
-                count += 1
-        print("Found {} manual components".format(count))
-      
+    bom = get_bom_components(bdversion)
+    if bom is None:
+        print("Cannot read components in version {}".format(args.version))
+        close_caches()
+        return 1
+    print("Found {} existing components in project".format(len(bom)))
+
+    kbstore = kb_store.KBFileStore(args.output)
+    if args.kbfile and args.append and os.path.abspath(args.kbfile) != os.path.abspath(args.output):
+        print("Copied {} entries from {} to {}".format(kbstore.merge_file(args.kbfile), args.kbfile, args.output))
+    if not lookup_client:
+        kbsearchplan = search_plan.SearchPlan([search_compname(package, args.replace_package_string)
+                                               for package, versions in groups if package not in kblookupdict])
+        print("Planned {} distinct KB searches for {} package name variants".format(kbsearchplan.distinct, kbsearchplan.planned))
+
     print("")
-    print("Processing component list ...")  
-    for line in lines:
-        package, version = process_compfile_line(line)
-        print("Manifest component to add = '{}/{}'".format(package, version), end="")
-        logging.debug("Manifest component to add = '{}/{}'".format(package, version))
-        kbverlurl = ""
-        if package in kblookupdict:
-            #
-            # Check if package/version is in kbverdict 
-            packstr = package + "/" + version
-            if packstr in kbverdict:
-                #
-                # Component version URL found in kbfile 
-               logging.debug("Compver found in kbverdict packstr = {}, kbverdict[packstr] = {}".format(packstr, kbverdict[packstr]))
-               kbverurl = kbverdict[packstr]
+    print("Will use output kbfile {}".format(args.output))
+    print("Processing component list file {} ({} packages) ...".format(args.component_file, len(groups)))
+    #
+    # Matched KB versions are passed to the import workers through a bounded queue, so the lookup waits (instead of
+    # holding an unlimited backlog) if adding components to the project falls behind
+    addqueue = queue.Queue(maxsize=args.workers * 2)
+    addstatus = {}
+    def add_worker():
+        while True:
+            entry = addqueue.get()
+            if entry is None:
+                return
+            addstatus[entry[2]] = add_bom_entry(entry)
+    adders = [threading.Thread(target=add_worker, daemon=True) for i in range(args.workers)]
+    for adder in adders:
+        adder.start()
+
+    entries = []
+    added_by = {}
+    keep = set()
+    starttime = time.time()
+    interrupted = None
+    try:
+        for package, messages, kbactions, kbcount in ordered_map(kblookup_package, groups, args.workers):
+            for version, message in messages:
+                print("Manifest Component = '{}/{}'{}".format(package, version, message))
+            apply_kbactions(kbstore, package, kbactions)
+            metrics.count('packages_processed')
+            metrics.count('versions_looked_up', kbcount)
+            verurls = matched_versions(package, [version for version, message in messages], kbactions)
+            for version, message in messages:
+                kbverurl = verurls.get(version)
+                if kbverurl is None:
+                    entries.append((package, version, " - No component match from KB"))
+                elif kbverurl in bom:
+                    keep.add(kbverurl)
+                    entries.append((package, version, " - already in project"))
+                elif kbverurl in added_by:
+                    entries.append((package, version, " - same KB component version as '{}'".format(added_by[kbverurl])))
+                else:
+                    added_by[kbverurl] = package + "/" + version
+                    entries.append((package, version, kbverurl))
+                    addqueue.put((package, version, kbverurl))
+    except (KeyboardInterrupt, lookup_service.LookupServiceError) as e:
+        interrupted = e
+    finally:
+        # Let the import workers finish the components already queued
+        for adder in adders:
+            addqueue.put(None)
+        for adder in adders:
+            adder.join()
+    with metrics.timed('kbfile_write'):
+        kbstore.close()
+
+    added = failed = skipped = nomatch = 0
+    for package, version, result in entries:
+        if result in addstatus:
+            if addstatus[result]:
+                added += 1
+                keep.add(result)
+                bom[result] = {'componentName': package, 'componentVersionName': version, 'matchTypes': ['MANUAL_BOM_COMPONENT']}
             else:
-                #
-                # No match of component version in kbfile version URLs
-                for kburl in kblookupdict[package]:
-                    #
-                    # Loop through component URLs from kbfile
-                    if kburl != "NO MATCH":
-                        kbverurl, srcurl = find_compver_from_compurl(package, kburl, version)
-                        if kbverurl != "NO VERSION MATCH":
-                            break
-            if kbverurl != "NO VERSION MATCH":
-                #
-                # Component does not exist in project
-                logging.debug("Component found in project - packstr = {}".format(packstr))
-                add_comp_to_bom(bdversion_url, kbverurl, args.component_file, package + "/" + version)
-                if kbverurl in manualcomplist:
-                    manualcomplist.delete(kbverurl)
+                failed += 1
+                print("Manifest component to add = '{}/{}' - Component NOT added".format(package, version))
+        elif result.startswith(" - No component"):
+            nomatch += 1
+        else:
+            skipped += 1
+
+    deleted = 0
+    if args.delete and not interrupted:
+        manualcomps = set(compver for compver, component in bom.items() if 'MANUAL_BOM_COMPONENT' in component.get('matchTypes', []))
+        toremove = [bom[compver] for compver in sorted(manualcomps - keep)]
+        if toremove:
+            print("Deleting {} manual components not in component list ...".format(len(toremove)))
+        for component, status in zip(toremove, ordered_map(del_bom_entry, toremove, args.workers)):
+            if status:
+                deleted += 1
+                bom.pop(component.get('componentVersion', component.get('component')), None)
             else:
-                print(" - No component match from KB")
+                print("Manual component '{}/{}' NOT deleted".format(component.get('componentName'), component.get('componentVersionName')))
+    if not args.no_cache:
+        save_bom_snapshot(args.cache_dir, args.project, args.version, bom)
+    print("")
+    if interrupted:
+        if isinstance(interrupted, lookup_service.LookupServiceError):
+            print(interrupted)
+        print("Interrupted after {} of {} packages - components already added are kept, rerun the same command to finish".format(
+            len(set(package for package, version, result in entries)), len(groups)))
+    print("Sync summary: {} added, {} skipped (already in project or duplicate), {} failed, {} not matched, {} deleted in {:.1f} min".format(
+        added, skipped, failed, nomatch, deleted, (time.time() - starttime) / 60))
+    close_caches()
+    return 1 if interrupted else None
 
-        else:
-            print (" - No component match in KB list file")
-    
-    if args.delete:
-        print("Unused components not deleted - not available until version 2019.08 which supports the required API")
-    #    count = 0
-    #    for compver in manualcomplist:
-    #        del_comp_from_bom(bdversion_url, compver)
-    #        count += 1
-    #    print("Deleted {} existing manual components".format(count))
+def run_plan():
+    #
+    # Preview an import using the project BOM saved by the last import run and KB responses from the KB cache,
+    # without connecting to the Black Duck server
+    global kblookupdict, kbverdict, offline
+    offline = True
+    snapshot = load_bom_snapshot(args.cache_dir, args.project, args.version)
+    if snapshot is None:
+        print("No saved BOM for project '{}' version '{}' in {} - run import (or import --dry-run) first".format(args.project, args.version, args.cache_dir))
+        close_caches()
+        return 1
+    print("Using BOM of project '{}' version '{}' saved {}".format(args.project, args.version, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot['time']))))
+    kblookupdict, kbverdict = load_kbfile(args.kbfile)
+    print("Using component list file '{}'".format(args.component_file))
+    groups = read_compfile(args.component_file, args.format)
+    if groups is None:
+        print("Cannot read component list file {}".format(args.component_file))
+        close_caches()
+        return 1
+    bom = snapshot['components']
+    print("Found {} existing components in project".format(len(bom)))
+
+    print("")
+    print("Processing component list ...")
+    entries, toadd, added_by, keep, toremove = plan_import(groups, bom, args.delete)
+    print_import_plan(entries, toadd, added_by, keep, toremove, "offline preview")
+    misses = sum(count for key, count in metrics.counters.items() if key[0] == 'kb_offline_misses')
+    if misses:
+        print("{} KB responses needed to match versions were not in the KB snapshot or cache - those versions are reported as not matched (use import --dry-run for a full plan)".format(misses))
+    close_caches()
+
+def serve_find_comp(request):
+    lines, messages = find_comp_from_kb(request['package'], request['versions'], None, None, request.get('replace_strings'))
+    for line in lines:
+        confirm_mapping(line)
+    return {'lines': lines, 'messages': messages}
+
+def serve_find_ver(request):
+    compname, matchversion, matchstrength, sourceurl, verurl = find_ver_from_compver(request['kburl'], request['version'])
+    return {'compname': compname, 'matchversion': matchversion, 'matchstrength': matchstrength, 'sourceurl': sourceurl, 'verurl': verurl}
+
+def serve_status():
+    return {
+        'uptime_seconds': time.time() - metrics.start,
+        'memo': compmemo.report(),
+        'kb_cache': kbcache.report() if kbcache else "KB cache: disabled",
+        'kb_snapshot': kbsnapshot.report() if kbsnapshot else "KB snapshot: not used",
+    }
+
+def run_serve():
+    #
+    # Answer KB lookup requests from kblookup and import modes (--server) until interrupted, using one Black Duck
+    # session and keeping KB components and version lists in memory between requests
+    global token_refresh, component_fetch_budget, confirmed_mappings, confirmed_components
+    token_refresh = args.token_refresh * 60
+    component_fetch_budget = args.max_component_fetches or None
+    confirmed_mappings, confirmed_components = load_confirmed_mappings()
+    handlers = {
+        '/v1/find-comp': serve_find_comp,
+        '/v1/find-ver': serve_find_ver,
+    }
+    try:
+        server = lookup_service.LookupServer(args.listen, handlers, serve_status)
+    except (OSError, ValueError) as e:
+        print("Cannot listen on {} - {}".format(args.listen, e))
+        close_caches()
+        return 1
+    try:
+        # Authenticate now so configuration problems are reported before any requests are received
+        get_hub()
+    except Exception as e:
+        print("Cannot connect to the Black Duck server - {}".format(e))
+        server.close()
+        close_caches()
+        return 1
+    # Stop cleanly (writing the caches and metrics) when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving KB lookups on {} - press Ctrl-C to stop".format(args.listen))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        close_caches()
+
+def run_validate():
+    #
+    # Check KB Lookup files - returns 1 if any problems are found
+    failed = False
+    for kbfile in args.kbfile:
+        try:
+            problems = kb_store.validate_kbfile(kbfile)
+        except (OSError, UnicodeDecodeError) as e:
+            print("{}: cannot read file - {}".format(kbfile, e))
+            failed = True
+            continue
+        for lineno, problem in problems:
+            print("{}:{}: {}".format(kbfile, lineno, problem))
+        print("{}: {} problems found".format(kbfile, len(problems)))
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+def run_merge():
+    #
+    # Merge KB Lookup files (e.g. the output files of kblookup --shard runs) into the output KB Lookup file, combining
+    # the entries for the same package and KB component (see kb_store.KBFileStore.merge_entries())
+    kbstore = kb_store.KBFileStore(args.output)
+    for kbfile in args.kbfile:
+        try:
+            counts = kbstore.merge_entries(kbfile)
+        except (OSError, UnicodeDecodeError) as e:
+            print("Cannot read KB Lookup file {} - {}".format(kbfile, e))
+            kbstore.close()
+            return 1
+        print("Merged {}: {} entries added, {} entries updated{}".format(
+            kbfile, counts['added'], counts['updated'],
+            ", {} versions matched to a different KB version in {} not changed".format(counts['conflicts'], args.output) if counts['conflicts'] else ""))
+    removed = kbstore.reconcile()
+    if removed:
+        print("Removed {} NO MATCH entries for packages matched in another file".format(removed))
+    kbstore.close()
+    print("Wrote {} entries to {}".format(len(kbstore), args.output))
+
+def run_compile():
+    #
+    # Compile the KB Lookup file into the binary index used in place of the file by the other commands
+    try:
+        counts = kb_index.compile_index(args.kbfile, args.output)
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        print("Cannot compile KB Lookup file {} - {}".format(args.kbfile, e))
+        return 1
+    print("Compiled {} to {}: {} packages, {} KB components, {} versions, {} strings ({} bytes)".format(
+        args.kbfile, args.output or kb_index.index_path(args.kbfile), counts['packages'], counts['components'],
+        counts['versions'], counts['strings'], counts['size']))
+
+def run_export_snapshot():
+    #
+    # Write the KB responses and confirmed package mappings in the KB response cache (and the mappings in the -k KB
+    # Lookup files) to a KB snapshot file
+    if not os.path.exists(os.path.join(args.cache_dir, "kbcache.sqlite")):
+        print("No KB response cache in {}".format(args.cache_dir))
+        return 1
+    cache = kb_cache.KBCache(args.cache_dir)
+    try:
+        counts = kb_snapshot.export_snapshot(cache, args.output, args.server_url, args.max_age, args.kbfile)
+    except (OSError, UnicodeDecodeError, ValueError, sqlite3.Error) as e:
+        print("Cannot export KB snapshot - {}".format(e))
+        return 1
+    finally:
+        cache.close()
+    print("Exported {} KB searches, {} KB components and {} KB version lists from {} and {} package mappings to {} ({:.1f} MB)".format(
+        counts['responses'].get('search', 0), counts['responses'].get('component', 0), counts['responses'].get('versions', 0),
+        counts['baseurl'] or "the KB cache", counts['mappings'], args.output, counts['size'] / (1024 * 1024)))
+
+def run_import_snapshot():
+    #
+    # Add the KB responses and package mappings of a KB snapshot file to the KB response cache
+    cache = kb_cache.KBCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    try:
+        counts = kb_snapshot.import_snapshot(cache, args.snapshot)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print("Cannot import KB snapshot - {}".format(e))
+        return 1
+    finally:
+        cache.close()
+    print("Imported {} of {} KB responses and {} of {} package mappings from {} ({}) to {} (responses and mappings already in the cache and newer were kept, the responses imported expire after the cache TTLs from now)".format(
+        counts['responses_added'], counts['responses'], counts['mappings_added'], counts['mappings'], args.snapshot,
+        counts['baseurl'] or "no server", cache.path))
+
+def run_stat():
+    for kbfile in args.kbfile:
+        try:
+            stats = kb_store.kbfile_stats(kbfile)
+        except (OSError, UnicodeDecodeError) as e:
+            print("{}: cannot read file - {}".format(kbfile, e))
+            return 1
+        print("{}: {} entries, {} packages ({} NO MATCH, {} with more than one KB component), {} KB components, "
+              "{} versions matched, {} NO VERSION MATCH".format(kbfile, stats['entries'], stats['packages'], stats['packages_no_match'],
+                                                                stats['packages_multiple_components'], stats['components'],
+                                                                stats['versions_matched'], stats['versions_no_match']))
+
+def run_parse():
+    #
+    # Read the component list file and report (or with --list print) the packages and versions found
+    fmt = args.format
+    try:
+        if fmt == 'auto':
+            fmt = manifest_reader.detect_format(args.component_file)
+    except (OSError, UnicodeDecodeError) as e:
+        print("Cannot read component list file {} - {}".format(args.component_file, e))
+        return 1
+    groups = read_compfile(args.component_file, fmt)
+    if groups is None:
+        print("Cannot read component list file {}".format(args.component_file))
+        return 1
+    if args.list:
+        for package, versions in groups:
+            for version in versions:
+                print("{}/{}".format(package, version))
+    print("{}: {} format, {} packages, {} package versions".format(args.component_file, fmt, len(groups), sum(len(versions) for package, versions in groups)))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Process or import component list into project/version', prog='import_manifest')
+
+    subparsers = parser.add_subparsers(help='Choose operation mode', dest='command')
+    # create the parser for the "kblookup" command
+    parser_g = subparsers.add_parser('kblookup', help='Process component list to find matching KB URLs & export to file')
+    add_component_file_arguments(parser_g)
+    add_kbfile_argument(parser_g, False)
+    parser_g.add_argument('-o', '--output', help='Output file of KB component IDs matching manifest components (default "kblookup.out", or "kblookup-I-of-N.out" with --shard I/N)')
+    add_replace_arguments(parser_g)
+    parser_g.add_argument('--shard', help='Only look up the packages in shard I of N (I/N) - packages are assigned to shards by a hash of the package name, so N runs (in separate processes or on separate hosts) look up the whole component list; combine the output files with the merge command', type=parse_shard)
+    parser_g.add_argument('--previous', help='Previous component list file which the -k KB Lookup file was created from - only packages and versions added since the previous component list are looked up')
+    add_worker_arguments(parser_g)
+    add_request_arguments(parser_g)
+    add_server_arguments(parser_g)
+    parser_g.add_argument('--checkpoint', help='Checkpoint file used to resume an interrupted run (default OUTPUT.checkpoint)')
+    parser_g.add_argument('--restart', help='Ignore any existing checkpoint file and process the whole component list', action='store_true')
+    add_match_arguments(parser_g)
+    parser_g.add_argument('--offline', help='Do not connect to the Black Duck server - answer KB requests from the KB snapshot (--snapshot, required) and the KB response cache only', action='store_true')
+    add_cache_arguments(parser_g)
+    add_metrics_arguments(parser_g)
+
+    # create the parser for the "import" command
+    parser_i = subparsers.add_parser('import', help='Import component list into specified Black Duck project/version using KB URLs from supplied file')
+    add_component_file_arguments(parser_i)
+    add_kbfile_argument(parser_i, True)
+    add_project_arguments(parser_i)
+    add_delete_argument(parser_i)
+    parser_i.add_argument('--dry-run', help='Report the components which would be added to (and with -d deleted from) the project without changing it', action='store_true')
+    add_retries_argument(parser_i)
+    add_worker_arguments(parser_i)
+    add_request_arguments(parser_i)
+    add_server_arguments(parser_i)
+    add_cache_arguments(parser_i)
+    add_metrics_arguments(parser_i)
+
+    # create the parser for the "batch" command
+    parser_b = subparsers.add_parser('batch', help='Import the component lists in a job file into their project/versions in one run, sharing the KB Lookup file, Black Duck session and caches')
+    parser_b.add_argument('-j', '--jobfile', help='Job file with one COMPONENT_FILE;PROJECT;VERSION line per import', required=True)
+    add_component_file_arguments(parser_b, component_file=False)
+    add_kbfile_argument(parser_b, True)
+    parser_b.add_argument('-d', '--delete', help='Delete existing manual components not in the component list from each project version', action='store_true')
+    parser_b.add_argument('--dry-run', help='Report the components which would be added to (and with -d deleted from) each project version without changing it', action='store_true')
+    add_retries_argument(parser_b)
+    parser_b.add_argument('--jobs', help='Number of jobs to run concurrently (default 4)', type=int, default=4)
+    add_worker_arguments(parser_b)
+    add_request_arguments(parser_b)
+    add_server_arguments(parser_b)
+    add_cache_arguments(parser_b)
+    add_metrics_arguments(parser_b)
+
+    # create the parser for the "sync" command
+    parser_y = subparsers.add_parser('sync', help='Look up component list in the KB and import it into the project/version in one pass, also writing the KB Lookup file')
+    add_component_file_arguments(parser_y)
+    add_kbfile_argument(parser_y, False)
+    parser_y.add_argument('-o', '--output', help='Output file of KB component IDs matching manifest components (default "kblookup.out")', default='kblookup.out')
+    add_replace_arguments(parser_y)
+    add_project_arguments(parser_y)
+    add_delete_argument(parser_y)
+    add_retries_argument(parser_y)
+    add_worker_arguments(parser_y)
+    add_request_arguments(parser_y)
+    add_server_arguments(parser_y)
+    add_match_arguments(parser_y)
+    add_cache_arguments(parser_y)
+    add_metrics_arguments(parser_y)
+
+    # create the parser for the "plan" command
+    parser_p = subparsers.add_parser('plan', help='Preview an import offline using the project BOM saved by the last import and the KB cache')
+    add_component_file_arguments(parser_p)
+    add_kbfile_argument(parser_p, True)
+    add_project_arguments(parser_p)
+    parser_p.add_argument('-d', '--delete', help='Include the manual components which import -d would delete from the project', action='store_true')
+    add_worker_arguments(parser_p)
+    add_cache_arguments(parser_p)
+    add_metrics_arguments(parser_p)
+
+    # create the parser for the "serve" command
+    parser_d = subparsers.add_parser('serve', help='Run a local KB lookup service for kblookup and import modes (--server)')
+    parser_d.add_argument('--listen', help='Address to listen on - HOST:PORT or unix:PATH for a Unix socket (default {})'.format(lookup_service.DEFAULT_ADDRESS), default=lookup_service.DEFAULT_ADDRESS)
+    parser_d.add_argument('--max-requests', help='Maximum number of concurrent requests to the Black Duck server (default 4)', type=int, default=4)
+    add_match_arguments(parser_d)
+    parser_d.set_defaults(workers=1)
+    add_request_arguments(parser_d)
+    add_cache_arguments(parser_d)
+    add_metrics_arguments(parser_d)
+
+    # create the parsers for the offline KB Lookup file and component list file commands
+    parser_v = subparsers.add_parser('validate', help='Check KB Lookup files for entries which cannot be used or conflict')
+    parser_v.add_argument('kbfile', help='KB Lookup file', nargs='+')
+    parser_m = subparsers.add_parser('merge', help='Merge KB Lookup files (e.g. from kblookup --shard runs) into one KB Lookup file')
+    parser_m.add_argument('kbfile', help='Input KB Lookup file', nargs='+')
+    parser_m.add_argument('-o', '--output', help='Output KB Lookup file (entries are added to the file if it exists)', required=True)
+    parser_x = subparsers.add_parser('compile', help='Compile a KB Lookup file into the binary index which the other commands use in place of the file')
+    parser_x.add_argument('kbfile', help='KB Lookup file')
+    parser_x.add_argument('-o', '--output', help='Output index file (default KBFILE.idx - the index is only used by the other commands when it is KBFILE.idx)')
+    parser_e = subparsers.add_parser('export-snapshot', help='Write the KB responses and package mappings in the KB response cache to a KB snapshot file for other hosts (--snapshot or import-snapshot)')
+    parser_e.add_argument('-o', '--output', help='Output KB snapshot file', required=True)
+    parser_e.add_argument('-k', '--kbfile', help='KB Lookup file to add the matched package -> KB component mappings from (can be specified multiple times)', action='append')
+    parser_e.add_argument('--server-url', help='Only export responses from this Black Duck server URL (required if the cache holds responses from more than one server)')
+    parser_e.add_argument('--max-age', help='Only export responses read from the server in the last MAX_AGE hours', type=float)
+    add_cache_dir_argument(parser_e)
+    parser_n = subparsers.add_parser('import-snapshot', help='Add the KB responses and package mappings in a KB snapshot file to the KB response cache (the responses expire after the cache TTLs from the time of the import)')
+    parser_n.add_argument('snapshot', help='KB snapshot file')
+    add_cache_dir_argument(parser_n)
+    add_cache_size_argument(parser_n)
+    parser_s = subparsers.add_parser('stat', help='Report the number of packages, KB components and versions matched in KB Lookup files')
+    parser_s.add_argument('kbfile', help='KB Lookup file', nargs='+')
+    parser_c = subparsers.add_parser('parse', help='Read a component list file and report the packages and versions found')
+    add_component_file_arguments(parser_c)
+    parser_c.add_argument('-l', '--list', help='Print each package/version found', action='store_true')
+    return parser
+
+COMMANDS = {
+    'kblookup': run_kblookup,
+    'import': run_import,
+    'batch': run_batch,
+    'sync': run_sync,
+    'plan': run_plan,
+    'serve': run_serve,
+    'validate': run_validate,
+    'merge': run_merge,
+    'compile': run_compile,
+    'export-snapshot': run_export_snapshot,
+    'import-snapshot': run_import_snapshot,
+    'stat': run_stat,
+    'parse': run_parse,
+}
+
+def main(argv=None):
+    global args, api, transport, kbcache, kbsnapshot, lookup_client
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if not args.command:
+        parser.print_help()
+        return 0
+
+    if args.command in ('kblookup', 'import', 'batch', 'sync', 'plan', 'serve'):
+        if args.workers < 1:
+            parser.error("--workers must be 1 or more")
+        if getattr(args, 'jobs', 1) < 1:
+            parser.error("--jobs must be 1 or more")
+        if getattr(args, 'previous', None) and not args.kbfile:
+            parser.error("--previous requires the KB Lookup file created from the previous component list (-k)")
+        if getattr(args, 'offline', False) and not args.snapshot:
+            parser.error("--offline requires a KB snapshot (--snapshot)")
+        if getattr(args, 'offline', False) and args.server:
+            parser.error("--offline cannot be used with --server")
+        try:
+            kbcache = open_kbcache(args)
+        except ValueError as e:
+            parser.error("Invalid --cache-ttl value: {}".format(e))
+        if hasattr(args, 'rate_limit'):
+            # sync mode runs --workers lookup workers and --workers import workers at the same time, and batch mode
+            # runs --workers workers for each of --jobs jobs
+            max_requests = args.max_requests or args.workers * {'sync': 2, 'batch': getattr(args, 'jobs', 1)}.get(args.command, 1)
+            try:
+                endpoint_limits = request_layer.parse_endpoint_limits(args.endpoint_limit)
+            except ValueError as e:
+                parser.error("Invalid --endpoint-limit value: {}".format(e))
+            api = request_layer.RequestLayer(args.rate_limit or None, max_requests, endpoint_limits,
+                                             args.request_retries, args.breaker_threshold, args.breaker_cooldown,
+                                             api.reauth, api.record)
+            transport = hub_transport.HubTransport(max_requests, args.connect_timeout, args.read_timeout,
+                                                   not args.no_compression)
+        instrumentation.start_logging(LOG_FILE, args.log_level)
+        compmemo.maxsize = args.memo_size
+        if args.snapshot:
+            try:
+                kbsnapshot = kb_snapshot.KBSnapshot(args.snapshot)
+            except ValueError as e:
+                print("Cannot use KB snapshot - {}".format(e))
+                return 1
+            print("Using KB snapshot {} of {} created {}".format(args.snapshot, kbsnapshot.baseurl or "no server",
+                                                                 time.strftime("%Y-%m-%d %H:%M", time.localtime(kbsnapshot.created))))
+    if getattr(args, 'server', None):
+        try:
+            lookup_client = lookup_service.LookupClient(args.server)
+            lookup_client.status()
+        except (ValueError, lookup_service.LookupServiceError) as e:
+            print("Cannot use lookup server {} - {}".format(args.server, e))
+            return 1
+        print("Using lookup server {}".format(args.server))
+    return COMMANDS[args.command]()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#
+# Run metrics and logging for import_manifest.py
+#
+# Metrics - thread safe counters, gauges and timers which are written at the end of a run (--metrics-out)
+# as JSON or in the Prometheus text exposition format (e.g. for the node_exporter textfile collector).
+#
+# start_logging() - send log records through a queue to a file written by a background thread, so
+# threads doing KB lookups do not wait for log file writes.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PREFIX = "import_manifest"
+
+def start_logging(filename, level=logging.INFO):
+    logqueue = queue.SimpleQueue()
+    filehandler = logging.FileHandler(filename)
+    filehandler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(logqueue, filehandler)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(logqueue))
+    root.setLevel(level)
+    listener.start()
+    # Write any queued records before the process exits
+    atexit.register(listener.stop)
+    return listener
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, (label, value)...) -> count
+        self.gauges = {}    # (name, (label, value)...) -> value
+        self.timers = {}    # name -> [count, total seconds, max seconds]
+        self.start = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = (name,) + tuple(sorted((label, str(val)) for label, val in labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name,) + tuple(sorted((label, str(val)) for label, val in labels.items()))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def to_json(self):
+        def grouped(values):
+            result = {}
+            for key, value in sorted(values.items()):
+                name, labels = key[0], key[1:]
+                if labels:
+                    result.setdefault(name, []).append(dict(labels, value=value))
+                else:
+                    result[name] = value
+            return result
+
+        with self.lock:
+            return {
+                'elapsed_seconds': time.time() - self.start,
+                'counters': grouped(self.counters),
+                'gauges': grouped(self.gauges),
+                'timers': {name: {'count': count, 'total_seconds': total, 'mean_seconds': total / count if count else 0.0, 'max_seconds': maximum}
+                           for name, (count, total, maximum) in sorted(self.timers.items())},
+            }
+
+    def to_prometheus(self):
+        def series(name, labels, value):
+            labelstr = ",".join('{}="{}"'.format(label, val.replace('\\', '\\\\').replace('"', '\\"')) for label, val in labels)
+            return "{}_{}{} {}\n".format(METRICS_PREFIX, name, "{" + labelstr + "}" if labelstr else "", value)
+
+        lines = []
+        with self.lock:
+            for kind, values, suffix in (('counter', self.counters, '_total'), ('gauge', self.gauges, '')):
+                typed = set()
+                for key, value in sorted(values.items()):
+                    if key[0] not in typed:
+                        lines.append("# TYPE {}_{}{} {}\n".format(METRICS_PREFIX, key[0], suffix, kind))
+                        typed.add(key[0])
+                    lines.append(series(key[0] + suffix, key[1:], value))
+            if self.timers:
+                lines.append("# TYPE {}_duration_seconds summary\n".format(METRICS_PREFIX))
+                for name, (count, total, maximum) in sorted(self.timers.items()):
+                    lines.append(series("duration_seconds_sum", [('operation', name)], total))
+                    lines.append(series("duration_seconds_count", [('operation', name)], count))
+                lines.append("# TYPE {}_duration_seconds_max gauge\n".format(METRICS_PREFIX))
+                for name, (count, total, maximum) in sorted(self.timers.items()):
+                    lines.append(series("duration_seconds_max", [('operation', name)], maximum))
+            lines.append("# TYPE {}_elapsed_seconds gauge\n".format(METRICS_PREFIX))
+            lines.append(series("elapsed_seconds", [], time.time() - self.start))
+        return "".join(lines)
+
+    def write(self, path, fmt=None):
+        #
+        # Write metrics to path as 'json' or 'prometheus' (default from the file extension - .prom is Prometheus)
+        if fmt is None:
+            fmt = 'prometheus' if path.endswith(".prom") else 'json'
+        tmppath = path + ".tmp"
+        with open(tmppath, "w") as mfile:
+            if fmt == 'prometheus':
+                mfile.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), mfile, indent=2)
+        # Rename so a textfile collector never reads a partial file
+        os.replace(tmppath, path)
@@ -0,0 +1,305 @@
+#
+# Caches of Black Duck KB API responses used by import_manifest.py
+#
+# KBCache - persistent on-disk cache. Responses to the KB search, component and component version
+# list endpoints are stored in a SQLite database in the cache directory keyed by request URL. Each
+# endpoint has its own TTL and the least recently used entries are evicted once the database exceeds
+# the size limit. The database also holds the local package name -> KB component mappings confirmed by
+# previous kblookup runs, which are used to rank KB search results.
+#
+# LRUCache - bounded in-memory cache of parsed objects (e.g. KB components and their version lists)
+# for the duration of one run.
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".import_manifest_cache")
+DEFAULT_CACHE_SIZE = 500    # MB
+DEFAULT_MEMO_SIZE = 2000    # Components held in memory
+LOCK_TIMEOUT = 30           # Seconds to wait for another process writing to the cache database
+ACCESS_FLUSH_SIZE = 1000    # Cache hits held before their access times are written to the database
+ACCESS_FLUSH_INTERVAL = 60  # Seconds after which the access times of cache hits are written to the database
+#
+# Default TTL (hours) per cached endpoint
+DEFAULT_TTLS = {
+    'search': 24,
+    'component': 7 * 24,
+    'versions': 24,
+}
+
+def url_endpoint(url):
+    #
+    # Return the cached endpoint type for a KB URL (or None if the URL should not be cached)
+    if "/api/search/components" in url:
+        return 'search'
+    if re.search(r'/api/components/[^/?]+/versions', url):
+        if re.search(r'/versions/[^/?]+', url):
+            return 'component'
+        return 'versions'
+    if "/api/components/" in url:
+        return 'component'
+    return None
+
+def parse_ttls(values):
+    #
+    # Convert list of --cache-ttl arguments ("HOURS" or "ENDPOINT=HOURS") to a TTL dict
+    ttls = dict(DEFAULT_TTLS)
+    for value in values or []:
+        if "=" in value:
+            endpoint, hours = value.split("=", 1)
+            if endpoint not in DEFAULT_TTLS:
+                raise ValueError("Unknown cache endpoint '{}' (use one of {})".format(
+                    endpoint, ", ".join(sorted(DEFAULT_TTLS))))
+            ttls[endpoint] = float(hours)
+        else:
+            for endpoint in ttls:
+                ttls[endpoint] = float(value)
+    return ttls
+
+class CachedResponse:
+    #
+    # Minimal stand-in for requests.Response returned for cache hits
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def json(self):
+        return json.loads(self.content)
+
+class KBCache:
+    def __init__(self, cachedir=DEFAULT_CACHE_DIR, ttls=None, max_size=DEFAULT_CACHE_SIZE * 1024 * 1024):
+        os.makedirs(cachedir, exist_ok=True)
+        self.path = os.path.join(cachedir, "kbcache.sqlite")
+        self.ttls = ttls or dict(DEFAULT_TTLS)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}      # URL -> time of cache hits not yet written to the database
+        self.flushed = time.time()  # Time the access times were last written
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # fetched is when the response was read from the server, stored when it was added to this cache (the TTLs
+        # start from stored, which is later than fetched for responses imported from a KB snapshot)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        "url TEXT PRIMARY KEY, endpoint TEXT, fetched REAL, stored REAL, accessed REAL, size INTEGER, body BLOB)")
+        if "stored" not in [row[1] for row in self.db.execute("PRAGMA table_info(responses)")]:
+            # Cache written by an earlier version
+            self.db.execute("ALTER TABLE responses ADD COLUMN stored REAL")
+            self.db.execute("UPDATE responses SET stored = fetched")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS mappings ("
+                        "package TEXT, compurl TEXT, confirmed REAL, PRIMARY KEY (package, compurl))")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        endpoint = url_endpoint(url)
+        if not endpoint:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT stored, body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None or now - row[0] > self.ttls.get(endpoint, 0) * 3600:
+                self.misses += 1
+                return None
+            # The access time is written with the next change (so a hit does not hold a write lock on the database),
+            # or after ACCESS_FLUSH_SIZE hits or ACCESS_FLUSH_INTERVAL seconds (e.g. in serve mode, which mostly gets hits)
+            self.accessed[url] = now
+            self.hits += 1
+            if len(self.accessed) >= ACCESS_FLUSH_SIZE or now - self.flushed >= ACCESS_FLUSH_INTERVAL:
+                self._flush_accessed()
+        logging.debug("KBCache: hit %s", url)
+        return CachedResponse(zlib.decompress(row[1]))
+
+    def put(self, url, content):
+        endpoint = url_endpoint(url)
+        if not endpoint:
+            return
+        body = zlib.compress(content)
+        now = time.time()
+        with self.lock:
+            try:
+                old = self.db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO responses (url, endpoint, fetched, stored, accessed, size, body) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", (url, endpoint, now, now, now, len(body), body))
+                self._write_accessed()
+                self.size += len(body) - (old[0] if old else 0)
+                if self.size > self.max_size:
+                    self._evict()
+                self.db.commit()
+            except sqlite3.Error:
+                # Do not leave a write transaction open (it would lock the cache for other processes)
+                self.db.rollback()
+                raise
+
+    def _write_accessed(self):
+        #
+        # Write the access times of the cache hits since the last change (called with the lock held)
+        if self.accessed:
+            self.db.executemany("UPDATE responses SET accessed = ? WHERE url = ?", [(now, url) for url, now in self.accessed.items()])
+            self.accessed = {}
+        self.flushed = time.time()
+
+    def _flush_accessed(self):
+        #
+        # Write and commit the access times of the cache hits (called with the lock held) - if the database cannot be
+        # written they are dropped, as they are only used to choose the entries evicted
+        try:
+            self._write_accessed()
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.db.rollback()
+            self.accessed = {}
+            self.flushed = time.time()
+            logging.debug("KBCache: access times not written - %s", e)
+
+    def _evict(self):
+        #
+        # Remove expired entries, then least recently used entries until under 90% of the size limit
+        now = time.time()
+        for endpoint, ttl in self.ttls.items():
+            self.db.execute("DELETE FROM responses WHERE endpoint = ? AND stored < ?", (endpoint, now - ttl * 3600))
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self.max_size * 0.9
+        if self.size > target:
+            cursor = self.db.execute("SELECT url, size FROM responses ORDER BY accessed")
+            remove = []
+            for url, size in cursor:
+                if self.size <= target:
+                    break
+                remove.append((url,))
+                self.size -= size
+            self.db.executemany("DELETE FROM responses WHERE url = ?", remove)
+        logging.debug("KBCache: evicted entries, cache size now %d bytes", self.size)
+
+    def confirm(self, package, compurl):
+        #
+        # Record that the local package name was matched to the KB component URL
+        with self.lock:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO mappings (package, compurl, confirmed) VALUES (?, ?, ?)",
+                                (package, compurl, time.time()))
+                self._write_accessed()
+                self.db.commit()
+            except sqlite3.Error:
+                self.db.rollback()
+                raise
+
+    def mappings(self):
+        #
+        # Return dict of package name -> set of confirmed KB component URLs
+        result = {}
+        with self.lock:
+            for package, compurl in self.db.execute("SELECT package, compurl FROM mappings"):
+                result.setdefault(package, set()).add(compurl)
+        return result
+
+    def dump(self):
+        #
+        # Return list of (url, endpoint, fetched, compressed body) for all cached responses, and list of
+        # (package, compurl, confirmed) for all mappings (used by kb_snapshot.export_snapshot())
+        with self.lock:
+            responses = self.db.execute("SELECT url, endpoint, fetched, body FROM responses").fetchall()
+            mappings = self.db.execute("SELECT package, compurl, confirmed FROM mappings").fetchall()
+        return responses, mappings
+
+    def load(self, responses, mappings):
+        #
+        # Add responses ((url, endpoint, fetched, compressed body)) and mappings ((package, compurl, confirmed)),
+        # keeping the cached response or mapping where it is newer (used by kb_snapshot.import_snapshot())
+        # The responses added keep the time they were read from the server (fetched), but their TTLs start from the
+        # import (stored), as the snapshot may be older than the TTLs
+        # Returns the numbers of responses and mappings added or updated
+        added = confirmed = 0
+        now = time.time()
+        with self.lock:
+            for url, endpoint, fetched, body in responses:
+                old = self.db.execute("SELECT fetched, size FROM responses WHERE url = ?", (url,)).fetchone()
+                if old and old[0] >= fetched:
+                    continue
+                self.db.execute("INSERT OR REPLACE INTO responses (url, endpoint, fetched, stored, accessed, size, body) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", (url, endpoint, fetched, now, now, len(body), body))
+                self.size += len(body) - (old[1] if old else 0)
+                added += 1
+            for package, compurl, when in mappings:
+                old = self.db.execute("SELECT confirmed FROM mappings WHERE package = ? AND compurl = ?", (package, compurl)).fetchone()
+                if old and old[0] >= when:
+                    continue
+                self.db.execute("INSERT OR REPLACE INTO mappings (package, compurl, confirmed) VALUES (?, ?, ?)",
+                                (package, compurl, when))
+                confirmed += 1
+            if self.size > self.max_size:
+                self._evict()
+            self.db.commit()
+        return added, confirmed
+
+    def close(self):
+        with self.lock:
+            self._write_accessed()
+            self.db.commit()
+            self.db.close()
+
+    def report(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return "KB cache: no lookups"
+        return "KB cache: {} hits, {} misses ({:.1f}% hit rate), {:.1f} MB in {}".format(
+            self.hits, self.misses, 100.0 * self.hits / total, self.size / (1024 * 1024), self.path)
+
+class LRUCache:
+    def __init__(self, name, maxsize=DEFAULT_MEMO_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.loading = {}   # Key -> threading.Event for keys being loaded by another thread
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        #
+        # Return the cached value for key, or call loader() to create it. Concurrent requests for
+        # the same key wait for the first loader instead of loading it again. None is not cached.
+        while True:
+            with self.lock:
+                if key in self.data:
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return self.data[key]
+                event = self.loading.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.loading[key] = event
+                    self.misses += 1
+                    break
+            # Wait for the other loader, then check again (it may have failed or been evicted)
+            event.wait()
+
+        try:
+            value = loader()
+            if value is not None:
+                with self.lock:
+                    self.data[key] = value
+                    while len(self.data) > self.maxsize:
+                        self.data.popitem(last=False)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def report(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return "{}: no lookups".format(self.name)
+        return "{}: {} hits, {} misses ({:.1f}% hit rate), {} entries held".format(
+            self.name, self.hits, self.misses, 100.0 * self.hits / total, len(self.data))
@@ -0,0 +1,331 @@
+#
+# Compiled binary index of a KB Lookup file (kbfile), used by import_manifest.py instead of reading the text kbfile into
+# dicts when the kbfile is very large (e.g. an organisation-wide kbfile with hundreds of thousands of entries)
+#
+# compile_index() writes the index (by default KBFILE.idx - see the compile mode of import_manifest.py) and KBIndex
+# opens it with mmap, so only the pages holding the entries looked up are read. The index holds the same information
+# as the kblookupdict (package -> KB component URLs) and kbverdict ('package/version' -> KB version URL) built by
+# import_kbfile():
+#   - strings (package names, version strings, URL prefixes) are stored once, as a 2 byte length and UTF-8 bytes
+#   - KB URLs of the form PREFIX/api/components/UUID[/versions/UUID] are stored as the prefix string and the UUIDs
+#     packed as 16 byte values (other URLs are stored as strings)
+#   - packages and 'package/version' keys are found through open addressing hash tables (CRC32 of the key)
+# The header records the size and modification time of the kbfile, so an index which is out of date is not used.
+
+import logging
+import mmap
+import os
+import re
+import struct
+import uuid
+import zlib
+
+import kb_store
+
+MAGIC = b"KBINDEX1"
+HEADER = struct.Struct("<8sQQ12I")      # magic, kbfile size, kbfile mtime (ns), counts, table sizes and section offsets
+PACKAGE = struct.Struct("<III")         # name string, first component record, number of component records
+COMPONENT = struct.Struct("<BI16s")     # URL kind, prefix (or URL) string, component UUID
+VERSION = struct.Struct("<IIBI16s16s")  # package record, version string, URL kind, prefix (or URL) string, component UUID, version UUID
+SLOT = struct.Struct("<I")              # record number + 1 (0 for an empty slot)
+
+URL_PACKED = 0          # PREFIX/api/components/UUID[/versions/UUID]
+URL_STRING = 1          # Any other URL, stored as a string
+URL_NO_MATCH = 2        # "NO VERSION MATCH"
+
+KB_URL_RE = re.compile(r'^(.*)/api/components/([0-9a-f-]{36})(?:/versions/([0-9a-f-]{36}))?$')
+
+def index_path(kbfile):
+    return kbfile + ".idx"
+
+def key_hash(key):
+    return zlib.crc32(key)
+
+def table_size(count):
+    #
+    # Power of 2 number of hash table slots, at most half full
+    size = 8
+    while size < count * 2:
+        size *= 2
+    return size
+
+def pack_uuid(value):
+    #
+    # Return the 16 byte UUID, or None if value is not a UUID in the canonical lower case form (so it is stored exactly)
+    try:
+        packed = uuid.UUID(value)
+    except ValueError:
+        return None
+    return packed.bytes if str(packed) == value else None
+
+class IndexWriter:
+    def __init__(self):
+        self.strings = bytearray()
+        self.string_offsets = {}
+
+    def string(self, value):
+        #
+        # Return the offset of the interned string value
+        offset = self.string_offsets.get(value)
+        if offset is None:
+            data = value.encode('utf-8')
+            if len(data) > 0xffff:
+                raise ValueError("string too long for the index ({} bytes)".format(len(data)))
+            offset = len(self.strings)
+            self.strings += struct.pack("<H", len(data)) + data
+            self.string_offsets[value] = offset
+        return offset
+
+    def url(self, value, version):
+        #
+        # Return (kind, prefix or URL string, component UUID, version UUID) for a KB component (or version) URL
+        if version and value == "NO VERSION MATCH":
+            return URL_NO_MATCH, 0, b"\0" * 16, b"\0" * 16
+        match = KB_URL_RE.match(value)
+        if match and (match.group(3) is not None) == version:
+            compuuid = pack_uuid(match.group(2))
+            veruuid = pack_uuid(match.group(3)) if version else b"\0" * 16
+            if compuuid and veruuid:
+                return URL_PACKED, self.string(match.group(1)), compuuid, veruuid
+        return URL_STRING, self.string(value), b"\0" * 16, b"\0" * 16
+
+def hash_table(keys):
+    #
+    # Return the slots of an open addressing hash table of keys (list of bytes, record number = position in keys)
+    size = table_size(len(keys))
+    slots = [0] * size
+    for record, key in enumerate(keys):
+        slot = key_hash(key) & (size - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (size - 1)
+        slots[slot] = record + 1
+    return slots
+
+def compile_index(kbfile, indexfile=None):
+    #
+    # Build the binary index of kbfile, with the same content as import_kbfile() reads: the KB component URLs of
+    # each package (kbfile order, NO MATCH entries skipped) and the KB version URL of each package/version (the
+    # last entry in the kbfile wins)
+    # Returns dict of the numbers of packages, components and versions and the index file size
+    indexfile = indexfile or index_path(kbfile)
+    stat = os.stat(kbfile)
+    components = {}     # package -> [KB component URL, ...]
+    versions = {}       # (package, version) -> KB version URL
+    with open(kbfile, "r") as kfile:
+        for line in kfile:
+            entry = kb_store.parse_kbfile_line(line)
+            if entry is None or entry[3] == "NO MATCH":
+                continue
+            components.setdefault(entry[0], []).append(entry[3])
+            for version, verurl in entry[4]:
+                versions.pop((entry[0], version), None)
+                versions[(entry[0], version)] = verurl
+
+    writer = IndexWriter()
+    packages = list(components)
+    package_numbers = {}
+    package_records = []
+    component_records = []
+    for number, package in enumerate(packages):
+        package_numbers[package] = number
+        package_records.append(PACKAGE.pack(writer.string(package), len(component_records), len(components[package])))
+        for compurl in components[package]:
+            kind, string, compuuid, veruuid = writer.url(compurl, False)
+            component_records.append(COMPONENT.pack(kind, string, compuuid))
+    version_keys = []
+    version_records = []
+    for (package, version), verurl in versions.items():
+        kind, string, compuuid, veruuid = writer.url(verurl, True)
+        version_records.append(VERSION.pack(package_numbers[package], writer.string(version), kind, string, compuuid, veruuid))
+        version_keys.append("{}/{}".format(package, version).encode('utf-8'))
+    package_slots = hash_table([package.encode('utf-8') for package in packages])
+    version_slots = hash_table(version_keys)
+
+    sections = [bytes(writer.strings), b"".join(package_records), b"".join(component_records), b"".join(version_records),
+                struct.pack("<{}I".format(len(package_slots)), *package_slots),
+                struct.pack("<{}I".format(len(version_slots)), *version_slots)]
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    header = HEADER.pack(MAGIC, stat.st_size, stat.st_mtime_ns, len(packages), len(component_records), len(version_records),
+                         len(package_slots), len(version_slots), len(writer.strings), *offsets)
+    tmpfile = indexfile + ".tmp"
+    with open(tmpfile, "wb") as ifile:
+        ifile.write(header)
+        for section in sections:
+            ifile.write(section)
+    os.replace(tmpfile, indexfile)
+    return {
+        'packages': len(packages),
+        'components': len(component_records),
+        'versions': len(version_records),
+        'strings': len(writer.string_offsets),
+        'size': offset,
+    }
+
+class KBIndex:
+    def __init__(self, path):
+        with open(path, "rb") as ifile:
+            self.mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.source_size, self.source_mtime, self.npackages, self.ncomponents, self.nversions, self.package_slots,
+         self.version_slots, stringsize, self.off_strings, self.off_packages, self.off_components, self.off_versions,
+         self.off_package_slots, self.off_version_slots) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError("{} is not a KB Lookup file index".format(path))
+        self.path = path
+        self.packages = PackageView(self)
+        self.versions = VersionView(self)
+
+    def is_current(self, kbfile):
+        #
+        # True if the index was compiled from kbfile as it is now
+        stat = os.stat(kbfile)
+        return stat.st_size == self.source_size and stat.st_mtime_ns == self.source_mtime
+
+    def string_bytes(self, offset):
+        offset += self.off_strings
+        length, = struct.unpack_from("<H", self.mm, offset)
+        return self.mm[offset + 2:offset + 2 + length]
+
+    def string(self, offset):
+        return self.string_bytes(offset).decode('utf-8')
+
+    def url(self, kind, string, compuuid, veruuid=None):
+        if kind == URL_NO_MATCH:
+            return "NO VERSION MATCH"
+        if kind == URL_STRING:
+            return self.string(string)
+        url = "{}/api/components/{}".format(self.string(string), uuid.UUID(bytes=compuuid))
+        if veruuid is not None:
+            url += "/versions/{}".format(uuid.UUID(bytes=veruuid))
+        return url
+
+    def find(self, key, slots, offset, matches):
+        #
+        # Return the record number for key in the hash table (slots entries at offset), or None
+        slot = key_hash(key) & (slots - 1)
+        while True:
+            record, = SLOT.unpack_from(self.mm, offset + slot * SLOT.size)
+            if record == 0:
+                return None
+            if matches(record - 1, key):
+                return record - 1
+            slot = (slot + 1) & (slots - 1)
+
+    def package(self, number):
+        return PACKAGE.unpack_from(self.mm, self.off_packages + number * PACKAGE.size)
+
+    def package_name(self, number):
+        return self.string(self.package(number)[0])
+
+    def package_key(self, number):
+        return self.string_bytes(self.package(number)[0])
+
+    def package_urls(self, number):
+        name, first, count = self.package(number)
+        urls = []
+        for record in range(first, first + count):
+            kind, string, compuuid = COMPONENT.unpack_from(self.mm, self.off_components + record * COMPONENT.size)
+            urls.append(self.url(kind, string, compuuid))
+        return urls
+
+    def find_package(self, package):
+        return self.find(package.encode('utf-8'), self.package_slots, self.off_package_slots,
+                         lambda number, key: self.package_key(number) == key)
+
+    def version_record(self, number):
+        return VERSION.unpack_from(self.mm, self.off_versions + number * VERSION.size)
+
+    def version_key(self, number):
+        package, version = self.version_record(number)[:2]
+        return self.package_key(package) + b"/" + self.string_bytes(version)
+
+    def find_version(self, packstr):
+        number = self.find(packstr.encode('utf-8'), self.version_slots, self.off_version_slots,
+                           lambda number, key: self.version_key(number) == key)
+        if number is None:
+            return None
+        package, version, kind, string, compuuid, veruuid = self.version_record(number)
+        return self.url(kind, string, compuuid, veruuid)
+
+    def close(self):
+        self.mm.close()
+
+class PackageView:
+    #
+    # Read only dict-like view of package -> [KB component URL, ...] (used as kblookupdict)
+    def __init__(self, index):
+        self.index = index
+
+    def __contains__(self, package):
+        return self.index.find_package(package) is not None
+
+    def __getitem__(self, package):
+        number = self.index.find_package(package)
+        if number is None:
+            raise KeyError(package)
+        return self.index.package_urls(number)
+
+    def get(self, package, default=None):
+        number = self.index.find_package(package)
+        return default if number is None else self.index.package_urls(number)
+
+    def items(self):
+        for number in range(self.index.npackages):
+            yield self.index.package_name(number), self.index.package_urls(number)
+
+    def __len__(self):
+        return self.index.npackages
+
+class VersionView:
+    #
+    # Dict-like view of 'package/version' -> KB version URL (used as kbverdict) - versions set during the run are
+    # held in memory and override the index
+    def __init__(self, index):
+        self.index = index
+        self.added = {}
+
+    def get(self, packstr, default=None):
+        if packstr in self.added:
+            return self.added[packstr]
+        verurl = self.index.find_version(packstr)
+        return default if verurl is None else verurl
+
+    def __contains__(self, packstr):
+        return self.get(packstr) is not None
+
+    def __getitem__(self, packstr):
+        verurl = self.get(packstr)
+        if verurl is None:
+            raise KeyError(packstr)
+        return verurl
+
+    def __setitem__(self, packstr, verurl):
+        self.added[packstr] = verurl
+
+    def __len__(self):
+        return self.index.nversions + len(self.added)
+
+def open_index(kbfile):
+    #
+    # Return the KBIndex for kbfile if its index file exists and is up to date, otherwise None
+    path = index_path(kbfile)
+    if not os.path.exists(path):
+        return None
+    try:
+        index = KBIndex(path)
+    except (OSError, ValueError, struct.error) as e:
+        logging.error("open_index(): Cannot open {} - {}".format(path, e))
+        return None
+    try:
+        current = index.is_current(kbfile)
+    except OSError:
+        current = False
+    if not current:
+        print("KB Lookup file index {} is out of date - reading {} (run compile to update the index)".format(path, kbfile))
+        index.close()
+        return None
+    return index
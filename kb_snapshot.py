@@ -0,0 +1,188 @@
+#
+# KB match snapshots for import_manifest.py
+#
+# A snapshot is a single SQLite file holding the KB search, component and component version list responses and the
+# confirmed package name -> KB component mappings from a KB response cache (see kb_cache.py), so the KB data collected
+# by one team's kblookup runs can be shared with other teams and with hosts which cannot connect to the Black Duck
+# server. Response bodies are stored zlib compressed (as in the KB cache) and the file is compacted when written.
+#
+# export_snapshot() writes a snapshot from the KB cache (export-snapshot mode), import_snapshot() adds a snapshot to
+# the KB cache (import-snapshot mode), and KBSnapshot answers KB requests from a snapshot file (--snapshot) before
+# the KB cache and the Black Duck server are used.
+#
+# The meta table records the snapshot format and version, the Black Duck server the responses were read from, and
+# when the snapshot was created. Snapshots with a newer format version are not read.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.request import pathname2url
+
+import kb_cache
+import kb_store
+
+FORMAT_NAME = "import_manifest-kb-snapshot"
+FORMAT_VERSION = 1
+
+def server_url(url):
+    #
+    # Return the Black Duck server URL (e.g. https://hub.example.com) of an API URL
+    return url.split("/api/", 1)[0]
+
+def kbfile_mappings(kbfile, confirmed):
+    #
+    # Return list of (package, compurl, confirmed) for the kbfile entries with at least one matched version
+    mappings = []
+    with open(kbfile, "r") as kfile:
+        for line in kfile:
+            entry = kb_store.parse_kbfile_line(line)
+            if entry and entry[3] != "NO MATCH" and any(verurl != "NO VERSION MATCH" for version, verurl in entry[4]):
+                mappings.append((entry[0], entry[3], confirmed))
+    return mappings
+
+def export_snapshot(kbcache, path, baseurl=None, max_age=None, kbfiles=None):
+    #
+    # Write the responses and mappings in kbcache (only those for the server baseurl, and read in the last max_age
+    # hours, if specified) and the mappings from kbfiles to the snapshot file path
+    # Returns dict of the server URL, numbers of responses (by endpoint) and mappings, and the snapshot file size
+    # Raises ValueError if the cache holds responses from more than one server and baseurl is not specified
+    responses, mappings = kbcache.dump()
+    if baseurl:
+        baseurl = baseurl.rstrip("/")
+        responses = [row for row in responses if server_url(row[0]) == baseurl]
+        mappings = [row for row in mappings if server_url(row[1]) == baseurl]
+    else:
+        servers = sorted(set(server_url(row[0]) for row in responses))
+        if len(servers) > 1:
+            raise ValueError("the KB cache holds responses from {} - specify the server to export".format(", ".join(servers)))
+        baseurl = servers[0] if servers else ""
+    if max_age is not None:
+        oldest = time.time() - max_age * 3600
+        responses = [row for row in responses if row[2] >= oldest]
+    for kbfile in kbfiles or []:
+        mappings += [row for row in kbfile_mappings(kbfile, os.path.getmtime(kbfile))
+                     if not baseurl or server_url(row[1]) == baseurl]
+
+    tmppath = path + ".tmp"
+    if os.path.exists(tmppath):
+        os.remove(tmppath)
+    db = sqlite3.connect(tmppath)
+    try:
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE responses (url TEXT PRIMARY KEY, endpoint TEXT, fetched REAL, body BLOB)")
+        db.execute("CREATE TABLE mappings (package TEXT, compurl TEXT, confirmed REAL, PRIMARY KEY (package, compurl))")
+        db.executemany("INSERT OR REPLACE INTO responses (url, endpoint, fetched, body) VALUES (?, ?, ?, ?)", responses)
+        # The latest confirmation of each mapping is kept
+        db.executemany("INSERT OR REPLACE INTO mappings (package, compurl, confirmed) VALUES (?, ?, ?)", sorted(mappings, key=lambda row: row[2]))
+        meta = {
+            'format': FORMAT_NAME,
+            'version': str(FORMAT_VERSION),
+            'created': str(time.time()),
+            'baseurl': baseurl,
+        }
+        db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", meta.items())
+        counts = dict(db.execute("SELECT endpoint, COUNT(*) FROM responses GROUP BY endpoint").fetchall())
+        nmappings = db.execute("SELECT COUNT(*) FROM mappings").fetchone()[0]
+        db.commit()
+        db.execute("VACUUM")
+    finally:
+        db.close()
+    os.replace(tmppath, path)
+    return {
+        'baseurl': baseurl,
+        'responses': counts,
+        'mappings': nmappings,
+        'size': os.path.getsize(path),
+    }
+
+class KBSnapshot:
+    def __init__(self, path):
+        #
+        # Open the snapshot file read only - raises ValueError if it is not a snapshot this version can read
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isfile(path):
+            raise ValueError("{} does not exist".format(path))
+        try:
+            self.db = sqlite3.connect("file:{}?mode=ro".format(pathname2url(os.path.abspath(path))), uri=True, check_same_thread=False)
+            meta = dict(self.db.execute("SELECT key, value FROM meta").fetchall())
+        except sqlite3.DatabaseError as e:
+            raise ValueError("{} is not a KB snapshot - {}".format(path, e))
+        if meta.get('format') != FORMAT_NAME:
+            self.db.close()
+            raise ValueError("{} is not a KB snapshot".format(path))
+        if int(meta.get('version', 0)) > FORMAT_VERSION:
+            self.db.close()
+            raise ValueError("{} has snapshot format version {} - this version of import_manifest.py reads version {}".format(
+                path, meta['version'], FORMAT_VERSION))
+        self.baseurl = meta.get('baseurl', "")
+        self.created = float(meta.get('created', 0))
+
+    def get(self, url):
+        #
+        # Return the snapshot response for the KB URL as a kb_cache.CachedResponse, or None (snapshot responses do not
+        # expire - the snapshot is chosen for the run)
+        if not kb_cache.url_endpoint(url):
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        logging.debug("KBSnapshot: hit %s", url)
+        return kb_cache.CachedResponse(zlib.decompress(row[0]))
+
+    def mappings(self):
+        #
+        # Return dict of package name -> set of confirmed KB component URLs
+        result = {}
+        with self.lock:
+            for package, compurl in self.db.execute("SELECT package, compurl FROM mappings"):
+                result.setdefault(package, set()).add(compurl)
+        return result
+
+    def dump(self):
+        #
+        # Return the responses and mappings in the form used by kb_cache.KBCache.load()
+        with self.lock:
+            responses = self.db.execute("SELECT url, endpoint, fetched, body FROM responses").fetchall()
+            mappings = self.db.execute("SELECT package, compurl, confirmed FROM mappings").fetchall()
+        return responses, mappings
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def report(self):
+        total = self.hits + self.misses
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(self.created))
+        if total == 0:
+            return "KB snapshot: no lookups ({} created {})".format(self.path, created)
+        return "KB snapshot: {} hits, {} misses ({:.1f}% hit rate) from {} created {}".format(
+            self.hits, self.misses, 100.0 * self.hits / total, self.path, created)
+
+def import_snapshot(kbcache, path):
+    #
+    # Add the responses and mappings of the snapshot file to kbcache (keeping cached responses and mappings which are
+    # newer - the cache TTLs of the responses added start from the import) - raises ValueError if the file is not a
+    # snapshot this version can read
+    # Returns dict of the numbers of responses and mappings in the snapshot, and added to the cache
+    snapshot = KBSnapshot(path)
+    try:
+        responses, mappings = snapshot.dump()
+    finally:
+        snapshot.close()
+    added, confirmed = kbcache.load(responses, mappings)
+    return {
+        'baseurl': snapshot.baseurl,
+        'responses': len(responses),
+        'mappings': len(mappings),
+        'responses_added': added,
+        'mappings_added': confirmed,
+    }
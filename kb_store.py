@@ -0,0 +1,337 @@
+#
+# Indexed store for the output KB Lookup file (kbfile) written by import_manifest.py kblookup mode
+#
+# The kbfile entries are held in memory with an index of (local component name, KB component URL)
+# to entries. New entries and version updates are appended to a journal file (<kbfile>.journal)
+# as they are made, and the kbfile itself is rewritten atomically (write to a temporary file then
+# rename) periodically and when the store is closed. If a run is killed, the journal is replayed
+# the next time the kbfile is opened so no matches are lost and the kbfile is never left half written.
+#
+# Adding an entry or version which is already in the kbfile has no effect, so results can safely be
+# applied again when an interrupted run is resumed.
+#
+# The kbfile remains in the semicolon separated text format so it can be reviewed and edited manually:
+#   Local component name;KB component name;KB component source URL;KB component URL;[Local version;KB version URL;]...
+
+import json
+import logging
+import os
+
+COMPACT_INTERVAL = 1000     # Journal records between rewrites of the kbfile
+
+def parse_kbfile_line(line):
+    #
+    # Split a kbfile line into [package, compname, sourceurl, compurl, [(version, verurl), ...]]
+    # Returns None for lines which are not kbfile entries (e.g. blank lines)
+    elements = line.rstrip("\r\n").split(";")
+    if len(elements) < 4:
+        return None
+    verurls = []
+    index = 4
+    while index < len(elements) - 1:
+        verurls.append((elements[index], elements[index + 1]))
+        index += 2
+    return [elements[0], elements[1], elements[2], elements[3], verurls]
+
+def format_kbfile_entry(entry):
+    package, compname, sourceurl, compurl, verurls = entry
+    return "{};{};{};{};{}\n".format(package, compname, sourceurl, compurl,
+                                     "".join(["{};{};".format(version, verurl) for version, verurl in verurls]))
+
+def validate_kbfile(path):
+    #
+    # Check the kbfile for lines which import_manifest.py cannot use or which conflict with other lines
+    # Returns list of (line number, problem)
+    problems = []
+    seen = {}       # (package, compurl) -> first line number
+    verurls = {}    # package/version -> (KB version URL, line number)
+    with open(path, "r") as kfile:
+        for lineno, line in enumerate(kfile, 1):
+            if not line.strip():
+                continue
+            entry = parse_kbfile_line(line)
+            if entry is None:
+                problems.append((lineno, "fewer than 4 fields"))
+                continue
+            package, compname, sourceurl, compurl, versions = entry
+            if not package:
+                problems.append((lineno, "no local component name"))
+            if compurl != "NO MATCH" and "/api/components/" not in compurl:
+                problems.append((lineno, "KB component URL '{}' is not NO MATCH or a KB component URL".format(compurl)))
+            fields = line.rstrip("\r\n").rstrip(";").split(";")
+            if len(fields) > 4 and len(fields) % 2:
+                problems.append((lineno, "local version '{}' with no KB version URL".format(fields[-1])))
+            if (package, compurl) in seen:
+                problems.append((lineno, "duplicate entry for {} {} (first on line {})".format(package, compurl, seen[(package, compurl)])))
+            else:
+                seen[(package, compurl)] = lineno
+            for version, verurl in versions:
+                if verurl in ("NO VERSION MATCH", ""):
+                    continue
+                if compurl == "NO MATCH" or not verurl.startswith(compurl + "/versions/"):
+                    problems.append((lineno, "KB version URL for version '{}' is not a version of {}".format(version, compurl)))
+                previous = verurls.setdefault(package + "/" + version, (verurl, lineno))
+                if previous[0] != verurl:
+                    problems.append((lineno, "version '{}' matched to a different KB version on line {}".format(version, previous[1])))
+    return problems
+
+def kbfile_stats(path):
+    #
+    # Return dict of counts of the entries, packages, KB components and version matches in the kbfile
+    stats = {'entries': 0, 'packages': 0, 'packages_no_match': 0, 'packages_multiple_components': 0,
+             'components': 0, 'versions_matched': 0, 'versions_no_match': 0}
+    packages = {}   # package -> set of KB component URLs
+    with open(path, "r") as kfile:
+        for line in kfile:
+            entry = parse_kbfile_line(line)
+            if entry is None:
+                continue
+            stats['entries'] += 1
+            packages.setdefault(entry[0], set()).add(entry[3])
+            for version, verurl in entry[4]:
+                if verurl == "NO VERSION MATCH":
+                    stats['versions_no_match'] += 1
+                else:
+                    stats['versions_matched'] += 1
+    components = set()
+    for compurls in packages.values():
+        compurls.discard("NO MATCH")
+        components.update(compurls)
+        if not compurls:
+            stats['packages_no_match'] += 1
+        elif len(compurls) > 1:
+            stats['packages_multiple_components'] += 1
+    stats['packages'] = len(packages)
+    stats['components'] = len(components)
+    return stats
+
+def kbfile_versions(path):
+    #
+    # Return dict of package -> set of local versions recorded in the kbfile (matched or NO VERSION MATCH)
+    versions = {}
+    with open(path, "r") as kfile:
+        for line in kfile:
+            entry = parse_kbfile_line(line)
+            if entry:
+                versions.setdefault(entry[0], set()).update(version for version, verurl in entry[4])
+    return versions
+
+class KBFileStore:
+    def __init__(self, path):
+        self.path = path
+        self.journalpath = path + ".journal"
+        self.entries = []   # [entry, raw line or None if modified] in kbfile order
+        self.index = {}     # (package, compurl) -> list of positions in entries
+        self.journal = None
+        self.journalcount = 0
+        if os.path.exists(path):
+            with open(path, "r") as kfile:
+                for line in kfile:
+                    self._add(line)
+        if os.path.exists(self.journalpath):
+            replayed = self._replay()
+            print("Recovered {} KB Lookup file updates from {}".format(replayed, self.journalpath))
+            self.compact()
+
+    def _add(self, line):
+        if not line.endswith("\n"):
+            line += "\n"
+        entry = parse_kbfile_line(line)
+        self.entries.append([entry, line])
+        if entry:
+            self.index.setdefault((entry[0], entry[3]), []).append(len(self.entries) - 1)
+
+    def contains(self, line):
+        #
+        # Return True if the kbfile already has an entry identical to line
+        entry = parse_kbfile_line(line)
+        return entry is not None and any(self.entries[pos][0] == entry for pos in self.index.get((entry[0], entry[3]), []))
+
+    def _update(self, package, compurl, verurls):
+        positions = self.index.get((package, compurl))
+        if not positions:
+            #
+            # No entry for this component in the kbfile (e.g. kblookup run with -k but not -a) - create one
+            self._add(format_kbfile_entry([package, "", "", compurl, []]))
+            positions = self.index[(package, compurl)]
+        for pos in positions:
+            existing = self.entries[pos][0][4]
+            newverurls = [verurl for verurl in verurls if verurl not in existing]
+            if newverurls:
+                existing.extend(newverurls)
+                self.entries[pos][1] = None
+
+    def _replay(self):
+        count = 0
+        with open(self.journalpath, "r") as jfile:
+            for record in jfile:
+                try:
+                    record = json.loads(record)
+                except ValueError:
+                    # Partial record written when the process was killed
+                    logging.warning("KBFileStore: ignoring incomplete journal record in {}".format(self.journalpath))
+                    break
+                if record['op'] == 'add':
+                    if not self.contains(record['line']):
+                        self._add(record['line'])
+                else:
+                    self._update(record['package'], record['compurl'], [tuple(verurl) for verurl in record['verurls']])
+                count += 1
+        return count
+
+    def _log(self, record):
+        if self.journal is None:
+            self.journal = open(self.journalpath, "a")
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        self.journalcount += 1
+        if self.journalcount >= COMPACT_INTERVAL:
+            self.compact()
+
+    def add_entry(self, line):
+        #
+        # Add a new kbfile line
+        if self.contains(line):
+            return
+        self._add(line)
+        self._log({'op': 'add', 'line': line})
+
+    def add_versions(self, package, compurl, verurls):
+        #
+        # Append (version, KB version URL) pairs to the kbfile entry for package & KB component URL
+        verurls = [tuple(verurl) for verurl in verurls]
+        self._update(package, compurl, verurls)
+        self._log({'op': 'update', 'package': package, 'compurl': compurl, 'verurls': verurls})
+        logging.debug("KBFileStore: updated kbfile entry %s %s with %s", package, compurl, verurls)
+
+    def merge_file(self, path, packages=None):
+        #
+        # Add all entries from another kbfile which are not already in this kbfile (only the entries for
+        # local component names in packages if specified)
+        count = 0
+        with open(path, "r") as kfile:
+            for line in kfile:
+                entry = parse_kbfile_line(line)
+                if entry and (packages is None or entry[0] in packages) and not self.contains(line):
+                    self._add(line)
+                    count += 1
+        self.compact()
+        return count
+
+    def remove_packages(self, packages):
+        #
+        # Remove all entries for the local component names in packages and rewrite the kbfile
+        # Returns the number of entries removed
+        packages = set(packages)
+        kept = [[entry, line] for entry, line in self.entries if not (entry and entry[0] in packages)]
+        removed = len(self.entries) - len(kept)
+        if removed:
+            self._rebuild(kept)
+            self.compact()
+        return removed
+
+    def _rebuild(self, entries):
+        self.entries = []
+        self.index = {}
+        for entry, line in entries:
+            self.entries.append([entry, line])
+            if entry:
+                self.index.setdefault((entry[0], entry[3]), []).append(len(self.entries) - 1)
+
+    def merge_entries(self, path):
+        #
+        # Merge another kbfile (e.g. the partial kbfile from one kblookup --shard run) into this kbfile - entries for
+        # a package and KB component URL which is already in this kbfile are combined: versions not in the entry are
+        # added and NO VERSION MATCH versions replaced by matched versions (versions matched to a different KB version
+        # URL are left unchanged and counted as conflicts)
+        # Returns dict of the numbers of entries added and updated and version conflicts
+        counts = {'added': 0, 'updated': 0, 'conflicts': 0}
+        with open(path, "r") as kfile:
+            for line in kfile:
+                entry = parse_kbfile_line(line)
+                if entry is None:
+                    continue
+                positions = self.index.get((entry[0], entry[3]))
+                if not positions:
+                    self._add(line)
+                    counts['added'] += 1
+                    continue
+                existing = self.entries[positions[0]]
+                changed = False
+                if not existing[0][1] and entry[1]:
+                    existing[0][1], existing[0][2] = entry[1], entry[2]
+                    changed = True
+                verurls = existing[0][4]
+                for version, verurl in entry[4]:
+                    current = [pos for pos, (existingversion, existingurl) in enumerate(verurls) if existingversion == version]
+                    if not current:
+                        verurls.append((version, verurl))
+                        changed = True
+                    elif verurl != "NO VERSION MATCH" and all(verurls[pos][1] != verurl for pos in current):
+                        unmatched = [pos for pos in current if verurls[pos][1] == "NO VERSION MATCH"]
+                        if unmatched:
+                            verurls[unmatched[0]] = (version, verurl)
+                            changed = True
+                        else:
+                            counts['conflicts'] += 1
+                if changed:
+                    existing[1] = None
+                    counts['updated'] += 1
+        return counts
+
+    def reconcile(self):
+        #
+        # Remove NO MATCH entries for packages which also have entries with KB component URLs (e.g. a package not
+        # matched in one partial kbfile but matched in another) - versions of the NO MATCH entry not in the other
+        # entries are added to the first of them as NO VERSION MATCH
+        # Returns the number of entries removed
+        matched = {}    # package -> position of first entry with a KB component URL
+        versions = {}   # package -> set of versions in entries with KB component URLs
+        for pos, (entry, line) in enumerate(self.entries):
+            if entry and entry[3] != "NO MATCH":
+                matched.setdefault(entry[0], pos)
+                versions.setdefault(entry[0], set()).update(version for version, verurl in entry[4])
+        kept = []
+        for item in self.entries:
+            entry = item[0]
+            if entry and entry[3] == "NO MATCH" and entry[0] in matched:
+                first = self.entries[matched[entry[0]]]
+                for version, verurl in entry[4]:
+                    if version not in versions[entry[0]]:
+                        first[0][4].append((version, "NO VERSION MATCH"))
+                        first[1] = None
+                        versions[entry[0]].add(version)
+                continue
+            kept.append(item)
+        removed = len(self.entries) - len(kept)
+        if removed:
+            self._rebuild(kept)
+        return removed
+
+    def export(self, ofile):
+        #
+        # Write all entries to file object ofile in kbfile format
+        for entry, line in self.entries:
+            ofile.write(line if line is not None else format_kbfile_entry(entry))
+
+    def compact(self):
+        #
+        # Rewrite the kbfile atomically with the current entries and discard the journal
+        tmppath = self.path + ".tmp"
+        with open(tmppath, "w") as ofile:
+            self.export(ofile)
+            ofile.flush()
+            os.fsync(ofile.fileno())
+        os.replace(tmppath, self.path)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.journalpath):
+            os.remove(self.journalpath)
+        self.journalcount = 0
+
+    def close(self):
+        self.compact()
+
+    def __len__(self):
+        return len([entry for entry, line in self.entries if entry])
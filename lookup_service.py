@@ -0,0 +1,199 @@
+#
+# Local lookup service for import_manifest.py - serve mode runs LookupServer, which answers KB component and
+# version matching requests from one long-running process holding a single authenticated Black Duck session
+# and the in-memory KB component/version caches. kblookup and import modes use LookupClient (--server) to send
+# their KB lookups to it instead of connecting to the Black Duck server.
+#
+# The service listens on a TCP port (HOST:PORT, localhost only by default) or on a Unix socket (unix:PATH) and
+# uses JSON over HTTP/1.1 keep-alive connections:
+#   POST /v1/find-comp  {"package": NAME, "versions": [VERSION, ...], "replace_strings": [STRING, ...]}
+#                       -> {"lines": [KBFILE LINE, ...], "messages": [[VERSION, MESSAGE], ...]}
+#   POST /v1/find-ver   {"kburl": KB COMPONENT URL, "version": VERSION}
+#                       -> {"compname", "matchversion", "matchstrength", "sourceurl", "verurl"}
+#   GET  /v1/status     -> server statistics
+
+import http.client
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+DEFAULT_ADDRESS = "127.0.0.1:8787"
+
+class LookupServiceError(Exception):
+    pass
+
+def parse_address(address):
+    #
+    # Return ('unix', path) or ('tcp', (host, port)) for a 'unix:PATH', 'HOST:PORT' or 'http://HOST:PORT' address
+    if address.startswith("unix:"):
+        return 'unix', address[5:]
+    if "://" not in address:
+        address = "http://" + address
+    url = urlparse(address)
+    if not url.hostname or not url.port:
+        raise ValueError("address must be unix:PATH or HOST:PORT")
+    return 'tcp', (url.hostname, url.port)
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind() expects a (host, port) address
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        # Only the user running the server can send requests through the socket
+        os.chmod(self.server_address, 0o600)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately - without TCP_NODELAY each keep-alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug("LookupServer: " + format, *args)
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/v1/status':
+            self.send_json(200, self.server.lookup.status())
+        else:
+            self.send_json(404, {'error': "unknown request {}".format(self.path)})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {'error': "request is not JSON"})
+            return
+        handler = self.server.lookup.handlers.get(self.path)
+        if handler is None:
+            self.send_json(404, {'error': "unknown request {}".format(self.path)})
+            return
+        try:
+            result = handler(request)
+        except (KeyError, TypeError) as e:
+            self.send_json(400, {'error': "invalid request - {}".format(e)})
+            return
+        except Exception as e:
+            logging.exception("LookupServer: {} failed".format(self.path))
+            self.send_json(500, {'error': str(e)})
+            return
+        self.server.lookup.count(self.path)
+        self.send_json(200, result)
+
+class UnixLookupRequestHandler(LookupRequestHandler):
+    # TCP_NODELAY cannot be set on a Unix socket (which has no delayed ACKs)
+    disable_nagle_algorithm = False
+
+class LookupServer:
+    def __init__(self, address, handlers, status=None):
+        #
+        # handlers is a dict of request path -> function(request dict) returning the response dict
+        # status is an optional function returning extra statistics for /v1/status
+        self.handlers = handlers
+        self.extra_status = status
+        self.requests = {}
+        self.lock = threading.Lock()
+        kind, bindaddress = parse_address(address)
+        self.address = address
+        if kind == 'unix':
+            self.server = UnixHTTPServer(bindaddress, UnixLookupRequestHandler)
+        else:
+            self.server = ThreadingHTTPServer(bindaddress, LookupRequestHandler)
+        self.server.daemon_threads = True
+        self.server.lookup = self
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def status(self):
+        with self.lock:
+            result = {'requests': dict(self.requests)}
+        if self.extra_status:
+            result.update(self.extra_status())
+        return result
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.server_close()
+        if isinstance(self.server, UnixHTTPServer) and os.path.exists(self.server.server_address):
+            os.remove(self.server.server_address)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socketpath, timeout):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socketpath = socketpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketpath)
+
+class LookupClient:
+    def __init__(self, address, timeout=600):
+        self.kind, self.address = parse_address(address)
+        self.timeout = timeout
+        self.local = threading.local()  # One keep-alive connection per thread
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.kind == 'unix':
+                conn = UnixHTTPConnection(self.address, self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def call(self, method, path, request=None):
+        body = json.dumps(request).encode('utf-8') if request is not None else None
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, path, body, {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # The server may have closed an idle keep-alive connection - reconnect once
+                conn.close()
+                self.local.conn = None
+                if attempt > 0:
+                    raise LookupServiceError("Cannot connect to lookup server - {}".format(e))
+                continue
+            try:
+                result = json.loads(data)
+            except ValueError:
+                raise LookupServiceError("Invalid response from lookup server (status {})".format(response.status))
+            if response.status != 200:
+                raise LookupServiceError("Lookup server request {} failed (status {}) - {}".format(path, response.status, result.get('error')))
+            return result
+
+    def status(self):
+        return self.call('GET', '/v1/status')
+
+    def find_comp(self, package, versions, replace_strings):
+        result = self.call('POST', '/v1/find-comp', {'package': package, 'versions': versions, 'replace_strings': replace_strings})
+        return result['lines'], [tuple(message) for message in result['messages']]
+
+    def find_ver(self, kburl, version):
+        result = self.call('POST', '/v1/find-ver', {'kburl': kburl, 'version': version})
+        return result['compname'], result['matchversion'], result['matchstrength'], result['sourceurl'], result['verurl']
@@ -0,0 +1,212 @@
+#
+# Component list (manifest) readers for import_manifest.py
+#
+# Each reader is a generator which reads the file incrementally and yields (package, version) pairs,
+# so very large manifests are never held in memory. Supported formats:
+#   plain      - one 'name-version' per line (the version starts at the first '-' separated field beginning with a digit)
+#   csv        - one 'name;version' per line
+#   yocto      - Yocto/OpenEmbedded license.manifest (PACKAGE NAME/PACKAGE VERSION/LICENSE records, CLOSED licenses skipped)
+#   spdx-json  - SPDX JSON document (packages name & versionInfo)
+#   spdx-tv    - SPDX tag-value document (PackageName & PackageVersion tags)
+#   cyclonedx  - CycloneDX JSON BOM (components name & version, including nested components)
+
+import csv
+import json
+import logging
+import re
+
+FORMATS = ['auto', 'plain', 'csv', 'yocto', 'spdx-json', 'spdx-tv', 'cyclonedx']
+CHUNK_SIZE = 64 * 1024
+JSON_TOKEN = re.compile(r'["{}\[\],]')
+JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+
+def process_compfile_line(line):
+    version = ""
+    package = ""
+    splitline = line.split("-")
+    for segment in splitline:
+        if segment[:1].isdigit():
+            if version != "":
+                version += "."
+            version += segment.strip()
+        else:
+            if package != "":
+                package += "-"
+            package += segment.strip()
+    return(package, version)
+
+def read_plain(cfile):
+    for line in cfile:
+        if line.strip():
+            yield process_compfile_line(line.strip())
+
+def read_csv(cfile):
+    for row in csv.reader(cfile, delimiter=';'):
+        if len(row) >= 2 and row[0].strip():
+            yield row[0].strip(), row[1].strip()
+
+def read_yocto(cfile):
+    package = ""
+    version = ""
+    for line in cfile:
+        splitline = line.split(":", 1)
+        if len(splitline) < 2:
+            continue
+        tag = splitline[0].strip()
+        if tag == "PACKAGE NAME":
+            package = splitline[1].strip()
+            version = ""
+        elif tag == "PACKAGE VERSION":
+            version = splitline[1].strip()
+        elif tag == "LICENSE" and package:
+            if splitline[1].strip() != "CLOSED":
+                yield package, version
+            package = ""
+
+def read_spdx_tv(cfile):
+    package = None
+    version = ""
+    for line in cfile:
+        splitline = line.split(":", 1)
+        if len(splitline) < 2:
+            continue
+        tag = splitline[0].strip()
+        if tag == "PackageName":
+            if package:
+                yield package, version
+            package = splitline[1].strip()
+            version = ""
+        elif tag == "PackageVersion" and package:
+            version = splitline[1].strip()
+    if package:
+        yield package, version
+
+def iter_json_array(cfile, key):
+    #
+    # Yield the elements of the array value of top-level key in the JSON object in cfile one at a time,
+    # reading the file in chunks (only the current element is decoded in memory)
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    depth = 0
+    eof = False
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = cfile.read(CHUNK_SIZE)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    #
+    # Scan to the array for key at depth 1 (skipping strings and nested values)
+    lastkey = None
+    while True:
+        mob = JSON_TOKEN.search(buf, pos)
+        if not mob:
+            if eof:
+                return
+            pos = len(buf)
+            more()
+            continue
+        char = mob.group(0)
+        if char == '"':
+            string = JSON_STRING.match(buf, mob.start())
+            if not string:
+                # String continues in the next chunk
+                if eof:
+                    return
+                pos = mob.start()
+                more()
+                continue
+            lastkey = json.loads(string.group(0)) if depth == 1 else None
+            pos = string.end()
+            continue
+        pos = mob.end()
+        if char in '{[':
+            if depth == 1 and char == '[' and lastkey == key:
+                break
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+        elif char == ',':
+            lastkey = None
+
+    #
+    # Decode array elements one at a time
+    while True:
+        while pos < len(buf) and buf[pos] in ', \t\r\n':
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                return
+            more()
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            more()
+            continue
+        if end >= len(buf) and not eof and buf[pos] not in '{["':
+            # Number or literal at end of buffer may be incomplete
+            more()
+            continue
+        pos = end
+        yield element
+
+def read_spdx_json(cfile):
+    for package in iter_json_array(cfile, "packages"):
+        if package.get('name'):
+            yield package['name'], package.get('versionInfo', "")
+
+def cyclonedx_components(component):
+    if component.get('name'):
+        yield component['name'], component.get('version', "")
+    for subcomponent in component.get('components', []):
+        yield from cyclonedx_components(subcomponent)
+
+def read_cyclonedx(cfile):
+    for component in iter_json_array(cfile, "components"):
+        yield from cyclonedx_components(component)
+
+READERS = {
+    'plain': read_plain,
+    'csv': read_csv,
+    'yocto': read_yocto,
+    'spdx-json': read_spdx_json,
+    'spdx-tv': read_spdx_tv,
+    'cyclonedx': read_cyclonedx,
+}
+
+def detect_format(compfile):
+    #
+    # Guess the manifest format from the file name and the start of the file
+    with open(compfile, "r") as cfile:
+        head = cfile.read(8192)
+    if compfile.endswith(".spdx.json") or (head.lstrip().startswith("{") and '"spdxVersion"' in head):
+        return 'spdx-json'
+    if compfile.endswith((".cdx.json", ".bom.json")) or (head.lstrip().startswith("{") and '"bomFormat"' in head):
+        return 'cyclonedx'
+    if compfile.endswith(".spdx") or "SPDXVersion:" in head:
+        return 'spdx-tv'
+    if "PACKAGE NAME:" in head:
+        return 'yocto'
+    firstline = head.lstrip().split("\n", 1)[0]
+    if ";" in firstline:
+        return 'csv'
+    return 'plain'
+
+def read_manifest(compfile, fmt='auto'):
+    #
+    # Yield (package, version) pairs from the component list file compfile
+    if fmt == 'auto':
+        fmt = detect_format(compfile)
+    logging.debug("read_manifest(): reading {} as {}".format(compfile, fmt))
+    with open(compfile, "r") as cfile:
+        for package, version in READERS[fmt](cfile):
+            yield package, version
@@ -0,0 +1,277 @@
+#
+# Request layer for the Black Duck API calls made by import_manifest.py
+#
+# Every request goes through RequestLayer.request(), which applies:
+#   - a token bucket rate limit (--rate-limit requests per second). After a 429 (Too Many Requests) or 503 response the
+#     rate is halved (starting from the measured request rate if there is no limit), then doubled each second without
+#     throttling back up to the highest rate which held. Above that it is increased in small steps (after PROBE_DELAY
+#     seconds without throttling) until it reaches the configured limit (or the rate when throttling started if no
+#     limit is set) - a throttled step returns to just below the highest rate which held
+#   - a limit on the number of concurrent requests in total (--max-requests) and per endpoint (--endpoint-limit)
+#   - retries of failed requests (connection errors, 408, 429 and 5xx responses) with jittered exponential backoff,
+#     waiting at least as long as the Retry-After response header asks. Requests which are not idempotent (POSTs
+#     creating projects, versions and BOM components) are only retried after a 429 or 503 response or when they failed
+#     before being sent (RequestNotSent), as a request which timed out or failed with another error may have been
+#     applied by the server
+#   - a circuit breaker - after several consecutive failed requests all workers pause for a cool down period (doubled
+#     each time the breaker opens again without a successful request in between), and a Retry-After from a 429 or 503
+#     response pauses all workers until the time given
+# 401 responses call the reauth function and are retried once.
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)      # Also the statuses for which requests which are not idempotent are retried
+MAX_BACKOFF = 60            # Maximum delay between retries (seconds)
+MIN_RATE = 0.5              # Lowest request rate the adaptive rate limit reduces to (requests per second)
+RATE_WINDOW = 5             # Seconds of requests used to measure the request rate
+PROBE_STEP = 0.02           # Fraction the rate is increased by each second above the highest rate which held
+PROBE_DELAY = 10            # Seconds without throttling before the rate is increased above the highest rate which held
+
+class RequestNotSent(Exception):
+    #
+    # Raised by a send function when the request failed before it was sent to the server (e.g. connection refused
+    # or connect timeout), so it can be retried even if it is not idempotent
+    pass
+
+class FailedResponse:
+    #
+    # Returned in place of a response when a request fails without a response (e.g. connection refused)
+    status_code = 0
+    content = b""
+    headers = {}
+
+    def __init__(self, error):
+        self.error = error
+
+    def json(self):
+        return {}
+
+def retry_after(response):
+    #
+    # Return the delay in seconds requested by the Retry-After header of response (seconds or HTTP date), or None
+    value = (getattr(response, 'headers', None) or {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff(attempt):
+    #
+    # Jittered exponential delay before retry number attempt (1, 2, ...)
+    return min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.max_rate = rate        # Configured limit (None for no limit)
+        self.rate = rate            # Current limit (None for no limit)
+        self.ceiling = rate         # Rate at which the limit is removed again (no configured limit)
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.throttled = 0          # Time of the last slow_down()
+        self.increased = 0          # Time of the last rate increase
+        self.held = None            # Highest rate which ran for a second without throttling (None before throttling)
+        self.recent = deque()       # Times of recent requests (to measure the request rate)
+        self.lock = threading.Lock()
+
+    def measured_rate(self, now):
+        while self.recent and self.recent[0] < now - RATE_WINDOW:
+            self.recent.popleft()
+        if not self.recent:
+            return 0.0
+        # Measure over the time since the first recent request (at least 1 second) so a run which has just started is not under-measured
+        return len(self.recent) / max(1.0, now - self.recent[0])
+
+    def acquire(self):
+        #
+        # Wait until a request can be sent
+        with self.lock:
+            now = time.time()
+            self.recent.append(now)
+            self.measured_rate(now)
+            if self.rate is None:
+                return
+            if now - self.throttled >= 1 and now - self.increased >= 1:
+                # The rate has run for a second without throttling - double it back up to the highest rate which held,
+                # then increase it in small steps above that
+                if self.held is not None and self.rate < self.held:
+                    self.rate = min(self.held, self.rate * 2)
+                elif now - self.throttled >= PROBE_DELAY:
+                    self.held = self.rate
+                    self.rate += max(MIN_RATE, self.rate * PROBE_STEP)
+                self.increased = now
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+                elif self.rate >= self.ceiling:
+                    logging.info("RequestLayer: request rate limit removed")
+                    self.rate = None
+                    return
+            # At most one request is sent at once, so a server counting requests per second does not see a burst
+            # when the workers start again after a pause
+            self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def slow_down(self):
+        #
+        # Reduce the request rate after the server asked for fewer requests - back to the highest rate which held if
+        # the rate was being increased above it, otherwise halve it
+        with self.lock:
+            now = time.time()
+            if now - self.throttled < 1:
+                # Already reduced for this burst of throttled responses
+                return
+            current = self.rate if self.rate is not None else max(MIN_RATE, self.measured_rate(now))
+            if self.max_rate is None and self.rate is None:
+                self.ceiling = current
+            if self.held is not None and current > self.held:
+                # The highest rate which held may have been close to the limit - step back a little below it
+                self.held = self.rate = max(MIN_RATE, self.held * 0.95)
+            else:
+                # Throttled at a rate which held before (or with no rate known to hold) - the server accepts fewer requests
+                self.held = max(MIN_RATE, current * 0.9)
+                self.rate = max(MIN_RATE, current / 2)
+            self.tokens = min(self.tokens, 1.0)
+            self.updated = now
+            self.throttled = now
+        logging.warning("RequestLayer: server is throttling requests - request rate limited to {:.1f}/s".format(self.rate))
+
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        #
+        # Wait while the breaker is open
+        while True:
+            with self.lock:
+                delay = self.open_until - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.open_until = max(self.open_until, time.time() + seconds)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.threshold or time.time() < self.open_until:
+                return
+            self.open_until = time.time() + self.cooldown
+            self.opened += 1
+            self.failures = 0
+            cooldown = self.cooldown
+            self.cooldown = min(self.cooldown * 2, 600)
+        logging.warning("RequestLayer: {} consecutive failed requests - pausing requests for {:.0f} seconds".format(self.threshold, cooldown))
+
+def parse_endpoint_limits(values):
+    #
+    # Parse --endpoint-limit ENDPOINT=N values into a dict of endpoint -> maximum concurrent requests
+    limits = {}
+    for value in values or []:
+        endpoint, sep, limit = value.partition("=")
+        if not sep or not endpoint:
+            raise ValueError("'{}' is not ENDPOINT=N".format(value))
+        limits[endpoint] = int(limit)
+        if limits[endpoint] < 1:
+            raise ValueError("limit for {} must be 1 or more".format(endpoint))
+    return limits
+
+class RequestLayer:
+    def __init__(self, rate=None, max_requests=1, endpoint_limits=None, retries=5, breaker_threshold=5, breaker_cooldown=30,
+                 reauth=None, record=None):
+        #
+        # reauth is called (with no arguments) after a 401 response before the request is retried
+        # record(endpoint, status) is called for every response (status 'error' for requests with no response)
+        self.bucket = TokenBucket(rate)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.slots = threading.BoundedSemaphore(max_requests)
+        self.endpoint_slots = dict((endpoint, threading.BoundedSemaphore(limit)) for endpoint, limit in (endpoint_limits or {}).items())
+        self.retries = retries
+        self.reauth = reauth
+        self.record = record
+        self.retried = 0
+
+    def send(self, endpoint, send):
+        self.breaker.wait()
+        self.bucket.acquire()
+        with ExitStack() as stack:
+            if endpoint in self.endpoint_slots:
+                stack.enter_context(self.endpoint_slots[endpoint])
+            stack.enter_context(self.slots)
+            try:
+                response = send()
+            except Exception as e:
+                response = FailedResponse(e)
+        if self.record:
+            self.record(endpoint, response.status_code or 'error')
+        return response
+
+    def request(self, endpoint, send, retries=None, idempotent=True):
+        #
+        # Call send() (which sends one request and returns the response) for endpoint, retrying as described above
+        # (only after a throttled response or a RequestNotSent error if idempotent is False)
+        # Returns the last response, or FailedResponse if no response was received
+        retries = self.retries if retries is None else retries
+        reauthed = False
+        attempt = 0
+        while True:
+            response = self.send(endpoint, send)
+            status = response.status_code
+            if status == 401 and self.reauth and not reauthed:
+                self.reauth()
+                reauthed = True
+                continue
+            if status not in RETRY_STATUSES and status != 0:
+                self.breaker.success()
+                return response
+            self.breaker.failure()
+            delay = retry_after(response)
+            if status in THROTTLE_STATUSES:
+                self.bucket.slow_down()
+                if delay:
+                    self.breaker.pause(delay)
+            retry = idempotent or status in THROTTLE_STATUSES or (status == 0 and isinstance(response.error, RequestNotSent))
+            if attempt >= retries or not retry:
+                logging.error("RequestLayer: {} request failed after {} attempts ({}){}".format(
+                    endpoint, attempt + 1, response.error if status == 0 else "status code {}".format(status),
+                    "" if retry else " - not retried as the server may have applied it"))
+                return response
+            attempt += 1
+            self.retried += 1
+            wait = max(backoff(attempt), delay or 0)
+            logging.debug("RequestLayer: retrying %s request in %.1f seconds (status %s)", endpoint, wait, status)
+            time.sleep(wait)
+
+    def report(self):
+        return "API requests: {} retried, circuit breaker opened {} times{}".format(
+            self.retried, self.breaker.opened,
+            ", request rate limited to {:.1f}/s".format(self.bucket.rate) if self.bucket.rate is not None else "")
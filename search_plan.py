@@ -0,0 +1,105 @@
+#
+# Planned KB searches for the package names in a component list, used by import_manifest.py kblookup mode
+#
+# For each package, search_names() lists the name variants searched in the KB in order - the package name,
+# the name with '-' and '_' replaced by '::' (original name only) and by spaces, then the same for the name
+# with the trailing '-xxx' (or '.xxx') removed, repeatedly. Variants which are the same as an earlier variant
+# are only searched once.
+#
+# SearchPlan holds the search names of all packages in the component list, so each distinct search is sent
+# once per run and its result shared by all packages which search for the same name (e.g. the 'perl-module'
+# and 'perl' variants of every perl-module-* package). Results are released once every package which
+# planned the search has finished with it.
+
+import threading
+
+def search_names(compname):
+    #
+    # Return the ordered list of distinct KB search names for package name compname
+    names = []
+    origcomp = compname
+    while compname:
+        names.append(compname)
+        if (len(compname) == len(origcomp)) and (compname.find("-") > -1):
+            names.append(compname.replace("-", "::").replace("_", "::"))
+        if (compname.find("-") > -1) or (compname.find("_") > -1):
+            names.append(compname.replace("-", " ").replace("_", " "))
+        #
+        # Remove trailing -xxx (or if no -, trailing .xxx) from package name
+        newcompname = compname.rsplit("-", 1)[0]
+        if len(newcompname) == len(compname):
+            newcompname = compname.rsplit(".", 1)[0]
+            if len(newcompname) == len(compname):
+                break
+        compname = newcompname
+    return list(dict.fromkeys(name for name in names if name.strip()))
+
+class SearchPlan:
+    def __init__(self, compnames):
+        self.names = {}     # Package name -> list of search names
+        self.users = {}     # Package name -> number of packages with that name which have not finished
+        self.refs = {}      # Search name -> number of packages which have not finished with it
+        self.results = {}   # Search name -> search result (held until refs reaches 0)
+        self.loading = {}   # Search name -> threading.Event while the search is being sent
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.shared = 0
+        self.planned = 0
+        for compname in compnames:
+            if compname not in self.names:
+                self.names[compname] = search_names(compname)
+            self.users[compname] = self.users.get(compname, 0) + 1
+            for name in self.names[compname]:
+                self.refs[name] = self.refs.get(name, 0) + 1
+            self.planned += len(self.names[compname])
+        self.distinct = len(self.refs)
+
+    def search_names(self, compname):
+        return self.names.get(compname) or search_names(compname)
+
+    def search(self, name, loader):
+        #
+        # Return the result of the search for name, calling loader() only if no other package has searched for it
+        while True:
+            with self.lock:
+                if name in self.results:
+                    self.shared += 1
+                    return self.results[name]
+                event = self.loading.get(name)
+                if event is None:
+                    event = threading.Event()
+                    self.loading[name] = event
+                    self.searches += 1
+                    break
+            event.wait()
+
+        try:
+            result = loader()
+            with self.lock:
+                if self.refs.get(name, 0) > 1:
+                    self.results[name] = result
+            return result
+        finally:
+            with self.lock:
+                del self.loading[name]
+            event.set()
+
+    def release(self, compname):
+        #
+        # Package compname has finished searching - release results no other package needs
+        with self.lock:
+            if compname not in self.users:
+                return
+            for name in self.names[compname]:
+                self.refs[name] -= 1
+                if self.refs[name] <= 0:
+                    del self.refs[name]
+                    self.results.pop(name, None)
+            self.users[compname] -= 1
+            if self.users[compname] == 0:
+                del self.users[compname]
+                del self.names[compname]
+
+    def report(self):
+        return "KB search plan: {} distinct searches planned for {} name variants, {} searches sent, {} results shared".format(
+            self.distinct, self.planned, self.searches, self.shared)
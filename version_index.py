@@ -0,0 +1,142 @@
+#
+# Precompiled index of the versions of one KB component, used by import_manifest.py to match
+# a local version string against the KB version list.
+#
+# The matching rules are those of the original linear scan in find_ver_from_compver():
+#   strength 3 - exact version string match ('-' and '.' treated as equal)
+#   strength 2 - KB version is the start of the local version, or the local version is found in the
+#                KB version with no digits before it (e.g. 'v1.2.3' or 'release-1.2.3')
+#   strength 1 - versions match at the start for more than 2 characters up to the final segment and
+#                the final numeric segments are within 2 of each other
+# Rather than comparing every KB version, candidates for each rule are found with dict lookups
+# (exact and prefix matches) and bisect ranges over sorted version strings, and only those
+# candidates are checked in the original list order so the result is identical to the scan.
+
+import re
+from bisect import bisect_left
+from difflib import SequenceMatcher
+
+def normalize_version(version):
+    return version.replace('-', '.')
+
+def _prefix_range(keys, prefix):
+    #
+    # Return (start, end) indices of the entries in sorted list keys which start with prefix
+    start = bisect_left(keys, prefix)
+    end = start
+    while end < len(keys) and keys[end].startswith(prefix):
+        end += 1
+    return start, end
+
+class VersionIndex:
+    def __init__(self, items):
+        self.raw = []       # KB versionName strings in KB order
+        self.names = []     # Normalized versionName strings
+        self.urls = []      # KB version URLs
+        self.exact = {}     # Normalized name -> list of positions
+        self.final = []     # Final numeric segment of normalized name (or None)
+        stripped = []
+        for pos, item in enumerate(items or []):
+            raw = item['versionName']
+            name = normalize_version(raw)
+            self.raw.append(raw)
+            self.names.append(name)
+            self.urls.append(item['_meta']['href'])
+            self.exact.setdefault(name, []).append(pos)
+            finalsegment = name.split(".")[-1]
+            self.final.append(int(finalsegment) if finalsegment.isdigit() else None)
+            #
+            # Version string from the first digit (e.g. 'v1.2.3' -> '1.2.3')
+            mob = re.search(r'\d', name)
+            if mob:
+                stripped.append((name[mob.start():], pos))
+        ordered = sorted(zip(self.names, range(len(self.names))))
+        self.sorted_names = [name for name, pos in ordered]
+        self.sorted_names_pos = [pos for name, pos in ordered]
+        stripped.sort()
+        self.sorted_stripped = [name for name, pos in stripped]
+        self.sorted_stripped_pos = [pos for name, pos in stripped]
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, localversion):
+        #
+        # Positions of all KB versions which could be partial (strength 1 or 2) matches for localversion
+        positions = set()
+        #
+        # KB versions which are the start of the local version
+        for i in range(1, len(localversion)):
+            positions.update(self.exact.get(localversion[:i], []))
+        #
+        # KB versions containing the local version with no digits before it
+        if localversion and localversion[0].isdigit():
+            start, end = _prefix_range(self.sorted_stripped, localversion)
+            positions.update(self.sorted_stripped_pos[start:end])
+        else:
+            positions.update(pos for pos, name in enumerate(self.names) if localversion in name)
+        #
+        # KB versions matching at the start up to the final segment of the local version
+        finaldot = localversion.rfind(".")
+        if finaldot >= 0:
+            localfinalsegment = localversion.split(".")[-1]
+            if localfinalsegment.isdigit():
+                localfinal = int(localfinalsegment)
+                prefixlen = max(3, finaldot)
+                start, end = _prefix_range(self.sorted_names, localversion[:prefixlen])
+                for pos in self.sorted_names_pos[start:end]:
+                    if self.final[pos] is not None and abs(self.final[pos] - localfinal) <= 2:
+                        positions.add(pos)
+        return sorted(positions)
+
+    def match(self, version):
+        #
+        # Return (KB versionName, KB version URL, match strength) for the best match of version
+        # or ("", "", 0) if no match
+        localversion = normalize_version(version)
+        if localversion in self.exact:
+            pos = self.exact[localversion][0]
+            if self.raw[pos] == "":
+                return "", "", 0
+            return self.raw[pos], self.urls[pos], 3
+
+        matchversion = ""
+        matchstrength = 0
+        matchpos = None
+        for pos in self.candidates(localversion):
+            kbversionname = self.names[pos]
+            seq = SequenceMatcher(None, kbversionname, localversion)
+            match = seq.find_longest_match(0, len(kbversionname), 0, len(localversion))
+            if (match.a == 0) and (match.b == 0) and (match.size == len(kbversionname)):
+                # Found match of full kbversion at start of search_version
+                if len(kbversionname) > len(matchversion):
+                    matchversion = self.raw[pos]
+                    matchstrength = 2
+                    matchpos = pos
+
+            elif (match.b == 0) and (match.size == len(localversion)):
+                # Found match of full search_version within kbversion with no digits before the match
+                mob = re.search(r'\d', kbversionname[0:match.a])
+                if not mob and (len(kbversionname) > len(matchversion)):
+                    matchversion = self.raw[pos]
+                    matchpos = pos
+                    if (match.a == 1) and (kbversionname.lower() == 'v'):
+                        matchstrength = 3
+                    else:
+                        matchstrength = 2
+
+            elif (match.a == 0) and (match.b == 0) and (match.size > 2):
+                # Close numeric version match - common start up to the final segment, final segments within 2
+                if 0 <= match.size - localversion.rfind(".") <= 2:
+                    kbfinalsegment = kbversionname.split(".")[-1]
+                    localfinalsegment = localversion.split(".")[-1]
+                    if kbfinalsegment.isdigit() and localfinalsegment.isdigit():
+                        if abs(int(kbfinalsegment) - int(localfinalsegment)) <= 2:
+                            if len(kbversionname) >= len(matchversion):
+                                matchversion = self.raw[pos]
+                                matchstrength = 1
+                                matchpos = pos
+
+        if matchpos is None:
+            return "", "", 0
+        return matchversion, self.urls[matchpos], matchstrength